@@ -1,11 +1,23 @@
 import click
 from ckan.model import Session
-from ckan.plugins import toolkit
-from datacite.errors import DataCiteError
 
 from ckanext.doi.lib.api import DataciteClient
-from ckanext.doi.lib.metadata import build_metadata_dict, build_xml_dict
-from ckanext.doi.model.crud import DOIQuery
+from ckanext.doi.lib.bulk import Checkpoint, DOIUpdater
+from ckanext.doi.lib.compare import format_changes
+from ckanext.doi.lib.helpers import doi_checkpoint_path, doi_reservation_size
+from ckanext.doi.lib.metrics import flush as flush_metrics
+from ckanext.doi.lib.metrics import timed
+from ckanext.doi.lib.publish import FAILED, SKIPPED, UNCHANGED, UPDATED
+from ckanext.doi.lib.reconcile import (
+    NOT_IN_DATABASE,
+    NOT_MINTED,
+    NOT_PUBLISHED,
+    OK,
+    WRONG_URL,
+    Reconciler,
+)
+from ckanext.doi.lib.reservations import refill_pool
+from ckanext.doi.model.crud import DOIQuery, ReservationQuery
 from ckanext.doi.model.doi import DOI
 
 
@@ -24,7 +36,7 @@ def delete_dois():
     Delete all DOIs from the database.
     """
     to_delete = Session.query(DOI).filter(
-        DOI.identifier.like(f'%{DataciteClient.get_prefix()}%')
+        DOIQuery.with_prefix(DataciteClient.get_prefix())
     )
     doi_count = to_delete.count()
     if doi_count == 0:
@@ -40,48 +52,237 @@ def delete_dois():
 @click.option(
     '-p', '--package_id', 'package_ids', multiple=True, help='Package id(s) to update'
 )
-def update_doi(package_ids):
+@click.option(
+    '--verify-remote',
+    is_flag=True,
+    help='Compare against the metadata on DataCite instead of the local fingerprint',
+)
+@click.option(
+    '-w',
+    '--workers',
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help='Number of threads loading packages and building metadata',
+)
+@click.option(
+    '-c',
+    '--concurrency',
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help='Number of simultaneous requests to DataCite',
+)
+@click.option(
+    '-b',
+    '--batch-size',
+    type=click.IntRange(min=1, max=1000),
+    default=100,
+    show_default=True,
+    help='Number of packages to load from the search index at once',
+)
+@click.option(
+    '--resume',
+    is_flag=True,
+    help='Continue the last update of all DOIs from where it stopped',
+)
+@click.option(
+    '--retry-failed',
+    is_flag=True,
+    help='Only update the DOIs that failed in previous runs',
+)
+@click.option(
+    '--show-changes',
+    is_flag=True,
+    help='Show what changed in the metadata of each updated DOI, where known',
+)
+@click.option(
+    '--checkpoint',
+    'checkpoint_path',
+    type=click.Path(dir_okay=False),
+    help='File to record progress in (defaults to ckanext.doi.checkpoint_path)',
+)
+def update_doi(
+    package_ids,
+    verify_remote,
+    workers,
+    concurrency,
+    batch_size,
+    resume,
+    retry_failed,
+    show_changes,
+    checkpoint_path,
+):
     """
     Update either all DOIs in the system or the ones associated with the given packages.
     """
-    if not package_ids:
-        dois_to_update = Session.query(DOI).all()
+    if package_ids and (resume or retry_failed):
+        raise click.UsageError(
+            '--resume and --retry-failed cannot be used with --package_id'
+        )
+    if resume and retry_failed:
+        raise click.UsageError('--resume and --retry-failed cannot be used together')
+
+    checkpoint = None
+    if package_ids:
+        dois_to_update = DOIQuery.read_packages(package_ids).values()
     else:
-        dois_to_update = list(filter(None, map(DOIQuery.read_package, package_ids)))
+        checkpoint = Checkpoint(checkpoint_path or doi_checkpoint_path())
+        if resume or retry_failed:
+            checkpoint.load()
+        if retry_failed:
+            if not checkpoint.failed:
+                click.secho('No failed DOIs to retry', fg='green')
+                return
+            dois_to_update = DOIQuery.stream(identifiers=checkpoint.failed)
+        else:
+            if resume and checkpoint.complete:
+                click.secho('The last update finished; nothing to resume', fg='green')
+                return
+            dois_to_update = DOIQuery.stream(after=checkpoint.last)
+            dois_to_update = _checkpointed(dois_to_update, checkpoint)
+
+    colours = {UPDATED: 'green', UNCHANGED: 'green', SKIPPED: 'yellow', FAILED: 'red'}
 
-    if len(dois_to_update) == 0:
+    def _report(task):
+        if task.status == UPDATED:
+            message = f'Updated "{task.title}"'
+            changes = getattr(task, 'changes', None)
+            if changes:
+                if show_changes:
+                    message += f': {format_changes(changes)}'
+                else:
+                    message += f' ({", ".join(change.field for change in changes)})'
+        elif task.status == FAILED:
+            message = (
+                f'Error while updating "{task.title}" (DOI {task.identifier}): '
+                f'{task.message}'
+            )
+        else:
+            message = f'"{task.title}" {task.message}'
+        click.secho(message, fg=colours[task.status])
+        if checkpoint is None:
+            return
+        if retry_failed:
+            checkpoint.retried(task.identifier, failed=task.status == FAILED)
+        else:
+            checkpoint.finished(task.identifier, failed=task.status == FAILED)
+
+    updater = DOIUpdater(
+        workers=workers,
+        concurrency=concurrency,
+        verify_remote=verify_remote,
+        on_result=_report,
+        batch_size=batch_size,
+    )
+    finished = False
+    try:
+        with timed('update_doi.run'):
+            counts = updater.run(dois_to_update)
+        finished = True
+    finally:
+        if checkpoint is not None:
+            if finished and not retry_failed:
+                checkpoint.finish_run()
+            else:
+                checkpoint.save()
+        flush_metrics()
+
+    if sum(counts.values()) == 0:
         click.secho('No DOIs found to update', fg='green')
         return
 
-    for record in dois_to_update:
-        pkg_dict = toolkit.get_action('package_show')({}, {'id': record.package_id})
-        title = pkg_dict.get('title', record.package_id)
+    click.secho(
+        f'Updated: {counts[UPDATED]}, unchanged: {counts[UNCHANGED]}, '
+        f'skipped: {counts[SKIPPED]}, failed: {counts[FAILED]}',
+        fg='red' if counts[FAILED] else 'green',
+    )
 
-        if record.published is None:
-            click.secho(
-                f'"{title}" does not have a published DOI; ignoring', fg='yellow'
-            )
-            continue
-        if pkg_dict.get('state', 'active') != 'active' or pkg_dict.get(
-            'private', False
-        ):
-            click.secho(f'"{title}" is inactive or private; ignoring', fg='yellow')
-            continue
-
-        metadata_dict = build_metadata_dict(pkg_dict)
-        xml_dict = build_xml_dict(metadata_dict)
-
-        client = DataciteClient()
-
-        same = client.check_for_update(record.identifier, xml_dict)
-        if not same:
-            try:
-                client.set_metadata(record.identifier, xml_dict)
-                click.secho(f'Updated "{title}"', fg='green')
-            except DataCiteError as e:
-                click.secho(
-                    f'Error while updating "{title}" (DOI {record.identifier}): {e})',
-                    fg='red',
-                )
-        else:
-            click.secho(f'"{title}" is already up to date', fg='green')
+
+def _checkpointed(records, checkpoint):
+    """
+    Record each record in the checkpoint as it is queued for processing.
+    """
+    for record in records:
+        checkpoint.started(record.identifier)
+        yield record
+
+
+@doi.command(name='refill-pool')
+@click.option(
+    '-s',
+    '--size',
+    type=int,
+    help='Number of DOIs the pool should contain (defaults to '
+    'ckanext.doi.reservations.size)',
+)
+def refill_pool_command(size):
+    """
+    Reserve unused DOIs so that new packages can be assigned one without having to
+    check with DataCite.
+    """
+    if size is None:
+        size = doi_reservation_size()
+    with timed('refill_pool'):
+        added = refill_pool(size)
+    click.secho(
+        f'Reserved {added} new DOIs; the pool now contains {ReservationQuery.count()}',
+        fg='green',
+    )
+
+
+@doi.command(name='reconcile')
+@click.option(
+    '--check-urls',
+    is_flag=True,
+    help='Also check that each published DOI points at its dataset (one request per '
+    'DOI)',
+)
+@click.option('--fix', is_flag=True, help='Fix the problems that can be fixed')
+@click.option(
+    '-b',
+    '--batch-size',
+    type=click.IntRange(min=1),
+    default=1000,
+    show_default=True,
+    help='Number of DOIs to read from the database at once',
+)
+def reconcile(check_urls, fix, batch_size):
+    """
+    Check that the DOIs in the database agree with the DOIs minted on DataCite.
+    """
+    descriptions = {
+        NOT_IN_DATABASE: 'minted on DataCite but not in the database',
+        NOT_PUBLISHED: 'minted on DataCite but not marked as published',
+        NOT_MINTED: 'marked as published but not minted on DataCite',
+        WRONG_URL: 'points at the wrong URL',
+    }
+
+    unfixed = 0
+
+    def _report(discrepancy):
+        nonlocal unfixed
+        if not discrepancy.fixed:
+            unfixed += 1
+        message = f'{discrepancy.identifier} is {descriptions[discrepancy.category]}'
+        if discrepancy.package_id:
+            message += f' (package {discrepancy.package_id})'
+        if discrepancy.detail:
+            message += f': {discrepancy.detail}'
+        if discrepancy.fixed:
+            message += ' - fixed'
+        click.secho(message, fg='green' if discrepancy.fixed else 'red')
+
+    reconciler = Reconciler(
+        check_urls=check_urls, fix=fix, on_result=_report, batch_size=batch_size
+    )
+    with timed('reconcile'):
+        counts = reconciler.run()
+    flush_metrics()
+
+    summary = ', '.join(
+        f'{category.replace("_", " ")}: {counts[category]}'
+        for category in (NOT_IN_DATABASE, NOT_PUBLISHED, NOT_MINTED, WRONG_URL)
+        if category != WRONG_URL or check_urls
+    )
+    click.secho(f'OK: {counts[OK]}, {summary}', fg='red' if unfixed else 'green')
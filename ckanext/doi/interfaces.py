@@ -27,6 +27,20 @@ class IDoi(interfaces.Interface):
         """
         return metadata_dict, errors
 
+    def doi_metadata_fields(self):
+        """
+        Optionally declares the fields this plugin's build_metadata_dict uses. If it
+        does, build_metadata_dict is only given those fields: a package dict holding
+        just the keys it reads, and metadata and errors dicts holding just the keys it
+        writes. Only the keys it writes are taken from what it returns. Its results are
+        cached, so it is only called again once the values of these fields change, so
+        it mustn't depend on anything else.
+
+        :returns: None (the default) to be given the full dicts every time, or a tuple
+            of (list of package dict keys it reads, list of metadata keys it writes)
+        """
+        return None
+
     def build_xml_dict(self, metadata_dict, xml_dict):
         """
         Converts the metadata_dict into an xml_dict that can be passed to the datacite
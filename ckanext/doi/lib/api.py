@@ -7,23 +7,76 @@
 import logging
 import random
 import string
+import threading
 from datetime import datetime as dt
 
-import xmltodict
 from ckan.plugins import toolkit
-from datacite import DataCiteMDSClient, schema42
-from datacite.errors import DataCiteError, DataCiteNotFoundError
+from datacite.errors import DataCiteError
 
-from ckanext.doi.lib.helpers import doi_test_mode
+from ckanext.doi.lib.backends import MDSBackend, RESTBackend
+from ckanext.doi.lib.compare import (
+    canonical_metadata,
+    diff_metadata,
+    format_changes,
+    metadata_fingerprint,
+)
+from ckanext.doi.lib.helpers import (
+    doi_api,
+    doi_backoff,
+    doi_retries,
+    doi_test_mode,
+    doi_timeout,
+    doi_verify_remote,
+)
+from ckanext.doi.lib.http import (
+    PooledDataCiteMDSClient,
+    PooledDataCiteRESTClient,
+    reset_session,
+)
+from ckanext.doi.lib.metrics import timed
+from ckanext.doi.lib.resilience import reset_breaker
+from ckanext.doi.lib.validation import validate_xml_dict
 from ckanext.doi.model.crud import DOIQuery
 
 log = logging.getLogger(__name__)
 
 DEPRECATED_TEST_PREFIX = '10.5072'
 
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Get the DataciteClient shared by this process. It is created on first use; the
+    underlying connections are pooled so reusing it avoids reconnecting to DataCite on
+    every call.
+
+    :returns: a DataciteClient
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = DataciteClient()
+    return _client
+
+
+def reset_client():
+    """
+    Discard the shared DataciteClient, its connections and the circuit breaker, e.g.
+    after the config has changed.
+    """
+    global _client
+    with _client_lock:
+        _client = None
+    reset_session()
+    reset_breaker()
+
 
 class DataciteClient:
     test_url = 'https://mds.test.datacite.org'
+    rest_test_url = 'https://api.test.datacite.org'
 
     def __init__(self):
         self.username = toolkit.config.get('ckanext.doi.account_name')
@@ -35,11 +88,22 @@ class DataciteClient:
             'password': self.password,
             'prefix': self.prefix,
             'test_mode': self.test_mode,
+            'timeout': doi_timeout(),
+            'retries': doi_retries(),
+            'backoff': doi_backoff(),
         }
-        if self.test_mode:
-            # temporary fix because datacite 1.0.1 isn't updated for the test prefix deprecation
-            client_config['url'] = self.test_url
-        self.client = DataCiteMDSClient(**client_config)
+        if doi_api() == 'rest':
+            if self.test_mode:
+                client_config['url'] = self.rest_test_url
+            self.client = PooledDataCiteRESTClient(**client_config)
+            self.backend = RESTBackend(self.client)
+        else:
+            if self.test_mode:
+                # temporary fix because datacite 1.0.1 isn't updated for the test
+                # prefix deprecation
+                client_config['url'] = self.test_url
+            self.client = PooledDataCiteMDSClient(**client_config)
+            self.backend = MDSBackend(self.client)
 
     @property
     def test_mode(self):
@@ -70,6 +134,39 @@ class DataciteClient:
             )
         return prefix
 
+    def random_doi(self):
+        """
+        Generate a random DOI using our prefix. This does not check whether it is in
+        use.
+
+        :returns: the full DOI
+        """
+        # the list of valid characters is larger than just lowercase and the digits but
+        # we don't need that many options and URLs with just alphanumeric characters in
+        # them are nicer. We just use lowercase characters to avoid any issues with case
+        # being ignored
+        valid_characters = string.ascii_lowercase + string.digits
+        # generate a random 8 character identifier
+        identifier = ''.join(random.choice(valid_characters) for _ in range(8))
+        # form the doi using the prefix
+        return f'{self.prefix}/{identifier}'
+
+    def is_unused(self, doi):
+        """
+        Check with Datacite that the given DOI is not in use.
+
+        :param doi: the full DOI
+        :returns: True if Datacite doesn't know about the DOI, False if it does or if
+            the check fails
+        """
+        try:
+            return self.backend.get_metadata(doi) is None
+        except DataCiteError as e:
+            log.warning(
+                f'Error whilst checking new DOIs with DataCite. DOI: {doi}, error: {e}'
+            )
+        return False
+
     def generate_doi(self):
         """
         Generate a new DOI which isn't currently in use.
@@ -79,110 +176,208 @@ class DataciteClient:
         uses no locking.
         :returns: the full, unique DOI
         """
-        # the list of valid characters is larger than just lowercase and the digits but we don't
-        # need that many options and URLs with just alphanumeric characters in them are nicer. We
-        # just use lowercase characters to avoid any issues with case being ignored
-        valid_characters = string.ascii_lowercase + string.digits
-
         attempts = 5
 
         while attempts > 0:
-            # generate a random 8 character identifier
-            identifier = ''.join(random.choice(valid_characters) for _ in range(8))
-            # form the doi using the prefix
-            doi = f'{self.prefix}/{identifier}'
-
-            if DOIQuery.read_doi(doi) is None:
-                try:
-                    self.client.metadata_get(doi)
-                except DataCiteNotFoundError:
-                    return doi
-                except DataCiteError as e:
-                    log.warning(
-                        f'Error whilst checking new DOIs with DataCite. DOI: {doi}, '
-                        f'error: {e}'
-                    )
+            doi = self.random_doi()
+            if DOIQuery.read_doi(doi) is None and self.is_unused(doi):
+                return doi
             attempts -= 1
         raise Exception('Failed to generate a DOI')
 
+    @staticmethod
+    def permalink(package_id):
+        """
+        Get the URL a package's DOI should point to, i.e. the package page.
+
+        :param package_id: the id of the package
+        :returns: the URL
+        """
+        site = toolkit.config.get('ckan.site_url')
+        if site[-1] != '/':
+            site += '/'
+        return f'{site}dataset/{package_id}'
+
+    def list_dois(self):
+        """
+        List the DOIs with our prefix that have been minted on datacite. The list is
+        streamed, so this is fine for any number of DOIs.
+
+        :returns: a generator of DOIs, as datacite has them (i.e. usually upper case)
+        """
+        return self.backend.list_dois(self.prefix)
+
+    def get_url(self, doi):
+        """
+        Get the URL a DOI points to on datacite.
+
+        :param doi: the DOI
+        :returns: the URL, or None if the DOI hasn't been minted
+        """
+        return self.backend.get_url(doi)
+
+    def set_url(self, doi, package_id):
+        """
+        Point an already minted DOI at its package's page again.
+
+        :param doi: the DOI
+        :param package_id: the id of the package the DOI is for
+        """
+        self.backend.mint(doi, self.permalink(package_id))
+
     def mint_doi(self, doi, package_id):
         """
         Mints the given DOI on datacite. Does not add metadata, just creates the DOI.
 
         :param doi: the doi (full, prefix and suffix)
         :param package_id: the id of the package this doi is for
+        :returns: a CachedDOI of the package's record
         """
 
-        # create the URL the DOI will point to, i.e. the package page
-        site = toolkit.config.get('ckan.site_url')
-        if site[-1] != '/':
-            site += '/'
-        permalink = f'{site}dataset/{package_id}'
-        # mint the DOI
-        self.client.doi_post(doi, permalink)
-        if DOIQuery.read_doi(doi) is None and DOIQuery.read_package(package_id) is None:
-            DOIQuery.create(doi, package_id)
-        elif DOIQuery.read_doi(doi) is None:
-            # in case this was previously attempted but no DOI was added
-            DOIQuery.update_package(package_id, identifier=doi)
-        DOIQuery.update_doi(doi, published=dt.now())
-
-    def set_metadata(self, doi, xml_dict):
+        permalink = self.permalink(package_id)
+        with timed('mint_doi'):
+            # mint the DOI
+            self.backend.mint(doi, permalink)
+            # creates the record if the package doesn't have one, or points it at this
+            # DOI in case a previous attempt didn't get that far
+            return DOIQuery.record_mint(doi, package_id, dt.now())
+
+    def validate_metadata(self, doi, xml_dict):
+        """
+        Add the DOI to the xml_dict and check that it is valid.
+
+        :param doi: the DOI the metadata is for
+        :param xml_dict: the metadata as an xml dict (generated from build_xml_dict)
+        """
+        xml_dict['identifiers'] = [{'identifierType': 'DOI', 'identifier': doi}]
+
+        # check that the data is valid, this will raise a DOIValidationError listing all
+        # the issues if there are any
+        with timed('validate'):
+            validate_xml_dict(xml_dict)
+
+    def _prepare_metadata(self, doi, xml_dict, validate):
+        if validate:
+            self.validate_metadata(doi, xml_dict)
+        else:
+            xml_dict['identifiers'] = [{'identifierType': 'DOI', 'identifier': doi}]
+
+    def _record_metadata(self, doi, xml_dict):
+        # remember what we posted so that future changes can be detected locally
+        DOIQuery.update_doi(
+            doi, metadata_hash=metadata_fingerprint(xml_dict), synced=dt.now()
+        )
+
+    def set_metadata(self, doi, xml_dict, validate=True):
         """
         Update or create the metadata for a given DOI on datacite.
 
         :param doi: the DOI to update the metadata for
         :param xml_dict: the metadata as an xml dict (generated from build_xml_dict)
+        :param validate: whether to validate the metadata first; only skip this if
+            validate_metadata has already been called
         :returns:
         """
-        xml_dict['identifiers'] = [{'identifierType': 'DOI', 'identifier': doi}]
+        self._prepare_metadata(doi, xml_dict, validate)
+        # create the metadata on datacite
+        self.backend.set_metadata(doi, xml_dict)
+        self._record_metadata(doi, xml_dict)
 
-        # check that the data is valid, this will raise a JSON schema exception if there are issues
-        schema42.validator.validate(xml_dict)
+    def publish_doi(self, doi, package_id, xml_dict, validate=True):
+        """
+        Create the metadata for a new DOI and mint it. With the REST API this is a
+        single request; with the MDS API the metadata is posted and then the DOI is
+        minted.
 
-        xml_doc = schema42.tostring(xml_dict)
-        # create the metadata on datacite
-        self.client.metadata_post(xml_doc)
+        :param doi: the doi (full, prefix and suffix)
+        :param package_id: the id of the package this doi is for
+        :param xml_dict: the metadata as an xml dict (generated from build_xml_dict)
+        :param validate: whether to validate the metadata first; only skip this if
+            validate_metadata has already been called
+        :returns: a CachedDOI of the package's record
+        """
+        self._prepare_metadata(doi, xml_dict, validate)
+        with timed('publish_doi'):
+            self.backend.publish(doi, xml_dict, self.permalink(package_id))
+            self._record_metadata(doi, xml_dict)
+            return DOIQuery.record_mint(doi, package_id, dt.now())
 
     def get_metadata(self, doi):
         """
         Retrieve metadata for a given DOI on datacite.
 
         :param doi: the DOI for which to retrieve the stored metadata
-        :returns:
+        :returns: the XML document (MDS API) or attributes dict (REST API), or None if
+            datacite doesn't have any
         """
-        try:
-            metadata = self.client.metadata_get(doi)
-        except DataCiteNotFoundError:
-            metadata = None
-        return metadata
+        return self.backend.get_metadata(doi)
 
-    def check_for_update(self, doi, xml_dict):
+    def check_for_update(self, doi, xml_dict, verify_remote=None):
         """
         Compare generated xml_dict against the one already posted on datacite.
 
         :param doi: the DOI of the package
         :param xml_dict: the xml_dict generated by build_xml_dict
+        :param verify_remote: compare against datacite even if there is a local
+            fingerprint; defaults to the ckanext.doi.verify_remote config option
         :returns: True if the two are the same, False if not
         """
-        posted_xml = self.get_metadata(doi)
-        if posted_xml is None or posted_xml.strip() == '':
-            return False
-        posted_xml_dict = dict(xmltodict.parse(posted_xml).get('resource', {}))
-        new_xml_dict = dict(xmltodict.parse(schema42.tostring(xml_dict))['resource'])
-        if 'identifier' in posted_xml_dict:
-            del posted_xml_dict['identifier']
-        has_dates = 'dates' in posted_xml_dict and 'date' in posted_xml_dict['dates']
-        if has_dates:
-            posted_xml_dict['dates']['date'] = [
-                d
-                for d in posted_xml_dict['dates']['date']
-                if d['@dateType'] != 'Updated'
-            ]
-            new_xml_dict['dates']['date'] = [
-                d for d in new_xml_dict['dates']['date'] if d['@dateType'] != 'Updated'
-            ]
-            return posted_xml_dict == new_xml_dict
-        else:
-            # if the original doesn't have any dates, it's definitely different
-            return False
+        return self.find_changes(doi, xml_dict, verify_remote=verify_remote) == []
+
+    def find_changes(self, doi, xml_dict, verify_remote=None):
+        """
+        Find out how the generated xml_dict differs from the metadata already posted on
+        datacite. The order of values in fields like subjects and formats is ignored.
+
+        If we have a fingerprint of the last metadata posted for this DOI the comparison
+        is done locally, unless verify_remote is set, in which case the metadata is
+        always downloaded from datacite and compared.
+
+        :param doi: the DOI of the package
+        :param xml_dict: the xml_dict generated by build_xml_dict
+        :param verify_remote: compare against datacite even if there is a local
+            fingerprint; defaults to the ckanext.doi.verify_remote config option
+        :returns: a list of FieldChanges (empty if the metadata is the same), or None if
+            the metadata has changed but the details aren't known (i.e. only the local
+            fingerprint was compared, or nothing has been posted)
+        """
+        if verify_remote is None:
+            verify_remote = doi_verify_remote()
+
+        with timed('check_for_update') as timer:
+            fingerprint = metadata_fingerprint(xml_dict)
+
+            if not verify_remote:
+                record = DOIQuery.read_doi(doi)
+                if record is not None and record.metadata_hash is not None:
+                    same = record.metadata_hash == fingerprint
+                    timer.tag(source='local', result='same' if same else 'changed')
+                    return [] if same else None
+
+            timer.tag(source='remote')
+            changes = self._check_remote(doi, xml_dict)
+            if changes == []:
+                # record the fingerprint so the next check doesn't need to go to
+                # datacite
+                DOIQuery.update_doi(doi, metadata_hash=fingerprint)
+                timer.tag(result='same')
+            else:
+                if changes:
+                    log.info(
+                        f'Metadata for DOI {doi} has changed: {format_changes(changes)}'
+                    )
+                timer.tag(result='changed')
+            return changes
+
+    def _check_remote(self, doi, xml_dict):
+        """
+        Compare generated xml_dict against the metadata downloaded from datacite.
+
+        :param doi: the DOI of the package
+        :param xml_dict: the xml_dict generated by build_xml_dict
+        :returns: a list of FieldChanges, or None if there is no metadata on datacite
+        """
+        posted = self.backend.get_canonical(doi)
+        if posted is None:
+            return None
+        return diff_metadata(posted, canonical_metadata(xml_dict))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+The DataCite APIs DOIs can be registered through.
+
+The API is selected by ckanext.doi.api:
+
+- "mds": the MDS API, which takes metadata as XML and needs separate requests to post
+  the metadata and to mint the DOI
+- "rest": the REST API (https://support.datacite.org/docs/api), which takes metadata
+  as JSON and creates, registers and updates a DOI in a single request
+
+Both backends take metadata as xml_dicts (as produced by build_xml_dict) and return it
+in canonical form (see the compare module), so the rest of the extension doesn't need
+to know which one is in use.
+"""
+
+from datacite.errors import DataCiteNoContentError, DataCiteNotFoundError
+
+from ckanext.doi.lib.compare import canonical_xml, canonicalise
+from ckanext.doi.lib.metrics import timed
+from ckanext.doi.lib.serialisation import normalise, to_xml
+
+# the keys that differ between xml_dicts (which follow the datacite library's schema42
+# module) and the REST API's JSON
+_JSON_KEYS = {
+    'schemeURI': 'schemeUri',
+    'valueURI': 'valueUri',
+    'rightsURI': 'rightsUri',
+    'awardURI': 'awardUri',
+}
+_XML_DICT_KEYS = {v: k for k, v in _JSON_KEYS.items()}
+
+
+def _rename(value, keys):
+    if isinstance(value, list):
+        return [_rename(v, keys) for v in value]
+    if isinstance(value, dict):
+        return {keys.get(k, k): _rename(v, keys) for k, v in value.items()}
+    return value
+
+
+def _people(people, to_json):
+    """
+    Convert the affiliations of creators or contributors, which are lists of
+    {"affiliation": name} in xml_dicts and lists of {"name": name} in the REST API.
+    """
+    converted = []
+    for person in people:
+        person = dict(person)
+        if to_json and 'affiliations' in person:
+            person['affiliation'] = [
+                {'name': a['affiliation']} for a in person.pop('affiliations')
+            ]
+        elif not to_json and 'affiliation' in person:
+            person['affiliations'] = [
+                {'affiliation': a['name'] if isinstance(a, dict) else a}
+                for a in person.pop('affiliation')
+            ]
+        converted.append(person)
+    return converted
+
+
+def to_attributes(xml_dict):
+    """
+    Convert an xml_dict into REST API attributes.
+
+    :param xml_dict: the xml_dict
+    :returns: a new dict
+    """
+    attributes = _rename(xml_dict, _JSON_KEYS)
+    for field in ('creators', 'contributors'):
+        if field in attributes:
+            attributes[field] = _people(attributes[field], to_json=True)
+    # the DOI itself goes in the doi attribute
+    identifiers = [
+        i for i in attributes.pop('identifiers', []) if i.get('identifierType') != 'DOI'
+    ]
+    if identifiers:
+        attributes['identifiers'] = identifiers
+    return attributes
+
+
+def from_attributes(attributes):
+    """
+    Convert REST API attributes (as returned by DataCite) into an xml_dict. Attributes
+    which aren't part of the metadata (e.g. the state, URL and citation counts) are
+    kept but are ignored by the serialisation module.
+
+    :param attributes: the attributes dict
+    :returns: a new dict
+    """
+    # empty fields (the REST API includes every field in its responses, whether it
+    # has a value or not) and numbers are dealt with by the serialisation module
+    xml_dict = _rename(attributes, _XML_DICT_KEYS)
+    for field in ('creators', 'contributors'):
+        if field in xml_dict:
+            xml_dict[field] = _people(xml_dict[field], to_json=False)
+    if isinstance(xml_dict.get('publisher'), dict):
+        # returned as an object when asked for with publisher=true
+        xml_dict['publisher'] = xml_dict['publisher'].get('name')
+    if xml_dict.get('types'):
+        # left out if it isn't set, but schema42 (and so normalise) needs it
+        xml_dict['types'] = {'resourceType': None, **xml_dict['types']}
+    if xml_dict.get('doi'):
+        xml_dict['identifiers'] = [
+            {'identifierType': 'DOI', 'identifier': xml_dict['doi']}
+        ] + xml_dict.get('identifiers', [])
+    return xml_dict
+
+
+class MDSBackend:
+    """
+    Registers DOIs through DataCite's MDS API.
+    """
+
+    name = 'mds'
+
+    def __init__(self, client):
+        """
+        :param client: a PooledDataCiteMDSClient
+        """
+        self.client = client
+
+    def get_metadata(self, doi):
+        """
+        Get the metadata DataCite has for a DOI.
+
+        :param doi: the DOI
+        :returns: the XML document, or None if there isn't one
+        :raises DataCiteError: if DataCite has the DOI but can't return its metadata
+            (e.g. a DataCiteGoneError if it has been deleted)
+        """
+        with timed('datacite.metadata_get') as timer:
+            try:
+                return self.client.metadata_get(doi)
+            except DataCiteNotFoundError:
+                timer.tag(result='not_found')
+                return None
+
+    def get_canonical(self, doi):
+        """
+        Get the metadata DataCite has for a DOI, in canonical form.
+
+        :param doi: the DOI
+        :returns: a dict, or None if there is no metadata
+        """
+        xml = self.get_metadata(doi)
+        if xml is None or xml.strip() == '':
+            return None
+        return canonical_xml(xml)
+
+    def set_metadata(self, doi, xml_dict):
+        """
+        Create or replace the metadata for a DOI, without minting it.
+
+        :param doi: the DOI
+        :param xml_dict: the xml_dict, including the DOI identifier
+        """
+        with timed('to_xml'):
+            xml_doc = to_xml(xml_dict)
+        with timed('datacite.metadata_post'):
+            self.client.metadata_post(xml_doc)
+
+    def mint(self, doi, url):
+        """
+        Mint a DOI which already has metadata, pointing it at the given URL. This is
+        also used to change the URL of a minted DOI.
+
+        :param doi: the DOI
+        :param url: the URL the DOI should resolve to
+        """
+        with timed('datacite.doi_post'):
+            self.client.doi_post(doi, url)
+
+    def publish(self, doi, xml_dict, url):
+        """
+        Post the metadata for a DOI and then mint it.
+
+        :param doi: the DOI
+        :param xml_dict: the xml_dict, including the DOI identifier
+        :param url: the URL the DOI should resolve to
+        """
+        self.set_metadata(doi, xml_dict)
+        self.mint(doi, url)
+
+    def get_url(self, doi):
+        """
+        :param doi: the DOI
+        :returns: the URL the DOI resolves to, or None if it hasn't been minted
+        """
+        with timed('datacite.doi_get') as timer:
+            try:
+                return self.client.doi_get(doi)
+            except (DataCiteNoContentError, DataCiteNotFoundError):
+                # datacite says no content for DOIs with metadata but no URL
+                timer.tag(result='not_found')
+                return None
+
+    def list_dois(self, prefix):
+        """
+        :param prefix: the DOI prefix
+        :returns: a generator of the minted DOIs with the prefix
+        """
+        prefix = f'{prefix}/'.lower()
+        with timed('datacite.doi_list'):
+            for doi in self.client.doi_list():
+                if doi.lower().startswith(prefix):
+                    yield doi
+
+
+class RESTBackend:
+    """
+    Registers DOIs through DataCite's REST API.
+    """
+
+    name = 'rest'
+
+    def __init__(self, client):
+        """
+        :param client: a PooledDataCiteRESTClient
+        """
+        self.client = client
+
+    def _put(self, doi, attributes):
+        with timed('datacite.dois_put'):
+            return self.client.put_doi(
+                doi, {'type': 'dois', 'attributes': {'doi': doi, **attributes}}
+            )
+
+    def get_metadata(self, doi):
+        """
+        Get the attributes DataCite has for a DOI.
+
+        :param doi: the DOI
+        :returns: the attributes dict, or None if DataCite doesn't know the DOI
+        """
+        with timed('datacite.dois_get') as timer:
+            try:
+                return self.client.get_metadata(doi)
+            except DataCiteNotFoundError:
+                timer.tag(result='not_found')
+                return None
+
+    def get_canonical(self, doi):
+        """
+        Get the metadata DataCite has for a DOI, in canonical form.
+
+        :param doi: the DOI
+        :returns: a dict, or None if there is no metadata
+        """
+        attributes = self.get_metadata(doi)
+        if attributes is None:
+            return None
+        canonical = canonicalise(normalise(from_attributes(attributes)))
+        return canonical or None
+
+    def set_metadata(self, doi, xml_dict):
+        """
+        Create or replace the metadata for a DOI. New DOIs are created as drafts.
+
+        :param doi: the DOI
+        :param xml_dict: the xml_dict
+        """
+        self._put(doi, to_attributes(xml_dict))
+
+    def mint(self, doi, url):
+        """
+        Register a DOI (making it findable) and point it at the given URL. This is also
+        used to change the URL of a registered DOI.
+
+        :param doi: the DOI
+        :param url: the URL the DOI should resolve to
+        """
+        self._put(doi, {'url': url, 'event': 'publish'})
+
+    def publish(self, doi, xml_dict, url):
+        """
+        Create or update a DOI, set its metadata and URL, and register it, all in one
+        request.
+
+        :param doi: the DOI
+        :param xml_dict: the xml_dict
+        :param url: the URL the DOI should resolve to
+        """
+        self._put(doi, {**to_attributes(xml_dict), 'url': url, 'event': 'publish'})
+
+    def get_url(self, doi):
+        """
+        :param doi: the DOI
+        :returns: the URL the DOI resolves to, or None if it hasn't been registered
+        """
+        attributes = self.get_metadata(doi)
+        if attributes is None or attributes.get('state') == 'draft':
+            return None
+        return attributes.get('url') or None
+
+    def list_dois(self, prefix):
+        """
+        :param prefix: the DOI prefix
+        :returns: a generator of the DOIs with the prefix
+        """
+        prefix = prefix.lower()
+        with timed('datacite.dois_list'):
+            for doi in self.client.doi_list(prefix):
+                if doi.lower().startswith(f'{prefix}/'):
+                    yield doi
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import json
+import os
+import threading
+from collections import Counter, deque
+
+from ckan.plugins import toolkit
+
+from ckanext.doi.lib.api import get_client
+from ckanext.doi.lib.helpers import doi_details, doi_validation_mode
+from ckanext.doi.lib.metadata import (
+    build_metadata_dict,
+    build_xml_dict,
+    get_metadata_context,
+)
+from ckanext.doi.lib.metrics import count, timed
+from ckanext.doi.lib.pipeline import run_pipeline
+from ckanext.doi.lib.publish import FAILED, SKIPPED, UNCHANGED, UPDATED, is_publishable
+
+
+def load_packages(package_ids):
+    """
+    Load many packages with a single search. The package dicts come from the search
+    index, so they are the same as package_show's output as of the last time each
+    package was indexed; the DOI fields are not included. Packages which aren't in the
+    index (e.g. private or deleted packages) are missing from the result.
+
+    :param package_ids: a list of package ids
+    :returns: a dict of package ids and package dicts
+    """
+    if not package_ids:
+        return {}
+    ids = ' OR '.join(f'"{package_id}"' for package_id in package_ids)
+    result = toolkit.get_action('package_search')(
+        {'ignore_auth': True},
+        {'fq': f'id:({ids})', 'rows': len(package_ids), 'include_private': True},
+    )
+    return {pkg_dict['id']: pkg_dict for pkg_dict in result['results']}
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DOIUpdater:
+    """
+    Updates the metadata on DataCite for many DOIs at once. Each DOI goes through four
+    stages: load the package, build and validate the metadata, compare it with what was
+    last posted, and post it if it has changed. Loading and building use one pool of
+    worker threads and the DataCite stages use another, so that building metadata for
+    one package overlaps with waiting on DataCite for others.
+
+    Packages are fetched from the search index in batches as the DOIs are queued; only
+    packages that aren't found there are loaded individually.
+    """
+
+    def __init__(
+        self,
+        workers=1,
+        concurrency=1,
+        verify_remote=False,
+        on_result=None,
+        batch_size=100,
+    ):
+        """
+        :param workers: number of threads loading packages and building metadata
+        :param concurrency: number of threads making requests to DataCite
+        :param verify_remote: always compare against the metadata on DataCite
+        :param on_result: optional function called with each finished Task
+        :param batch_size: number of packages to load from the search index at once
+        """
+        self.workers = workers
+        self.concurrency = concurrency
+        self.verify_remote = verify_remote
+        self.on_result = on_result
+        self.batch_size = batch_size
+        # validate everything up front, or only what is about to be posted
+        self.validate_early = doi_validation_mode() == 'always'
+        self.client = get_client()
+        # the site-wide values are worked out once for the whole run
+        self.context = get_metadata_context()
+        self.counts = Counter()
+
+    def run(self, records):
+        """
+        Update the given DOIs.
+
+        :param records: an iterable of DOI records
+        :returns: a Counter of the number of DOIs with each outcome
+        """
+        stages = [
+            (self.load_package, self.workers),
+            (self.build_metadata, self.workers),
+            (self.check_metadata, self.concurrency),
+            (self.post_metadata, self.concurrency),
+        ]
+        run_pipeline(self._load(records), stages, self._handle_result, FAILED)
+        return self.counts
+
+    def _load(self, records):
+        """
+        Generate the items to go through the pipeline, loading the packages in
+        batches.
+        """
+        for chunk in _chunks(records, self.batch_size):
+            with timed('update_doi.load_packages'):
+                pkg_dicts = load_packages([r.package_id for r in chunk])
+            for record in chunk:
+                # copy the values we need from the record so that it isn't tied to this
+                # thread's database session
+                yield (
+                    record.identifier,
+                    record.package_id,
+                    record.published,
+                    pkg_dicts.get(record.package_id),
+                )
+
+    def _handle_result(self, task):
+        self.counts[task.status] += 1
+        count('update_doi', task.status)
+        if self.on_result is not None:
+            self.on_result(task)
+
+    def load_package(self, task):
+        """
+        Stage 1: get the package dict and skip DOIs that shouldn't be updated.
+        """
+        identifier, package_id, published, pkg_dict = task.item
+        task.identifier = identifier
+        task.title = package_id
+        if pkg_dict is None:
+            # not in the search index so we have to load it the slow way
+            with timed('package_show'):
+                pkg_dict = toolkit.get_action('package_show')({}, {'id': package_id})
+        else:
+            # the indexed copy may not have up-to-date DOI details so add them here
+            pkg_dict.update(doi_details(identifier, published))
+        task.pkg_dict = pkg_dict
+        task.title = pkg_dict.get('title', package_id)
+
+        if published is None:
+            task.finish(SKIPPED, 'does not have a published DOI; ignoring')
+        elif not is_publishable(task.pkg_dict):
+            task.finish(SKIPPED, 'is inactive or private; ignoring')
+
+    def build_metadata(self, task):
+        """
+        Stage 2: build (and optionally validate) the metadata.
+        """
+        with timed('build_metadata_dict'):
+            metadata_dict = build_metadata_dict(task.pkg_dict, self.context)
+        with timed('build_xml_dict'):
+            task.xml_dict = build_xml_dict(metadata_dict)
+        if self.validate_early:
+            self.client.validate_metadata(task.identifier, task.xml_dict)
+
+    def check_metadata(self, task):
+        """
+        Stage 3: find out what has changed since the metadata was last posted.
+        """
+        task.changes = self.client.find_changes(
+            task.identifier, task.xml_dict, verify_remote=self.verify_remote
+        )
+        if task.changes == []:
+            task.finish(UNCHANGED, 'is already up to date')
+
+    def post_metadata(self, task):
+        """
+        Stage 4: post the new metadata to DataCite.
+        """
+        self.client.set_metadata(
+            task.identifier, task.xml_dict, validate=not self.validate_early
+        )
+        task.finish(UPDATED, 'updated')
+
+
+class Checkpoint:
+    """
+    Records the progress of a bulk update in a JSON file so that an interrupted run can
+    be resumed and failed DOIs retried.
+
+    DOIs are finished out of order when the update runs concurrently, so the
+    checkpoint keeps track of the DOIs that have been started (in order) and only moves
+    the "last" marker forward once every DOI up to it has been finished.
+    """
+
+    def __init__(self, path, save_every=100):
+        """
+        :param path: the path of the checkpoint file
+        :param save_every: write the file after this many DOIs have been finished
+        """
+        self.path = path
+        self.save_every = save_every
+        self.last = None
+        self.complete = False
+        self.failed = set()
+        self._pending = deque()
+        self._done = set()
+        self._since_save = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the state of the previous run from the file, if there is one.
+
+        :returns: self
+        """
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            self.last = state.get('last')
+            self.complete = state.get('complete', False)
+            self.failed = set(state.get('failed', []))
+        return self
+
+    def save(self):
+        """
+        Write the current state to the file.
+        """
+        with self._lock:
+            state = {
+                'last': self.last,
+                'complete': self.complete,
+                'failed': sorted(self.failed),
+            }
+            self._since_save = 0
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        # replace the old file in one go so it is never left half-written
+        os.replace(tmp_path, self.path)
+
+    def started(self, identifier):
+        """
+        Record that a DOI has been queued for processing. Must be called in DOI order.
+
+        :param identifier: the DOI
+        """
+        with self._lock:
+            self.complete = False
+            self._pending.append(identifier)
+
+    def finished(self, identifier, failed=False):
+        """
+        Record that a DOI has been processed.
+
+        :param identifier: the DOI
+        :param failed: whether processing failed
+        """
+        with self._lock:
+            if failed:
+                self.failed.add(identifier)
+            else:
+                self.failed.discard(identifier)
+            self._done.add(identifier)
+            while self._pending and self._pending[0] in self._done:
+                self.last = self._pending.popleft()
+                self._done.remove(self.last)
+            self._since_save += 1
+            should_save = self._since_save >= self.save_every
+        if should_save:
+            self.save()
+
+    def retried(self, identifier, failed=False):
+        """
+        Record the result of retrying a previously failed DOI. This doesn't affect the
+        position of the sweep.
+
+        :param identifier: the DOI
+        :param failed: whether processing failed again
+        """
+        with self._lock:
+            if failed:
+                self.failed.add(identifier)
+            else:
+                self.failed.discard(identifier)
+
+    def finish_run(self):
+        """
+        Record that the run went through every DOI and save.
+        """
+        with self._lock:
+            self.complete = not self._pending
+        self.save()
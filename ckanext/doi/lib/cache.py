@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import threading
+import time
+from collections import OrderedDict
+
+# returned by TTLCache.get when there is no (unexpired) entry for a key
+MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread-safe, in-memory least-recently-used cache where entries also expire after
+    a set number of seconds. None is a valid value to cache.
+    """
+
+    def __init__(self, max_size, ttl, timer=time.monotonic):
+        """
+        :param max_size: the maximum number of entries; the least recently used entry
+            is dropped when the cache is full
+        :param ttl: the number of seconds an entry is valid for; if this is 0, nothing
+            is cached
+        :param timer: function returning the current time in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """
+        Whether anything will actually be cached.
+        """
+        return self.ttl > 0 and self.max_size > 0
+
+    def get(self, key):
+        """
+        Get the cached value for the given key.
+
+        :param key: the key
+        :returns: the value, or MISSING if there is no valid entry
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires <= self.timer():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """
+        Add or replace the value for the given key.
+
+        :param key: the key
+        :param value: the value
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = (self.timer() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove the entry for the given key, if there is one.
+
+        :param key: the key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        """
+        The number of entries, including any that have expired.
+        """
+        return len(self._entries)
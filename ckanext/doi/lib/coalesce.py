@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+Coalescing of DOI syncs, so that a burst of updates to a package (e.g. adding lots of
+resources, or a harvester) results in at most one sync with DataCite per package per
+ckanext.doi.coalesce_window seconds.
+
+State is kept in the redis server CKAN uses for its job queue, so it is shared by the
+web and job workers:
+
+- ckanext-doi:pending:<package id> is set while a sync job for the package is queued;
+  further updates don't queue another job as the queued one will load the latest
+  version of the package when it runs
+- ckanext-doi:synced:<package id> is set when the package is synced and expires after
+  the window; while it exists, updates are handed to a job which waits for it to expire
+- ckanext-doi:lock:<package id> is held while the package is being synced, so that two
+  workers never sync the same package at once
+"""
+
+import logging
+import math
+import time
+
+from ckan.lib.redis import connect_to_redis
+
+log = logging.getLogger(__name__)
+
+# a queued job that never runs (e.g. its worker was killed) stops further jobs being
+# queued for the package for at most this many seconds
+PENDING_TTL = 600
+# the longest a sync can hold the lock for, and the longest a job waits for it; the
+# coalesce window must be shorter than this
+LOCK_TIMEOUT = 300
+
+
+def _key(kind, package_id):
+    return f'ckanext-doi:{kind}:{package_id}'
+
+
+def claim_pending(package_id, conn=None):
+    """
+    Mark a sync job as queued for the package, if there isn't one already.
+
+    :param package_id: the id of the package
+    :param conn: the redis connection to use; defaults to CKAN's
+    :returns: True if a job should be queued, False if one already has been
+    """
+    conn = conn or connect_to_redis()
+    return bool(conn.set(_key('pending', package_id), 1, nx=True, ex=PENDING_TTL))
+
+
+class SyncLock:
+    """
+    Held while a package's DOI is synced with DataCite.
+    """
+
+    def __init__(self, package_id, window, conn=None, sleep=time.sleep):
+        """
+        :param package_id: the id of the package
+        :param window: the minimum number of seconds between syncs of the package
+        :param conn: the redis connection to use; defaults to CKAN's
+        :param sleep: function used to wait until the package can be synced again
+        """
+        self.package_id = package_id
+        self.window = window
+        self.conn = conn or connect_to_redis()
+        self.sleep = sleep
+        self._lock = self.conn.lock(_key('lock', package_id), timeout=LOCK_TIMEOUT)
+
+    def acquire(self, blocking=True):
+        """
+        Take the lock, unless another worker is syncing the package or (when not
+        blocking) it was synced less than the window ago or a sync job is queued for it.
+
+        When blocking, this first waits for the window since the last sync to pass and
+        only then waits for the lock, so the lock is only held while the package is
+        actually being synced. If the lock can't be taken, the package is no longer
+        marked as having a sync job queued, so that later updates queue another one.
+
+        :param blocking: wait for the window since the last sync to pass and then for
+            the lock (for up to LOCK_TIMEOUT seconds)
+        :returns: True if the package can be synced now, False if not
+        """
+        synced_key = _key('synced', self.package_id)
+        pending_key = _key('pending', self.package_id)
+        if not blocking:
+            if self.conn.exists(synced_key, pending_key):
+                return False
+            if not self._lock.acquire(blocking=False):
+                return False
+        else:
+            while True:
+                wait = self.conn.pttl(synced_key)
+                if wait > 0:
+                    log.debug(f'Waiting {wait}ms to sync {self.package_id} again')
+                    self.sleep(wait / 1000)
+                if not self._lock.acquire(blocking_timeout=LOCK_TIMEOUT):
+                    self.conn.delete(pending_key)
+                    return False
+                if self.conn.pttl(synced_key) <= 0:
+                    break
+                # another worker synced the package while we waited for the lock, so
+                # wait for the window again
+                self._lock.release()
+        # anything that happens to the package from here on needs another sync
+        self.conn.delete(pending_key)
+        return True
+
+    def release(self, synced=True):
+        """
+        Release the lock.
+
+        :param synced: whether the package was synced, in which case the next sync has
+            to wait for the window to pass
+        """
+        if synced and self.window > 0:
+            self.conn.set(
+                _key('synced', self.package_id), 1, px=math.ceil(self.window * 1000)
+            )
+        self._lock.release()
+
+    def __enter__(self):
+        """
+        Wait for and take the lock.
+
+        :raises TimeoutError: if the lock couldn't be taken
+        """
+        if not self.acquire():
+            raise TimeoutError(
+                f'Timed out waiting for another sync of {self.package_id} to finish'
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """
+        Release the lock, starting the window before the next sync if there wasn't an
+        error.
+        """
+        self.release(synced=exc_type is None)
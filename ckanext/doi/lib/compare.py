@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import json
+from collections import Counter, namedtuple
+
+from ckanext.doi.lib.serialisation import from_xml, normalise
+
+# fields where the order of the values doesn't mean anything, so a change in order
+# alone is not a change in the metadata
+UNORDERED_FIELDS = (
+    'identifiers',
+    'subjects',
+    'contributors',
+    'sizes',
+    'formats',
+    'rightsList',
+)
+
+# a difference in one field of the metadata; for fields holding a list, removed and
+# added are the values only in the old and only in the new metadata respectively, for
+# other fields they contain the whole old and new values
+FieldChange = namedtuple('FieldChange', ['field', 'removed', 'added'])
+
+
+def _key(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def canonicalise(normalised):
+    """
+    Get the canonical form of normalised metadata (see the serialisation module). This
+    contains only the values that matter when deciding whether DataCite needs updating,
+    i.e. it doesn't include the DOI itself or the "Updated" date (which changes on
+    every save), and the values in UNORDERED_FIELDS are sorted.
+
+    :param normalised: a dict from serialisation.normalise or serialisation.from_xml
+    :returns: a new dict
+    """
+    canonical = dict(normalised)
+    identifiers = [
+        i for i in canonical.pop('identifiers', []) if i.get('identifierType') != 'DOI'
+    ]
+    if identifiers:
+        canonical['identifiers'] = identifiers
+    dates = [d for d in canonical.pop('dates', []) if d.get('dateType') != 'Updated']
+    if dates:
+        canonical['dates'] = dates
+    for field in UNORDERED_FIELDS:
+        if field in canonical:
+            canonical[field] = sorted(canonical[field], key=_key)
+    return canonical
+
+
+def canonical_metadata(xml_dict):
+    """
+    Get the canonical form of an xml_dict.
+
+    :param xml_dict: the xml_dict generated by build_xml_dict
+    :returns: a new dict
+    """
+    return canonicalise(normalise(xml_dict))
+
+
+def canonical_xml(xml):
+    """
+    Get the canonical form of DataCite XML, e.g. as downloaded from DataCite.
+
+    :param xml: the XML document as str or bytes
+    :returns: a new dict
+    """
+    return canonicalise(from_xml(xml))
+
+
+def metadata_fingerprint(xml_dict):
+    """
+    Generate a hash of the canonical form of an xml_dict. Two xml_dicts with the same
+    fingerprint would result in the same metadata on DataCite.
+
+    :param xml_dict: the xml_dict generated by build_xml_dict
+    :returns: the hex digest as a str
+    """
+    serialised = _key(canonical_metadata(xml_dict))
+    return hashlib.sha256(serialised.encode('utf-8')).hexdigest()
+
+
+def exact_fingerprint(xml_dict):
+    """
+    Generate a hash of an xml_dict exactly as it is, e.g. for caching the results of
+    checks where the types and order of the values matter.
+
+    :param xml_dict: the xml_dict
+    :returns: the hex digest as a str
+    """
+    return hashlib.sha256(_key(xml_dict).encode('utf-8')).hexdigest()
+
+
+def diff_metadata(old, new):
+    """
+    Find the fields which differ between two sets of canonical metadata.
+
+    :param old: the canonical form of the old metadata
+    :param new: the canonical form of the new metadata
+    :returns: a list of FieldChanges, sorted by field; empty if they are the same
+    """
+    changes = []
+    for field in sorted(old.keys() | new.keys()):
+        old_value = old.get(field)
+        new_value = new.get(field)
+        if old_value == new_value:
+            continue
+        if isinstance(old_value, list) or isinstance(new_value, list):
+            old_value = old_value or []
+            new_value = new_value or []
+            old_counts = Counter(_key(v) for v in old_value)
+            new_counts = Counter(_key(v) for v in new_value)
+            removed = [json.loads(k) for k in (old_counts - new_counts).elements()]
+            added = [json.loads(k) for k in (new_counts - old_counts).elements()]
+            if not removed and not added:
+                # same values, different order
+                removed, added = old_value, new_value
+        else:
+            removed = [] if old_value is None else [old_value]
+            added = [] if new_value is None else [new_value]
+        changes.append(FieldChange(field, removed, added))
+    return changes
+
+
+def format_changes(changes):
+    """
+    Describe a list of FieldChanges in a single line, for logs and the CLI.
+
+    :param changes: a list of FieldChanges
+    :returns: a str
+    """
+    parts = []
+    for change in changes:
+        values = [f'-{_key(v)}' for v in change.removed]
+        values += [f'+{_key(v)}' for v in change.added]
+        parts.append(f'{change.field}: {" ".join(values)}')
+    return '; '.join(parts)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from datetime import datetime
+from functools import lru_cache
+
+import dateutil.parser as parser
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    """
+    Convert a date string into a datetime. CKAN's own timestamps are ISO 8601 (e.g.
+    2020-11-09T17:14:06.700561) so datetime.fromisoformat is tried first as it is much
+    faster than dateutil, which is only used for anything it can't handle. The same
+    strings come up again and again (e.g. when the citation snippet is rendered) so
+    the results are memoised; datetimes are immutable so they can be shared.
+
+    :param value: a date string
+    :returns: datetime
+    :raises ValueError: if the string isn't a date dateutil understands
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except (ValueError, AttributeError):
+        # AttributeError: fromisoformat was added in python 3.7
+        return parser.parse(value)
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import copy
+import hashlib
+import json
+import threading
+
+from ckan.plugins import PluginImplementations
+
+from ckanext.doi.interfaces import IDoi
+from ckanext.doi.lib.cache import MISSING, TTLCache
+from ckanext.doi.lib.helpers import doi_cache_size, doi_context_ttl
+from ckanext.doi.lib.metrics import count, timed
+
+_chain = None
+_chain_lock = threading.Lock()
+
+
+def _declared_fields(plugin):
+    """
+    Get the fields a plugin says its build_metadata_dict uses, if it says.
+
+    :param plugin: an IDoi implementation
+    :returns: a tuple of (package dict keys it reads, metadata keys it writes), or None
+    """
+    # plugins that don't inherit IDoi's default methods won't have this one
+    declare = getattr(plugin, 'doi_metadata_fields', None)
+    fields = declare() if declare is not None else None
+    if fields is None:
+        return None
+    reads, writes = fields
+    return tuple(reads), tuple(writes)
+
+
+def _fingerprint(*values):
+    text = json.dumps(values, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class PluginChain:
+    """
+    The IDoi implementations, found once rather than every time metadata is built.
+
+    Plugins which declare the fields they use (see IDoi.doi_metadata_fields) are only
+    given those fields rather than the whole package and metadata dicts, and what they
+    return is cached against the values of those fields, so they aren't called again
+    until one of them changes. Other plugins are called with everything, every time.
+    """
+
+    def __init__(self, plugins, cache=None):
+        """
+        :param plugins: the IDoi implementations, in the order they should run
+        :param cache: the TTLCache to keep the results of plugins which declare their
+            fields in; defaults to one sized by ckanext.doi.cache.size that keeps
+            results for ckanext.doi.context_ttl seconds
+        """
+        self.plugins = [(plugin, _declared_fields(plugin)) for plugin in plugins]
+        self.cache = (
+            cache
+            if cache is not None
+            else TTLCache(doi_cache_size(), doi_context_ttl())
+        )
+
+    @property
+    def package_fields(self):
+        """
+        The package dict keys the plugins read.
+
+        :returns: a sorted list of keys, or None if any plugin hasn't declared its
+            fields (so could read anything)
+        """
+        keys = set()
+        for _, fields in self.plugins:
+            if fields is None:
+                return None
+            keys.update(fields[0])
+        return sorted(keys)
+
+    def build_metadata_dict(self, pkg_dict, metadata_dict, errors):
+        """
+        Pass the metadata through each plugin's build_metadata_dict.
+
+        :param pkg_dict: package dictionary
+        :param metadata_dict: the metadata dict built by this extension
+        :param errors: a dictionary of metadata keys and errors
+        :returns: metadata_dict, errors
+        """
+        for index, (plugin, fields) in enumerate(self.plugins):
+            if fields is None:
+                # implementations should remove relevant errors from the errors dict if
+                # they successfully handle an item
+                with timed('idoi.build_metadata_dict', plugin=plugin.name):
+                    metadata_dict, errors = plugin.build_metadata_dict(
+                        pkg_dict, metadata_dict, errors
+                    )
+            else:
+                self._run_declared(
+                    index, plugin, fields, pkg_dict, metadata_dict, errors
+                )
+        return metadata_dict, errors
+
+    def _run_declared(self, index, plugin, fields, pkg_dict, metadata_dict, errors):
+        """
+        Run a plugin which has declared its fields, updating metadata_dict and errors
+        in place.
+        """
+        reads, writes = fields
+        pkg_view = {k: pkg_dict[k] for k in reads if k in pkg_dict}
+        own_metadata = {k: metadata_dict[k] for k in writes if k in metadata_dict}
+        own_errors = {k: errors[k] for k in writes if k in errors}
+        key = (index, _fingerprint(pkg_view, own_metadata, sorted(own_errors)))
+
+        cached = self.cache.get(key)
+        if cached is MISSING:
+            with timed('idoi.build_metadata_dict', plugin=plugin.name):
+                new_metadata, new_errors = plugin.build_metadata_dict(
+                    pkg_view, own_metadata, own_errors
+                )
+            outputs = {k: new_metadata[k] for k in writes if k in new_metadata}
+            remaining = {k: new_errors[k] for k in writes if k in new_errors}
+            self.cache.set(key, (copy.deepcopy(outputs), remaining))
+        else:
+            count('idoi.build_metadata_dict', 'cached', plugin=plugin.name)
+            outputs, remaining = cached
+            # the metadata dict may be changed later so don't hand out the cached copy
+            outputs = copy.deepcopy(outputs)
+
+        for k in writes:
+            if k in outputs:
+                metadata_dict[k] = outputs[k]
+            else:
+                metadata_dict.pop(k, None)
+            if k in remaining:
+                errors[k] = remaining[k]
+            else:
+                errors.pop(k, None)
+
+    def build_xml_dict(self, metadata_dict, xml_dict):
+        """
+        Pass the xml dict through each plugin's build_xml_dict.
+
+        :param metadata_dict: the metadata dict generated from build_metadata_dict
+        :param xml_dict: the xml dict built by this extension
+        :returns: xml_dict
+        """
+        for plugin, _ in self.plugins:
+            with timed('idoi.build_xml_dict', plugin=plugin.name):
+                xml_dict = plugin.build_xml_dict(metadata_dict, xml_dict)
+        return xml_dict
+
+
+def get_plugin_chain():
+    """
+    Get the PluginChain shared by this process, creating it if necessary.
+
+    :returns: a PluginChain
+    """
+    global _chain
+    if _chain is None:
+        with _chain_lock:
+            if _chain is None:
+                _chain = PluginChain(PluginImplementations(IDoi))
+    return _chain
+
+
+def reset_plugin_chain():
+    """
+    Discard the shared PluginChain so that the IDoi implementations are found again,
+    e.g. after plugins have been loaded or unloaded.
+    """
+    global _chain
+    with _chain_lock:
+        _chain = None
@@ -4,6 +4,45 @@
 # This file is part of ckanext-doi
 # Created by the Natural History Museum in London, UK
 
+from datacite.errors import HttpError
+from jsonschema import ValidationError
+
 
 class DOIMetadataException(Exception):
     pass
+
+
+class DOIValidationError(DOIMetadataException, ValidationError):
+    """
+    Raised when metadata doesn't match the DataCite schema. Holds every error found,
+    not just the first. Also a jsonschema ValidationError so that code catching those
+    still works.
+    """
+
+    def __init__(self, errors):
+        """
+        :param errors: a list of jsonschema ValidationErrors
+        """
+        self.errors = errors
+        messages = [
+            f'{"/".join(map(str, e.absolute_path)) or "(root)"}: {e.message}'
+            for e in errors
+        ]
+        super().__init__('; '.join(messages))
+
+
+class DataCiteUnavailableError(HttpError):
+    """
+    Raised instead of making a request to DataCite when recent requests have failed
+    and the circuit breaker is open.
+    """
+
+    def __init__(self, retry_in):
+        """
+        :param retry_in: seconds until requests will be tried again
+        """
+        self.retry_in = retry_in
+        super().__init__(
+            f'DataCite is unavailable; requests will be tried again in '
+            f'{retry_in:.0f} seconds'
+        )
@@ -4,12 +4,16 @@
 # This file is part of ckanext-doi
 # Created by the Natural History Museum in London, UK
 
+import os
+import tempfile
 from datetime import datetime
 
-import dateutil.parser as parser
 from ckan.plugins import toolkit
 from ckantools.config import get_debug, get_setting
 
+from ckanext.doi.lib.coalesce import LOCK_TIMEOUT
+from ckanext.doi.lib.dates import parse_date
+
 
 def package_get_year(pkg_dict):
     """
@@ -17,10 +21,10 @@ def package_get_year(pkg_dict):
 
     :param pkg_dict: return:
     """
-    if not isinstance(pkg_dict['metadata_created'], datetime):
-        pkg_dict['metadata_created'] = parser.parse(pkg_dict['metadata_created'])
-
-    return pkg_dict['metadata_created'].year
+    created = pkg_dict['metadata_created']
+    if not isinstance(created, datetime):
+        created = parse_date(created)
+    return created.year
 
 
 def get_site_title():
@@ -44,6 +48,25 @@ def get_site_url():
     return site_url.rstrip('/')
 
 
+def doi_details(identifier, published):
+    """
+    Get the DOI fields that are added to package dicts.
+
+    :param identifier: the DOI
+    :param published: the date the DOI was published (datetime or None)
+    :returns: dict
+    """
+    return {
+        'doi': identifier,
+        'doi_status': True if published else False,
+        'domain': get_site_url().replace('http://', ''),
+        'doi_date_published': (
+            datetime.strftime(published, '%Y-%m-%d') if published else None
+        ),
+        'doi_publisher': toolkit.config.get('ckanext.doi.publisher'),
+    }
+
+
 def date_or_none(date_object_or_string):
     """
     Try and convert the given object into a datetime; if not possible, return None.
@@ -54,7 +77,7 @@ def date_or_none(date_object_or_string):
     if isinstance(date_object_or_string, datetime):
         return date_object_or_string
     elif isinstance(date_object_or_string, str):
-        return parser.parse(date_object_or_string)
+        return parse_date(date_object_or_string)
     else:
         return None
 
@@ -66,3 +89,269 @@ def doi_test_mode():
     :returns: bool
     """
     return toolkit.asbool(get_setting('ckanext.doi.test_mode', default=get_debug()))
+
+
+def doi_api():
+    """
+    Get the DataCite API to register DOIs through: "mds" (XML) or "rest" (JSON).
+
+    :returns: str
+    """
+    api = get_setting('ckanext.doi.api', default='mds')
+    if api not in ('mds', 'rest'):
+        raise ValueError(f'Invalid ckanext.doi.api "{api}"; use "mds" or "rest"')
+    return api
+
+
+def doi_publish_async():
+    """
+    Determines whether DOIs should be synced with DataCite in a background job rather
+    than during the request that updated the dataset.
+
+    :returns: bool
+    """
+    mode = get_setting('ckanext.doi.publish_mode', default='sync')
+    if mode not in ('sync', 'async'):
+        raise ValueError(
+            f'Invalid ckanext.doi.publish_mode "{mode}"; use "sync" or "async"'
+        )
+    return mode == 'async'
+
+
+def doi_job_queue():
+    """
+    Get the name of the job queue to add DOI sync jobs to.
+
+    :returns: str queue name
+    """
+    return get_setting('ckanext.doi.job_queue', default='default')
+
+
+def doi_coalesce_window():
+    """
+    Get the minimum number of seconds between syncs of the same package with DataCite.
+    Updates made within this time of a sync are collected into one job. 0 disables
+    this.
+
+    :returns: float
+    """
+    window = float(get_setting('ckanext.doi.coalesce_window', default=0))
+    if window >= LOCK_TIMEOUT:
+        raise ValueError(
+            f'Invalid ckanext.doi.coalesce_window "{window:g}"; it must be less than '
+            f'{LOCK_TIMEOUT} seconds'
+        )
+    return window
+
+
+def doi_pool_size():
+    """
+    Get the maximum number of connections to keep open to DataCite.
+
+    :returns: int
+    """
+    return int(get_setting('ckanext.doi.pool_size', default=10))
+
+
+def doi_timeout():
+    """
+    Get the connect and read timeouts (in seconds) for requests to DataCite.
+
+    :returns: tuple of (connect timeout, read timeout)
+    """
+    return (
+        float(get_setting('ckanext.doi.timeout.connect', default=5)),
+        float(get_setting('ckanext.doi.timeout.read', default=30)),
+    )
+
+
+def doi_retries():
+    """
+    Get the number of times to retry a request to DataCite that failed with a 5xx or
+    429 response, or couldn't connect.
+
+    :returns: int
+    """
+    return int(get_setting('ckanext.doi.retry.attempts', default=2))
+
+
+def doi_backoff():
+    """
+    Get the limits (in seconds) on the random delay before the first retry and before
+    any retry. The first limit doubles with each retry until it reaches the second.
+
+    :returns: tuple of (initial limit, maximum limit)
+    """
+    return (
+        float(get_setting('ckanext.doi.retry.backoff', default=0.5)),
+        float(get_setting('ckanext.doi.retry.max_backoff', default=10)),
+    )
+
+
+def doi_breaker_threshold():
+    """
+    Get the number of requests to DataCite that must fail in a row before further
+    requests are refused. 0 disables the circuit breaker.
+
+    :returns: int
+    """
+    return int(get_setting('ckanext.doi.breaker.threshold', default=5))
+
+
+def doi_breaker_reset_timeout():
+    """
+    Get the number of seconds requests to DataCite are refused for once the circuit
+    breaker has opened.
+
+    :returns: float
+    """
+    return float(get_setting('ckanext.doi.breaker.reset_timeout', default=30))
+
+
+def doi_verify_remote():
+    """
+    Determines whether metadata should always be compared against the copy on DataCite,
+    rather than the fingerprint of the last metadata we posted.
+
+    :returns: bool
+    """
+    return toolkit.asbool(get_setting('ckanext.doi.verify_remote', default=False))
+
+
+def doi_skip_irrelevant():
+    """
+    Determines whether dataset updates that don't change any of the fields DOI metadata
+    is built from should skip syncing with DataCite.
+
+    :returns: bool
+    """
+    return toolkit.asbool(get_setting('ckanext.doi.skip_irrelevant', default=True))
+
+
+def doi_reservation_size():
+    """
+    Get the number of DOIs to keep in the reservation pool. If this is 0 the pool is
+    not refilled automatically.
+
+    :returns: int
+    """
+    return int(get_setting('ckanext.doi.reservations.size', default=0))
+
+
+def doi_checkpoint_path():
+    """
+    Get the path of the file used to record the progress of update-doi runs.
+
+    :returns: str path
+    """
+    default_dir = get_setting('ckan.storage_path', default=tempfile.gettempdir())
+    return get_setting(
+        'ckanext.doi.checkpoint_path',
+        default=os.path.join(default_dir, 'ckanext-doi-update.json'),
+    )
+
+
+def doi_cache_size():
+    """
+    Get the maximum number of packages to cache DOI records for.
+
+    :returns: int
+    """
+    return int(get_setting('ckanext.doi.cache.size', default=1000))
+
+
+def doi_cache_ttl():
+    """
+    Get the number of seconds DOI records are cached for. 0 disables the cache.
+
+    :returns: float
+    """
+    return float(get_setting('ckanext.doi.cache.ttl', default=60))
+
+
+def doi_context_ttl():
+    """
+    Get the number of seconds the site-wide values used to build metadata (publisher,
+    site URL, language and licenses) are kept for before being worked out again.
+
+    :returns: float
+    """
+    return float(get_setting('ckanext.doi.context_ttl', default=300))
+
+
+def doi_validation_mode():
+    """
+    Get when metadata should be checked against the DataCite schema before posting it:
+    "always", "changed" (in update-doi, only when the metadata has changed) or "cli"
+    (only in update-doi).
+
+    :returns: str
+    """
+    mode = get_setting('ckanext.doi.validation', default='always')
+    if mode not in ('always', 'changed', 'cli'):
+        raise ValueError(
+            f'Invalid ckanext.doi.validation "{mode}"; use "always", "changed" or "cli"'
+        )
+    return mode
+
+
+def doi_metrics_sinks():
+    """
+    Get the names of the sinks timings and counts should be sent to, from the
+    space-separated ckanext.doi.metrics option: any of "log", "statsd" and
+    "prometheus". Metrics are not recorded at all if this is empty.
+
+    :returns: list of str
+    """
+    sinks = get_setting('ckanext.doi.metrics', default='').split()
+    unknown = set(sinks) - {'log', 'statsd', 'prometheus'}
+    if unknown:
+        raise ValueError(
+            f'Unknown ckanext.doi.metrics sinks: {", ".join(sorted(unknown))}; use '
+            f'"log", "statsd" and/or "prometheus"'
+        )
+    return sinks
+
+
+def doi_metrics_prefix():
+    """
+    Get the prefix for metric names.
+
+    :returns: str
+    """
+    return get_setting('ckanext.doi.metrics.prefix', default='ckanext_doi')
+
+
+def doi_statsd_address():
+    """
+    Get the host and port of the statsd server to send metrics to.
+
+    :returns: tuple of (host, port)
+    """
+    host = get_setting('ckanext.doi.metrics.statsd_host', default='localhost')
+    port = get_setting('ckanext.doi.metrics.statsd_port', default=8125)
+    return host, int(port)
+
+
+def doi_prometheus_path():
+    """
+    Get the path of the file Prometheus metrics are written to (e.g. in the node
+    exporter's textfile collector directory). "{pid}" in the path is replaced with the
+    process id, so each process writes its own file.
+
+    :returns: str
+    """
+    default_dir = get_setting('ckan.storage_path', default=tempfile.gettempdir())
+    return get_setting(
+        'ckanext.doi.metrics.prometheus_path',
+        default=os.path.join(default_dir, 'ckanext_doi.{pid}.prom'),
+    )
+
+
+def doi_metrics_flush_interval():
+    """
+    Get the minimum number of seconds between writes of the Prometheus metrics file.
+
+    :returns: float
+    """
+    return float(get_setting('ckanext.doi.metrics.flush_interval', default=15))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import json
+import ssl
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from datacite import DataCiteMDSClient, DataCiteRESTClient
+from datacite.errors import DataCiteError, HttpError
+from datacite.request import DataCiteRequest
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests.exceptions import RequestException
+
+from ckanext.doi.lib.errors import DataCiteUnavailableError
+from ckanext.doi.lib.helpers import doi_pool_size
+from ckanext.doi.lib.metrics import count
+from ckanext.doi.lib.resilience import RETRYABLE_STATUSES, backoff_delay, get_breaker
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Get the process-wide requests session used for all DataCite calls. The session
+    keeps connections alive so that subsequent calls can skip the TCP/TLS handshake.
+    It is created on first use and is safe to share between threads.
+
+    :returns: a requests.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                pool_size = doi_pool_size()
+                adapter = HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size
+                )
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def reset_session():
+    """
+    Close the shared session and its pooled connections. A new one will be created
+    the next time it is needed.
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+
+class PooledDataCiteRequest(DataCiteRequest):
+    """
+    A DataCiteRequest that sends requests through the shared session rather than
+    opening a new connection every time. Requests that fail with a 5xx or 429 response
+    or that can't connect are retried (see ckanext.doi.lib.resilience), and no requests
+    are made while the circuit breaker is open.
+    """
+
+    def __init__(self, *args, retries=0, backoff=(0.5, 10), sleep=time.sleep, **kwargs):
+        """
+        Takes the same arguments as DataCiteRequest, plus the ones below.
+
+        :param retries: number of times to retry a request that failed in a way that
+            might not happen again
+        :param backoff: tuple of the limits (in seconds) on the delay before the first
+            retry and before any retry
+        :param sleep: function used to wait before retrying
+        """
+        super().__init__(*args, **kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+
+    def request(
+        self, url, method='GET', body=None, params=None, headers=None, stream=False
+    ):
+        """
+        Make a request using the shared session.
+
+        :param stream: don't download the response body straight away, so that it can
+            be read bit by bit with iter_lines
+        """
+        params = params or {}
+        headers = headers or {}
+
+        if self.default_params:
+            params.update(self.default_params)
+
+        if self.base_url:
+            url = self.base_url + url
+
+        if body and isinstance(body, str):
+            body = body.encode('utf-8')
+
+        kwargs = dict(
+            auth=HTTPBasicAuth(self.username, self.password),
+            params=params,
+            headers=headers,
+        )
+        if method in ('POST', 'PUT'):
+            kwargs['data'] = body
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        if stream:
+            kwargs['stream'] = True
+
+        breaker = get_breaker()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                count('datacite.request', 'rejected')
+                raise DataCiteUnavailableError(breaker.retry_in())
+
+            response = None
+            retry_after = None
+            try:
+                response = get_session().request(method, url, **kwargs)
+            except (RequestException, ssl.SSLError) as e:
+                breaker.failure()
+                # only retry if the request didn't get through; if DataCite took too
+                # long to respond, waiting for it all over again won't help
+                if not isinstance(e, requests.exceptions.ConnectionError):
+                    raise HttpError(e)
+                error = HttpError(e)
+            except BaseException:
+                # don't leave the breaker waiting for the result of a trial request
+                breaker.failure()
+                raise
+            else:
+                if response.status_code >= 500:
+                    breaker.failure()
+                else:
+                    # even a 429 means that DataCite is up
+                    breaker.success()
+                if response.status_code not in RETRYABLE_STATUSES:
+                    return response
+                retry_after = response.headers.get('Retry-After')
+
+            if attempt >= self.retries or not breaker.available:
+                if response is None:
+                    raise error
+                return response
+
+            count('datacite.request', 'retried')
+            if response is not None:
+                # give the connection back to the pool
+                response.close()
+            self.sleep(backoff_delay(attempt, *self.backoff, retry_after=retry_after))
+            attempt += 1
+
+
+class _PooledClient:
+    """
+    Makes a DataCite client from the datacite library reuse pooled connections.
+    """
+
+    def __init__(self, *args, url=None, retries=0, backoff=(0.5, 10), **kwargs):
+        """
+        Takes the same arguments as the datacite library's client, except that the url
+        is used even in test mode (the datacite library always uses its own test URL),
+        plus the retries and backoff arguments of PooledDataCiteRequest.
+        """
+        super().__init__(*args, url=url, **kwargs)
+        if url:
+            self.api_url = url if url.endswith('/') else f'{url}/'
+        self.retries = retries
+        self.backoff = backoff
+
+    def _create_request(self):
+        return PooledDataCiteRequest(
+            base_url=self.api_url,
+            username=self.username,
+            password=self.password,
+            timeout=self.timeout,
+            retries=self.retries,
+            backoff=self.backoff,
+        )
+
+
+class PooledDataCiteMDSClient(_PooledClient, DataCiteMDSClient):
+    """
+    DataCite MDS client which reuses pooled connections.
+    """
+
+    def doi_list(self):
+        """
+        List every DOI registered to the account. The list is downloaded bit by bit as
+        it is read, so it never has to be held in memory.
+
+        :returns: a generator of DOI strings
+        """
+        r = self._create_request().request('doi', stream=True)
+        with r:
+            if r.status_code == 204:
+                return
+            if r.status_code != 200:
+                raise DataCiteError.factory(r.status_code, r.text)
+            r.encoding = r.encoding or 'utf-8'
+            for line in r.iter_lines(decode_unicode=True):
+                line = line.strip()
+                if line:
+                    yield line
+
+
+class PooledDataCiteRESTClient(_PooledClient, DataCiteRESTClient):
+    """
+    DataCite REST API client which reuses pooled connections.
+    """
+
+    headers = {'content-type': 'application/vnd.api+json'}
+    page_size = 1000
+
+    @staticmethod
+    def _error(r):
+        # the REST API responds with a 422 if the request is well formed but the
+        # metadata isn't valid, which is our fault rather than DataCite's
+        status = 400 if r.status_code == 422 else r.status_code
+        return DataCiteError.factory(status, r.text)
+
+    def put_doi(self, doi, data):
+        """
+        Create or update a DOI.
+
+        :param doi: the DOI
+        :param data: the JSON:API resource object, i.e. a dict with an attributes key
+        :returns: the DOI's attributes, as DataCite has them after the update
+        """
+        r = self._create_request().put(
+            f'dois/{doi}', body=json.dumps({'data': data}), headers=self.headers
+        )
+        # DataCite responds with a 201 if the DOI didn't exist before
+        if r.status_code not in (200, 201):
+            raise self._error(r)
+        return r.json()['data']['attributes']
+
+    def doi_list(self, prefix):
+        """
+        List every registered or findable DOI with the given prefix. The list is
+        downloaded a page at a time as it is read.
+
+        :param prefix: the DOI prefix
+        :returns: a generator of DOI strings
+        """
+        params = {'prefix': prefix, 'page[size]': self.page_size, 'page[cursor]': 1}
+        while True:
+            r = self._create_request().get('dois', params=params, headers=self.headers)
+            if r.status_code != 200:
+                raise self._error(r)
+            body = r.json()
+            for item in body.get('data', []):
+                # drafts haven't been minted
+                if item['attributes'].get('state') != 'draft':
+                    yield item['attributes'].get('doi') or item['id']
+            next_page = (body.get('links') or {}).get('next')
+            if not next_page:
+                return
+            cursor = parse_qs(urlparse(next_page).query).get('page[cursor]')
+            if not cursor:
+                return
+            params['page[cursor]'] = cursor[0]
@@ -5,25 +5,115 @@
 # Created by the Natural History Museum in London, UK
 
 import logging
+import threading
 
-from ckan.lib.helpers import lang as ckan_lang
 from ckan.model import Package
-from ckan.plugins import PluginImplementations, toolkit
+from ckan.plugins import toolkit
 
-from ckanext.doi.interfaces import IDoi
 from ckanext.doi.lib import xml_utils
+from ckanext.doi.lib.cache import MISSING, TTLCache
+from ckanext.doi.lib.dispatch import get_plugin_chain
 from ckanext.doi.lib.errors import DOIMetadataException
-from ckanext.doi.lib.helpers import date_or_none, get_site_url, package_get_year
+from ckanext.doi.lib.helpers import (
+    date_or_none,
+    doi_context_ttl,
+    get_site_url,
+    package_get_year,
+)
 
 log = logging.getLogger(__name__)
 
+_context_cache = None
+_context_lock = threading.Lock()
 
-def build_metadata_dict(pkg_dict):
+
+class MetadataContext:
+    """
+    The site-wide values used when building metadata for any package, worked out once
+    so that building each package's metadata only needs dictionary lookups.
+    """
+
+    __slots__ = ('publisher', 'site_url', 'language', 'licenses', 'license_error')
+
+    def __init__(self, publisher, site_url, language, licenses, license_error=None):
+        """
+        :param publisher: the name of the publisher
+        :param site_url: the site URL, without a trailing slash
+        :param language: the two letter language code
+        :param licenses: a dict of license ids and (url, id) tuples
+        :param license_error: the exception raised while loading the licenses, if any
+        """
+        self.publisher = publisher
+        self.site_url = site_url
+        self.language = language
+        self.licenses = licenses
+        self.license_error = license_error
+
+    @classmethod
+    def from_config(cls):
+        """
+        Work out the values from the config and CKAN's license register (which may
+        have to be downloaded).
+
+        :returns: a MetadataContext
+        """
+        licenses = {}
+        license_error = None
+        try:
+            for license_id, license in Package.get_license_register().items():
+                licenses[license_id] = (license.url, license.id)
+        except Exception as e:
+            license_error = e
+        # the site's default language rather than the current request's, so that the
+        # metadata is the same whoever saves the package
+        language = toolkit.config.get('ckan.locale_default') or 'en'
+        return cls(
+            publisher=toolkit.config.get('ckanext.doi.publisher'),
+            site_url=get_site_url(),
+            # remove any localisation of the language, e.g. en from en_GB
+            language=language[:2],
+            licenses=licenses,
+            license_error=license_error,
+        )
+
+
+def get_metadata_context():
+    """
+    Get the MetadataContext shared by this process. It is worked out again once it is
+    older than the ckanext.doi.context_ttl config option.
+
+    :returns: a MetadataContext
+    """
+    global _context_cache
+    if _context_cache is None:
+        with _context_lock:
+            if _context_cache is None:
+                _context_cache = TTLCache(1, doi_context_ttl())
+    context = _context_cache.get(None)
+    if context is MISSING:
+        context = MetadataContext.from_config()
+        _context_cache.set(None, context)
+    return context
+
+
+def clear_metadata_context():
+    """
+    Discard the shared MetadataContext, e.g. after the config or licenses have changed.
+    """
+    global _context_cache
+    with _context_lock:
+        _context_cache = None
+
+
+def build_metadata_dict(pkg_dict, context=None):
     """
     Build/extract a basic dict of metadata that can then be passed to build_xml_dict.
 
     :param pkg_dict: dict of package details
+    :param context: the MetadataContext to use; defaults to the shared one
     """
+    if context is None:
+        context = get_metadata_context()
     metadata_dict = {}
 
     # collect errors instead of throwing them immediately; some data may not be correctly handled
@@ -52,7 +142,7 @@ def build_metadata_dict(pkg_dict):
     _add_required('titles', lambda: [{'title': pkg_dict.get('title')}])
 
     # PUBLISHER
-    _add_required('publisher', lambda: toolkit.config.get('ckanext.doi.publisher'))
+    _add_required('publisher', lambda: context.publisher)
 
     # PUBLICATION YEAR
     _add_required('publicationYear', lambda: package_get_year(pkg_dict))
@@ -140,17 +230,12 @@ def build_metadata_dict(pkg_dict):
 
     # LANGUAGE
     # use language set in CKAN
-    try:
-        # remove any localisation of the language, e.g. en from en_GB.
-        # default to english in case nothing is set, because it's ckan's default
-        optional['language'] = (ckan_lang() or 'en')[:2]
-    except Exception as e:
-        errors['language'] = e
+    optional['language'] = context.language
 
     # ALTERNATE IDENTIFIERS
     # add permalink back to this site
     try:
-        permalink = f'{get_site_url()}/dataset/{pkg_dict["id"]}'
+        permalink = f'{context.site_url}/dataset/{pkg_dict["id"]}'
         optional['alternateIdentifiers'] = [
             {'alternateIdentifierType': 'URL', 'alternateIdentifier': permalink}
         ]
@@ -174,7 +259,7 @@ def build_metadata_dict(pkg_dict):
     # FORMATS
     # list unique formats from package resources
     try:
-        formats = list(
+        formats = sorted(
             set(
                 filter(
                     None, [r.get('format') for r in pkg_dict.get('resources', []) or []]
@@ -192,16 +277,14 @@ def build_metadata_dict(pkg_dict):
     # RIGHTS
     # use the package license and get details from CKAN's license register
     license_id = pkg_dict.get('license_id', 'notspecified')
-    try:
-        if license_id != 'notspecified' and license_id is not None:
-            license_register = Package.get_license_register()
-            license = license_register.get(license_id)
-            if license is not None:
-                optional['rightsList'] = [
-                    {'rightsURI': license.url, 'rightsIdentifier': license.id}
-                ]
-    except Exception as e:
-        errors['rightsList'] = e
+    if license_id != 'notspecified' and license_id is not None:
+        if context.license_error is not None:
+            errors['rightsList'] = context.license_error
+        elif license_id in context.licenses:
+            url, identifier = context.licenses[license_id]
+            optional['rightsList'] = [
+                {'rightsURI': url, 'rightsIdentifier': identifier}
+            ]
 
     # DESCRIPTIONS
     # use package notes
@@ -218,12 +301,9 @@ def build_metadata_dict(pkg_dict):
     metadata_dict.update(required)
     metadata_dict.update(optional)
 
-    for plugin in PluginImplementations(IDoi):
-        # implementations should remove relevant errors from the errors dict if they successfully
-        # handle an item
-        metadata_dict, errors = plugin.build_metadata_dict(
-            pkg_dict, metadata_dict, errors
-        )
+    metadata_dict, errors = get_plugin_chain().build_metadata_dict(
+        pkg_dict, metadata_dict, errors
+    )
 
     for k in required:
         if metadata_dict.get(k) is None and errors.get(k) is None:
@@ -320,7 +400,4 @@ def build_xml_dict(metadata_dict):
         else:
             xml_dict[k] = v
 
-    for plugin in PluginImplementations(IDoi):
-        xml_dict = plugin.build_xml_dict(metadata_dict, xml_dict)
-
-    return xml_dict
+    return get_plugin_chain().build_xml_dict(metadata_dict, xml_dict)
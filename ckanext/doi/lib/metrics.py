@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+Timings and counts for each stage of publishing DOIs, sent to the sinks listed in the
+ckanext.doi.metrics option. When no sinks are configured, timed() hands back a shared
+object that does nothing, so the instrumentation costs next to nothing.
+
+Usage:
+
+    with timed('datacite.metadata_post') as timer:
+        ...
+        timer.tag(result='created')
+
+Every timing is tagged with its operation and a result, which is "ok" (or "error" if
+an exception was raised) unless the code being timed sets another.
+"""
+
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+
+from ckanext.doi.lib.helpers import (
+    doi_metrics_flush_interval,
+    doi_metrics_prefix,
+    doi_metrics_sinks,
+    doi_prometheus_path,
+    doi_statsd_address,
+)
+
+log = logging.getLogger(__name__)
+
+# None until the sinks have been set up from the config
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+class LogSink:
+    """
+    Writes each timing and count as a line of key=value pairs to the
+    ckanext.doi.metrics logger.
+    """
+
+    def __init__(self):
+        """
+        Use the ckanext.doi.metrics logger.
+        """
+        self.log = logging.getLogger('ckanext.doi.metrics')
+
+    @staticmethod
+    def _pairs(tags):
+        return ' '.join(f'{k}={v}' for k, v in sorted(tags.items()))
+
+    def timing(self, operation, seconds, tags):
+        """
+        Record how long an operation took.
+
+        :param operation: the name of the operation
+        :param seconds: the duration
+        :param tags: dict of tags, including the result
+        """
+        self.log.info(
+            f'metric=timing operation={operation} duration_ms={seconds * 1000:.3f} '
+            f'{self._pairs(tags)}'
+        )
+
+    def count(self, operation, tags):
+        """
+        Record that an operation happened.
+
+        :param operation: the name of the operation
+        :param tags: dict of tags, including the result
+        """
+        self.log.info(f'metric=count operation={operation} {self._pairs(tags)}')
+
+    def flush(self):
+        """
+        Write out anything that has been buffered.
+        """
+        pass
+
+
+class StatsdSink:
+    """
+    Sends metrics to a statsd server over UDP, with the tags in the DogStatsD format
+    (which Telegraf and the Datadog agent understand).
+    """
+
+    def __init__(self, address, prefix):
+        """
+        :param address: (host, port) of the statsd server
+        :param prefix: prefix for the metric names
+        """
+        self.address = address
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except OSError as e:
+            # metrics must never break publishing
+            log.debug(f'Could not send metric to statsd: {e}')
+
+    @staticmethod
+    def _tags(operation, tags):
+        pairs = [f'operation:{operation}']
+        pairs.extend(f'{k}:{v}' for k, v in sorted(tags.items()))
+        return ','.join(pairs)
+
+    def timing(self, operation, seconds, tags):
+        """
+        Record how long an operation took.
+
+        :param operation: the name of the operation
+        :param seconds: the duration
+        :param tags: dict of tags, including the result
+        """
+        self._send(
+            f'{self.prefix}.duration:{seconds * 1000:.3f}|ms|#'
+            f'{self._tags(operation, tags)}'
+        )
+
+    def count(self, operation, tags):
+        """
+        Record that an operation happened.
+
+        :param operation: the name of the operation
+        :param tags: dict of tags, including the result
+        """
+        self._send(f'{self.prefix}.total:1|c|#{self._tags(operation, tags)}')
+
+    def flush(self):
+        """
+        Write out anything that has been buffered.
+        """
+        pass
+
+
+class PrometheusSink:
+    """
+    Aggregates metrics in memory and writes them to a file in the Prometheus text
+    format, for the node exporter's textfile collector. The file is rewritten at most
+    every flush_interval seconds, and when the process exits.
+
+    Durations are recorded as a histogram, so percentiles can be calculated. Every
+    series has a pid label, so that the files written by different processes don't
+    contain the same series (which the textfile collector rejects).
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, path, prefix, flush_interval, timer=time.monotonic):
+        """
+        :param path: path of the file to write; "{pid}" is replaced with the process id
+            so that each process can have its own file
+        :param prefix: prefix for the metric names
+        :param flush_interval: minimum number of seconds between writes
+        :param timer: function returning the current time in seconds
+        """
+        self.pid = os.getpid()
+        self.path = path.format(pid=self.pid)
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.timer = timer
+        self._durations = {}
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._last_flush = timer()
+
+    @staticmethod
+    def _key(operation, tags):
+        return (('operation', operation),) + tuple(sorted(tags.items()))
+
+    def timing(self, operation, seconds, tags):
+        """
+        Record how long an operation took.
+
+        :param operation: the name of the operation
+        :param seconds: the duration
+        :param tags: dict of tags, including the result
+        """
+        key = self._key(operation, tags)
+        with self._lock:
+            # one count per bucket, then the sum and the total count
+            values = self._durations.setdefault(key, [0] * (len(self.BUCKETS) + 2))
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    values[i] += 1
+            values[-2] += seconds
+            values[-1] += 1
+        self._maybe_flush()
+
+    def count(self, operation, tags):
+        """
+        Record that an operation happened.
+
+        :param operation: the name of the operation
+        :param tags: dict of tags, including the result
+        """
+        key = self._key(operation, tags)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self.timer() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def _labels(self, key, extra=None):
+        pairs = list(key) + [('pid', self.pid)] + ([extra] if extra else [])
+        escaped = (
+            (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for k, v in pairs
+        )
+        return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+    def render(self):
+        """
+        Get the metrics in the Prometheus text format.
+
+        :returns: str
+        """
+        duration = f'{self.prefix}_duration_seconds'
+        total = f'{self.prefix}_total'
+        with self._lock:
+            durations = {k: list(v) for k, v in self._durations.items()}
+            counts = dict(self._counts)
+        lines = []
+        if durations:
+            lines.append(f'# HELP {duration} Time taken by each DOI operation.')
+            lines.append(f'# TYPE {duration} histogram')
+            for key, values in sorted(durations.items()):
+                for bound, bucket_count in zip(self.BUCKETS, values):
+                    lines.append(
+                        f'{duration}_bucket{self._labels(key, ("le", bound))} '
+                        f'{bucket_count}'
+                    )
+                lines.append(
+                    f'{duration}_bucket{self._labels(key, ("le", "+Inf"))} {values[-1]}'
+                )
+                lines.append(f'{duration}_sum{self._labels(key)} {values[-2]}')
+                lines.append(f'{duration}_count{self._labels(key)} {values[-1]}')
+        if counts:
+            lines.append(f'# HELP {total} Number of DOI operations by result.')
+            lines.append(f'# TYPE {total} counter')
+            for key, value in sorted(counts.items()):
+                lines.append(f'{total}{self._labels(key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """
+        Write the metrics file.
+        """
+        self._last_flush = self.timer()
+        tmp_path = f'{self.path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(self.render())
+            # the collector must never see a half-written file
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f'Could not write metrics to {self.path}: {e}')
+
+
+def _create_sinks():
+    sinks = []
+    for name in doi_metrics_sinks():
+        if name == 'log':
+            sinks.append(LogSink())
+        elif name == 'statsd':
+            sinks.append(StatsdSink(doi_statsd_address(), doi_metrics_prefix()))
+        elif name == 'prometheus':
+            sinks.append(
+                PrometheusSink(
+                    doi_prometheus_path(),
+                    doi_metrics_prefix(),
+                    doi_metrics_flush_interval(),
+                )
+            )
+    return sinks
+
+
+def get_sinks():
+    """
+    Get the configured sinks, creating them on first use.
+
+    :returns: a list of sinks; empty if metrics are disabled
+    """
+    global _sinks
+    if _sinks is None:
+        with _sinks_lock:
+            if _sinks is None:
+                _sinks = _create_sinks()
+    return _sinks
+
+
+def set_sinks(sinks):
+    """
+    Replace the sinks, flushing the current ones first. Mostly useful for testing.
+
+    :param sinks: a list of sinks, or None to create them from the config again on
+        next use
+    """
+    global _sinks
+    flush()
+    with _sinks_lock:
+        _sinks = sinks
+
+
+def reset_metrics():
+    """
+    Flush and discard the current sinks, e.g. after the config has changed.
+    """
+    set_sinks(None)
+
+
+def flush():
+    """
+    Make sure everything recorded so far has been written out.
+    """
+    for sink in _sinks or []:
+        sink.flush()
+
+
+atexit.register(flush)
+
+
+class _Timer:
+    __slots__ = ('operation', 'sinks', 'tags', 'start')
+
+    def __init__(self, operation, sinks, tags):
+        self.operation = operation
+        self.sinks = sinks
+        self.tags = tags
+
+    def tag(self, **tags):
+        """
+        Add or replace tags, e.g. to set the result.
+        """
+        self.tags.update(tags)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.tags['result'] = 'error'
+        for sink in self.sinks:
+            sink.timing(self.operation, seconds, self.tags)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def tag(self, **tags):
+        """
+        Does nothing.
+        """
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(operation, **tags):
+    """
+    Time the code in a with block.
+
+    :param operation: the name of the operation being timed
+    :param tags: extra tags
+    :returns: a context manager, with a tag method for adding tags (including the
+        result) from inside the block
+    """
+    sinks = get_sinks()
+    if not sinks:
+        return _NULL_TIMER
+    return _Timer(operation, sinks, {'result': 'ok', **tags})
+
+
+def count(operation, result, **tags):
+    """
+    Count an outcome of an operation.
+
+    :param operation: the name of the operation
+    :param result: the outcome
+    :param tags: extra tags
+    """
+    sinks = get_sinks()
+    if sinks:
+        tags['result'] = result
+        for sink in sinks:
+            sink.count(operation, tags)
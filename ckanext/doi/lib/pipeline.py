@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import logging
+import threading
+from contextlib import contextmanager
+from queue import Queue
+
+from ckan.model import Session
+
+log = logging.getLogger(__name__)
+
+# marks the end of the items going through a queue
+_END = object()
+
+
+class Task:
+    """
+    An item moving through a pipeline. Stages add whatever they need to the task as
+    attributes and call finish() if no further stages should process it.
+    """
+
+    def __init__(self, item):
+        """
+        :param item: the item being processed
+        """
+        self.item = item
+        self.status = None
+        self.message = None
+        self.error = None
+
+    @property
+    def finished(self):
+        """
+        Whether the task has been given a status.
+        """
+        return self.status is not None
+
+    def finish(self, status, message=None, error=None):
+        """
+        Mark the task as finished; it will be passed straight through any remaining
+        stages.
+
+        :param status: the outcome
+        :param message: optional description of the outcome
+        :param error: the exception, if the task failed
+        """
+        self.status = status
+        self.message = message
+        self.error = error
+
+
+def _app_context_factory():
+    """
+    Get a function which creates a context like the one we're currently running in, so
+    that worker threads can use the same flask app (CKAN's actions and helpers need
+    one).
+
+    :returns: a function returning a context manager
+    """
+    try:
+        import flask
+
+        if flask.has_app_context():
+            app = flask.current_app._get_current_object()
+            return app.test_request_context
+    except ImportError:
+        pass
+
+    @contextmanager
+    def _no_context():
+        yield
+
+    return _no_context
+
+
+def run_pipeline(items, stages, on_result, failed_status, queue_size=100):
+    """
+    Pass items through a series of stages, each running in its own pool of threads and
+    connected by bounded queues, so that (for example) slow network calls in one stage
+    overlap with work in the others. Results will not necessarily come out in the same
+    order they went in.
+
+    Each stage is a function which takes a Task and either updates it for the next
+    stage or calls its finish() method. Exceptions raised by a stage finish the task
+    with the failed_status. Once a task has made it through all the stages (or has been
+    finished), it is passed to on_result. on_result is only ever called from one
+    thread at a time.
+
+    :param items: an iterable of items to process; these are wrapped in Tasks
+    :param stages: a list of (function, number of threads) tuples
+    :param on_result: function called with each Task once it is done
+    :param failed_status: the status to give tasks that raise an exception
+    :param queue_size: maximum number of tasks waiting between each stage
+    """
+    queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    make_context = _app_context_factory()
+    threads = []
+
+    def _stage_worker(func, inbox, outbox, remaining, lock):
+        with make_context():
+            try:
+                while True:
+                    task = inbox.get()
+                    if task is _END:
+                        # let the other workers in this stage see the end too, then tell
+                        # the next stage once the last one has stopped
+                        inbox.put(_END)
+                        with lock:
+                            remaining[0] -= 1
+                            last = remaining[0] == 0
+                        if last:
+                            outbox.put(_END)
+                        return
+                    if not task.finished:
+                        try:
+                            func(task)
+                        except Exception as e:
+                            log.debug(f'Pipeline task failed: {e}', exc_info=True)
+                            task.finish(failed_status, str(e), e)
+                    outbox.put(task)
+            finally:
+                # each thread gets its own database session
+                Session.remove()
+
+    for i, (func, thread_count) in enumerate(stages):
+        remaining = [thread_count]
+        lock = threading.Lock()
+        for _ in range(thread_count):
+            thread = threading.Thread(
+                target=_stage_worker,
+                args=(func, queues[i], queues[i + 1], remaining, lock),
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+
+    def _collect():
+        while True:
+            task = queues[-1].get()
+            if task is _END:
+                return
+            try:
+                on_result(task)
+            except Exception as e:
+                log.error(f'Error handling pipeline result: {e}', exc_info=True)
+
+    collector = threading.Thread(target=_collect, daemon=True)
+    collector.start()
+
+    try:
+        for item in items:
+            queues[0].put(Task(item))
+    finally:
+        queues[0].put(_END)
+        for thread in threads:
+            thread.join()
+        collector.join()
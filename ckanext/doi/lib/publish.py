@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import logging
+
+from ckan.plugins import toolkit
+
+from ckanext.doi.lib.api import get_client
+from ckanext.doi.lib.coalesce import SyncLock, claim_pending
+from ckanext.doi.lib.helpers import (
+    doi_coalesce_window,
+    doi_job_queue,
+    doi_validation_mode,
+)
+from ckanext.doi.lib.metadata import build_metadata_dict, build_xml_dict
+from ckanext.doi.lib.metrics import count, timed
+from ckanext.doi.lib.relevance import input_snapshot
+from ckanext.doi.model.crud import DOIQuery
+
+log = logging.getLogger(__name__)
+
+# possible outcomes of a publish attempt
+CREATED = 'created'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def is_publishable(pkg_dict):
+    """
+    Check whether a package should have its DOI registered with DataCite, i.e. it is
+    active and public.
+
+    :param pkg_dict: the package dict
+    :returns: True if the DOI should be published, False if not
+    """
+    return pkg_dict.get('state', 'active') == 'active' and not pkg_dict.get(
+        'private', False
+    )
+
+
+def publish_package(package_id, context=None):
+    """
+    Load the given package and make sure DataCite has an up-to-date copy of its
+    metadata, minting the DOI if it has not been published yet.
+
+    :param package_id: the id of the package
+    :param context: the action context to load the package with; if not provided the
+        package is loaded ignoring auth
+    :returns: a tuple of the DOI record (or None if skipped) and one of CREATED,
+        UPDATED, UNCHANGED or SKIPPED
+    """
+    if context is None:
+        context = {'ignore_auth': True}
+    # remove user-defined update schemas first (if needed)
+    context.pop('schema', None)
+
+    # Load the package_show version of the dict
+    with timed('package_show'):
+        pkg_dict = toolkit.get_action('package_show')(context, {'id': package_id})
+
+    # the package may have been made private or deleted since this was requested
+    if not is_publishable(pkg_dict):
+        return None, SKIPPED
+
+    # Load or create the local DOI (package may not have a DOI if extension was loaded
+    # after package creation)
+    doi = DOIQuery.read_package(package_id, create_if_none=True)
+
+    with timed('build_metadata_dict'):
+        metadata_dict = build_metadata_dict(pkg_dict)
+    with timed('build_xml_dict'):
+        xml_dict = build_xml_dict(metadata_dict)
+
+    client = get_client()
+    validate = doi_validation_mode() != 'cli'
+
+    if doi.published is None:
+        client.publish_doi(doi.identifier, package_id, xml_dict, validate=validate)
+        status = CREATED
+    elif not client.check_for_update(doi.identifier, xml_dict):
+        # Not the same, so we want to update the metadata
+        client.set_metadata(doi.identifier, xml_dict, validate=validate)
+        status = UPDATED
+    else:
+        status = UNCHANGED
+
+    # remember what the metadata was built from so that later updates which don't
+    # change any of it can be skipped
+    snapshot = input_snapshot(pkg_dict)
+    if snapshot is not None and doi.input_hash != snapshot:
+        DOIQuery.update_doi(doi.identifier, input_hash=snapshot)
+    return doi, status
+
+
+def publish_package_job(package_id):
+    """
+    Background job version of publish_package. Runs on a CKAN worker.
+
+    :param package_id: the id of the package
+    """
+    if doi_coalesce_window() > 0:
+        # wait for any other sync of this package to finish and for the window since
+        # it to pass; updates made while we wait are picked up by this job
+        try:
+            with SyncLock(package_id, doi_coalesce_window()):
+                _publish_job(package_id)
+        except TimeoutError as e:
+            # try again later rather than losing the update
+            log.warning(f'{e}; queueing another DOI sync for package {package_id}')
+            enqueue_publish(package_id)
+    else:
+        _publish_job(package_id)
+
+
+def _publish_job(package_id):
+    with timed('publish_job') as timer:
+        doi, status = publish_package(package_id)
+        timer.tag(result=status)
+    log.info(f'DOI sync for package {package_id} finished: {status}')
+
+
+def enqueue_publish(package_id):
+    """
+    Add a job to the queue to sync the DOI for the given package with DataCite.
+
+    :param package_id: the id of the package
+    :returns: the enqueued job, or None if a job for the package was already queued
+    """
+    if doi_coalesce_window() > 0 and not claim_pending(package_id):
+        # the queued job loads the package when it runs so will include this update
+        count('enqueue_publish', 'coalesced')
+        return None
+    return toolkit.enqueue_job(
+        publish_package_job,
+        [package_id],
+        title=f'Sync DOI for package {package_id}',
+        queue=doi_job_queue(),
+    )
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import heapq
+import logging
+import tempfile
+from collections import Counter
+from datetime import datetime as dt
+
+from ckanext.doi.lib.api import get_client
+from ckanext.doi.lib.metrics import count
+from ckanext.doi.lib.publish import CREATED, publish_package
+from ckanext.doi.model.crud import DOIQuery
+
+log = logging.getLogger(__name__)
+
+# the kinds of disagreement between the doi table and datacite
+NOT_IN_DATABASE = 'not_in_database'
+NOT_PUBLISHED = 'not_published'
+NOT_MINTED = 'not_minted'
+WRONG_URL = 'wrong_url'
+# everything matches
+OK = 'ok'
+
+
+class Discrepancy:
+    """
+    A DOI which the doi table and datacite disagree about.
+    """
+
+    __slots__ = ('category', 'identifier', 'package_id', 'detail', 'fixed')
+
+    def __init__(self, category, identifier, package_id=None, detail=None):
+        """
+        :param category: one of NOT_IN_DATABASE, NOT_PUBLISHED, NOT_MINTED or WRONG_URL
+        :param identifier: the DOI
+        :param package_id: the id of the package the doi table has for the DOI, if any
+        :param detail: more information, e.g. the URL datacite has
+        """
+        self.category = category
+        self.identifier = identifier
+        self.package_id = package_id
+        self.detail = detail
+        self.fixed = False
+
+
+def external_sort(lines, chunk_size=100000):
+    """
+    Sort strings without holding them all in memory: they are sorted in chunks which
+    are written to temporary files, then merged.
+
+    :param lines: an iterable of strings, which mustn't contain newlines
+    :param chunk_size: the most strings to hold in memory at once
+    :returns: a generator of the sorted strings
+    """
+    runs = []
+    chunk = []
+    try:
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                runs.append(_write_run(chunk))
+                chunk = []
+        if not runs:
+            # it all fits in memory
+            yield from sorted(chunk)
+            return
+        if chunk:
+            runs.append(_write_run(chunk))
+        yield from heapq.merge(*((line[:-1] for line in run) for run in runs))
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _write_run(chunk):
+    run = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+    run.writelines(f'{line}\n' for line in sorted(chunk))
+    run.seek(0)
+    return run
+
+
+class Reconciler:
+    """
+    Compares the doi table with the list of DOIs minted on datacite.
+
+    It finds:
+
+    - DOIs minted on datacite which aren't in the doi table (NOT_IN_DATABASE)
+    - DOIs minted on datacite which the doi table says aren't published (NOT_PUBLISHED)
+    - DOIs the doi table says are published which aren't minted on datacite
+      (NOT_MINTED)
+    - optionally, DOIs which don't point at their package's page (WRONG_URL); this
+      needs a request per DOI
+
+    Datacite's list is downloaded in one streamed request and the doi table is read in
+    batches. As neither comes in an order that can be relied on to match the other,
+    both are sorted using temporary files and then merged, so memory use doesn't grow
+    with the number of DOIs. DOIs are compared ignoring case.
+    """
+
+    def __init__(
+        self,
+        check_urls=False,
+        fix=False,
+        on_result=None,
+        batch_size=1000,
+        chunk_size=100000,
+    ):
+        """
+        :param check_urls: check the URL of every published DOI
+        :param fix: fix the problems that can be fixed: set the published date of
+            NOT_PUBLISHED DOIs, publish NOT_MINTED DOIs and update WRONG_URL ones.
+            NOT_IN_DATABASE DOIs can't be fixed as we don't know which package they
+            belong to
+        :param on_result: optional function called with each Discrepancy found (after
+            any fix has been attempted)
+        :param batch_size: number of records to read from the doi table at once
+        :param chunk_size: the most DOIs to sort in memory at once
+        """
+        self.check_urls = check_urls
+        self.fix = fix
+        self.on_result = on_result
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.client = get_client()
+        self.counts = Counter()
+
+    def _remote_keys(self):
+        for identifier in self.client.list_dois():
+            yield identifier.lower()
+
+    def _local_lines(self):
+        records = DOIQuery.stream(batch_size=self.batch_size, prefix=self.client.prefix)
+        for record in records:
+            key = record.identifier.lower()
+            published = 'y' if record.published is not None else ''
+            # the tab sorts before anything that can be in a DOI, so lines are sorted
+            # by their key
+            yield f'{key}\t{record.identifier}\t{record.package_id}\t{published}'
+
+    def run(self):
+        """
+        Compare the doi table with datacite.
+
+        :returns: a Counter of the number of DOIs in each category (including OK)
+        """
+        remote = external_sort(self._remote_keys(), self.chunk_size)
+        local = external_sort(self._local_lines(), self.chunk_size)
+
+        remote_key = next(remote, None)
+        local_line = next(local, None)
+        while remote_key is not None or local_line is not None:
+            local_key = local_line.split('\t', 1)[0] if local_line is not None else None
+            if local_key is None or (remote_key is not None and remote_key < local_key):
+                self._handle(Discrepancy(NOT_IN_DATABASE, remote_key))
+                remote_key = _next_different(remote, remote_key)
+                continue
+
+            _, identifier, package_id, published = local_line.split('\t')
+            if remote_key is None or local_key < remote_key:
+                # not minted, which is only a problem if it's meant to be published
+                if published:
+                    self._handle(Discrepancy(NOT_MINTED, identifier, package_id))
+            elif not published:
+                self._handle(Discrepancy(NOT_PUBLISHED, identifier, package_id))
+            elif self.check_urls:
+                self._check_url(identifier, package_id)
+            else:
+                self._handle(None)
+
+            if remote_key == local_key:
+                remote_key = _next_different(remote, remote_key)
+            local_line = next(local, None)
+
+        return self.counts
+
+    def _check_url(self, identifier, package_id):
+        url = self.client.get_url(identifier)
+        if url is None:
+            self._handle(Discrepancy(NOT_MINTED, identifier, package_id))
+        elif url != self.client.permalink(package_id):
+            self._handle(Discrepancy(WRONG_URL, identifier, package_id, detail=url))
+        else:
+            self._handle(None)
+
+    def _handle(self, discrepancy):
+        if discrepancy is None:
+            self.counts[OK] += 1
+            return
+        if self.fix:
+            try:
+                self._fix(discrepancy)
+            except Exception as e:
+                log.warning(f'Could not fix {discrepancy.identifier}: {e}')
+                discrepancy.detail = str(e)
+        self.counts[discrepancy.category] += 1
+        count('reconcile', discrepancy.category, fixed=discrepancy.fixed)
+        if self.on_result is not None:
+            self.on_result(discrepancy)
+
+    def _fix(self, discrepancy):
+        identifier = discrepancy.identifier
+        if discrepancy.category == NOT_PUBLISHED:
+            DOIQuery.update_doi(identifier, published=dt.now())
+            discrepancy.fixed = True
+        elif discrepancy.category == NOT_MINTED:
+            published = DOIQuery.read_doi(identifier).published
+            # mark it unpublished so that it is minted again
+            DOIQuery.update_doi(identifier, published=None)
+            status = None
+            try:
+                _, status = publish_package(discrepancy.package_id)
+            finally:
+                if status != CREATED:
+                    # it wasn't minted, so put the record back as it was
+                    DOIQuery.update_doi(identifier, published=published)
+            discrepancy.fixed = status == CREATED
+            if not discrepancy.fixed:
+                discrepancy.detail = f'the package could not be published ({status})'
+        elif discrepancy.category == WRONG_URL:
+            self.client.set_url(identifier, discrepancy.package_id)
+            discrepancy.fixed = True
+
+
+def _next_different(keys, key):
+    """
+    Skip past any repeats of the given key.
+    """
+    next_key = next(keys, None)
+    while next_key is not None and next_key == key:
+        next_key = next(keys, None)
+    return next_key
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+import json
+
+from ckanext.doi.lib.dispatch import get_plugin_chain
+from ckanext.doi.lib.helpers import doi_skip_irrelevant, doi_verify_remote
+from ckanext.doi.lib.metadata import get_metadata_context
+from ckanext.doi.lib.metrics import count
+from ckanext.doi.model.crud import DOIQuery
+
+# the package fields the metadata is built from which can be changed by editing the
+# package (the id and created date can't be, and the DOI details come from the doi
+# table); tags and resources are handled separately
+PACKAGE_FIELDS = (
+    'type',
+    'title',
+    'author',
+    'maintainer',
+    'notes',
+    'license_id',
+    'version',
+)
+
+
+def _tags(pkg_dict):
+    names = {t.strip() for t in (pkg_dict.get('tag_string') or '').split(',')}
+    for tag in pkg_dict.get('tags') or []:
+        names.add(tag['name'] if isinstance(tag, dict) else tag)
+    names.discard('')
+    return sorted(names)
+
+
+def _resources(pkg_dict):
+    resources = pkg_dict.get('resources')
+    if resources is None:
+        # not the same as having no resources
+        return None
+    return [[str(r.get('size') or 0), r.get('format') or ''] for r in resources]
+
+
+def input_snapshot(pkg_dict):
+    """
+    Get a hash of everything in the package dict the DOI metadata is built from, along
+    with the site-wide values it uses (see metadata.MetadataContext). If two packages
+    have the same snapshot, they have the same metadata.
+
+    :param pkg_dict: the package dict
+    :returns: str hash, or None if it can't be worked out because an IDoi plugin hasn't
+        declared which fields it reads
+    """
+    plugin_fields = get_plugin_chain().package_fields
+    if plugin_fields is None:
+        return None
+    context = get_metadata_context()
+    snapshot = {
+        'fields': {k: pkg_dict.get(k) for k in PACKAGE_FIELDS},
+        'tags': _tags(pkg_dict),
+        'resources': _resources(pkg_dict),
+        'plugins': {k: pkg_dict.get(k) for k in plugin_fields},
+        'context': [
+            context.publisher,
+            context.site_url,
+            context.language,
+            context.licenses.get(pkg_dict.get('license_id')),
+        ],
+    }
+    text = json.dumps(snapshot, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def is_relevant_update(pkg_dict):
+    """
+    Check whether an update to a package could change its DOI metadata, by comparing
+    its snapshot with the one stored when its metadata was last posted to DataCite.
+    Updates that only change other things (e.g. resource views, or extras used by
+    other extensions) don't need to be synced.
+
+    :param pkg_dict: the updated package dict
+    :returns: False if the package's DOI is published and the metadata can't have
+        changed, otherwise True
+    """
+    # if we're always meant to check the copy on datacite, we have to do it every time
+    if not doi_skip_irrelevant() or doi_verify_remote():
+        return True
+    snapshot = input_snapshot(pkg_dict)
+    if snapshot is None:
+        return True
+    record = DOIQuery.read_package(pkg_dict['id'])
+    relevant = (
+        record is None or record.published is None or record.input_hash != snapshot
+    )
+    count('update_gate', 'relevant' if relevant else 'skipped')
+    return relevant
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import logging
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+
+from ckanext.doi.lib.api import get_client
+from ckanext.doi.lib.helpers import doi_job_queue, doi_reservation_size
+from ckanext.doi.model.crud import ReservationQuery
+
+log = logging.getLogger(__name__)
+
+# set while a refill job is queued or running, so that only one is queued at a time
+REFILL_KEY = 'ckanext-doi:refill'
+# a queued refill job that never runs (e.g. its worker was killed) stops further jobs
+# being queued for at most this many seconds
+REFILL_TTL = 600
+
+
+def new_doi():
+    """
+    Get a DOI for a new package. A DOI is taken from the reservation pool if there are
+    any there, otherwise one is generated (which means checking with DataCite).
+
+    :returns: the full, unique DOI
+    """
+    doi = ReservationQuery.claim()
+    if doi is not None:
+        return doi
+    if doi_reservation_size() > 0 and enqueue_refill() is not None:
+        log.info('The DOI reservation pool is empty; queued a refill')
+    return get_client().generate_doi()
+
+
+def refill_pool(size):
+    """
+    Add DOIs to the reservation pool until it contains the given number. Every DOI
+    added has been checked against the local database and DataCite.
+
+    :param size: the number of DOIs the pool should contain
+    :returns: the number of DOIs added
+    """
+    client = get_client()
+    needed = size - ReservationQuery.count()
+    added = 0
+    # allow for some failures (e.g. if datacite is having problems) but don't loop
+    # forever
+    attempts_left = needed * 2
+
+    while needed > 0 and attempts_left > 0:
+        candidates = {client.random_doi() for _ in range(needed)}
+        attempts_left -= len(candidates)
+        candidates -= ReservationQuery.in_use(candidates)
+        unused = [doi for doi in candidates if client.is_unused(doi)]
+        added += ReservationQuery.add(unused)
+        needed -= len(unused)
+
+    if needed > 0:
+        log.warning(f'Could only reserve {added} DOIs; {needed} still needed')
+    return added
+
+
+def refill_pool_job(size=None):
+    """
+    Background job version of refill_pool.
+
+    :param size: the number of DOIs the pool should contain; defaults to the
+        ckanext.doi.reservations.size config option
+    """
+    if size is None:
+        size = doi_reservation_size()
+    try:
+        added = refill_pool(size)
+    finally:
+        # the pool can be refilled again once it's empty
+        connect_to_redis().delete(REFILL_KEY)
+    log.info(f'Added {added} DOIs to the reservation pool')
+
+
+def enqueue_refill():
+    """
+    Add a job to the queue to refill the reservation pool, unless one is already
+    queued or running.
+
+    :returns: the enqueued job, or None if one was already queued
+    """
+    if not connect_to_redis().set(REFILL_KEY, 1, nx=True, ex=REFILL_TTL):
+        return None
+    return toolkit.enqueue_job(
+        refill_pool_job,
+        title='Refill DOI reservation pool',
+        queue=doi_job_queue(),
+    )
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+Retries and a circuit breaker for requests to DataCite.
+
+Requests that fail in a way that might not happen again (a 5xx or 429 response, or a
+failure to connect) are retried after an exponentially increasing, randomised delay.
+Every process has one circuit breaker shared by all its requests: once enough requests
+in a row have failed it opens, and requests are refused straight away (with a
+DataCiteUnavailableError) until it has been open for a while, when a single request is
+let through to see if DataCite has recovered.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from ckanext.doi.lib.helpers import doi_breaker_reset_timeout, doi_breaker_threshold
+from ckanext.doi.lib.metrics import count
+
+log = logging.getLogger(__name__)
+
+# responses that are worth trying again
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def backoff_delay(attempt, backoff, max_backoff, retry_after=None, rand=random.random):
+    """
+    Work out how long to wait before retrying a request. The delay is picked at random
+    between 0 and an exponentially increasing limit ("full jitter"), so that clients
+    which failed at the same time don't all retry at the same time.
+
+    :param attempt: the number of the retry, starting from 0
+    :param backoff: the limit for the first retry, in seconds
+    :param max_backoff: the most the limit can grow to, in seconds
+    :param retry_after: the value of the Retry-After header, if there was one; if it
+        is a number of seconds it is used instead (up to max_backoff)
+    :param rand: function returning a random float between 0 and 1
+    :returns: the delay in seconds
+    """
+    if retry_after is not None:
+        try:
+            return min(max(float(retry_after), 0), max_backoff)
+        except ValueError:
+            # an HTTP date, which isn't worth parsing
+            pass
+    return rand() * min(max_backoff, backoff * 2**attempt)
+
+
+class CircuitBreaker:
+    """
+    Keeps track of whether DataCite is working. Thread safe.
+    """
+
+    def __init__(self, threshold, reset_timeout, timer=time.monotonic):
+        """
+        :param threshold: number of failures in a row before the breaker opens; 0 means
+            it never opens
+        :param reset_timeout: seconds to stay open before letting a request through to
+            check whether DataCite has recovered
+        :param timer: function returning the current time in seconds
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        """
+        Whether a request would be allowed now, without claiming the trial request
+        when half-open.
+
+        :returns: bool
+        """
+        with self._lock:
+            if self.state == OPEN:
+                return self.retry_in() == 0
+            return self.state == CLOSED
+
+    def retry_in(self):
+        """
+        Get the number of seconds until a request will next be let through.
+
+        :returns: float; 0 if requests are being let through
+        """
+        if self.state != OPEN:
+            return 0
+        return max(0, self._opened_at + self.reset_timeout - self.timer())
+
+    def allow(self):
+        """
+        Check whether a request may be made. If the breaker has been open for long
+        enough, this request becomes the trial one and other requests are refused until
+        it has finished.
+
+        :returns: bool
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and self.retry_in() == 0:
+                self.state = HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        """
+        Record that a request worked.
+        """
+        with self._lock:
+            if self.state != CLOSED:
+                log.info('DataCite is responding again; closing the circuit breaker')
+            self.state = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        """
+        Record that a request failed.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED
+                and self.threshold
+                and self.failures >= self.threshold
+            ):
+                if self.state == CLOSED:
+                    log.warning(
+                        f'{self.failures} requests to DataCite failed in a row; not '
+                        f'sending any more for {self.reset_timeout} seconds'
+                    )
+                self.state = OPEN
+                self._opened_at = self.timer()
+                count('datacite.breaker', OPEN)
+
+
+def get_breaker():
+    """
+    Get the circuit breaker shared by this process, creating it on first use.
+
+    :returns: a CircuitBreaker
+    """
+    global _breaker
+    if _breaker is None:
+        with _breaker_lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    doi_breaker_threshold(), doi_breaker_reset_timeout()
+                )
+    return _breaker
+
+
+def reset_breaker():
+    """
+    Discard the shared circuit breaker, e.g. after the config has changed.
+    """
+    global _breaker
+    with _breaker_lock:
+        _breaker = None
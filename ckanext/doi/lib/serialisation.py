@@ -0,0 +1,686 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+Conversion between xml_dicts (as produced by build_xml_dict) and DataCite 4.x XML.
+
+to_xml produces exactly the same document as datacite's schema42.tostring, but builds
+it directly rather than through an lxml tree. from_xml parses DataCite XML into a
+"normalised" dict: the xml_dict structure, but only containing the values that actually
+appear in the XML (empty values, and keys schema42 doesn't serialise, are left out).
+normalise converts an xml_dict into the same form without any XML in between, so the
+metadata posted to DataCite can be compared with newly generated metadata using ==.
+
+Internally both directions go through a simple tree of nodes, each a tuple of
+(tag, [(attribute name, value), ...], text, [child nodes]).
+"""
+
+import re
+from io import BytesIO
+from xml.etree.ElementTree import iterparse
+
+NAMESPACE = 'http://datacite.org/schema/kernel-4'
+XML_LANG = 'xml:lang'
+_ET_XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+_HEADER = (
+    "<?xml version='1.0' encoding='utf-8'?>\n"
+    f'<resource xmlns="{NAMESPACE}" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:schemaLocation="http://datacite.org/schema/kernel-4 '
+    'http://schema.datacite.org/meta/kernel-4.2/metadata.xsd"'
+)
+
+_INVALID_CHARACTERS = re.compile(
+    '[^\u0009\u000a\u000d\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]'
+)
+_TEXT_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '\r': '&#13;'})
+_ATTR_ESCAPES = str.maketrans(
+    {
+        '&': '&amp;',
+        '<': '&lt;',
+        '>': '&gt;',
+        '"': '&quot;',
+        '\n': '&#10;',
+        '\r': '&#13;',
+        '\t': '&#9;',
+    }
+)
+
+
+# building nodes from an xml_dict; these mirror the rules in datacite.schema42
+
+
+def _check(value, allow_none=False):
+    if value is None and allow_none:
+        return None
+    if not isinstance(value, str):
+        raise TypeError(f'bad argument type: {type(value).__name__}({value!r})')
+    if _INVALID_CHARACTERS.search(value):
+        raise ValueError(
+            'All strings must be XML compatible: Unicode or ASCII, no NULL bytes or '
+            'control characters'
+        )
+    return value
+
+
+def _node(tag, text=None, attrs=None, children=None):
+    return tag, attrs or [], text, children or []
+
+
+def _attr(attrs, name, value):
+    """
+    Set an attribute, replacing any existing one with the same name.
+    """
+    value = _check(value)
+    for i, (existing, _) in enumerate(attrs):
+        if existing == name:
+            attrs[i] = (name, value)
+            return
+    attrs.append((name, value))
+
+
+def _optional_attrs(attrs, value, *names):
+    """
+    Set attributes from a dict if they are present and not empty.
+    """
+    for name in names:
+        if value.get(name):
+            _attr(attrs, name, value[name])
+
+
+def _lang(attrs, value):
+    if value.get('lang'):
+        _attr(attrs, XML_LANG, value['lang'])
+
+
+def _identifiers(values):
+    doi = None
+    alternates = []
+    for value in values:
+        if value['identifierType'] == 'DOI':
+            if doi is not None:
+                # Don't know what to do with two DOIs
+                raise TypeError
+            doi = _node(
+                'identifier',
+                _check(value['identifier']),
+                [('identifierType', 'DOI')],
+            )
+        else:
+            alternates.append(
+                _node(
+                    'alternateIdentifier',
+                    _check(value['identifier']),
+                    [('alternateIdentifierType', _check(value['identifierType']))],
+                )
+            )
+    nodes = []
+    if doi is not None:
+        nodes.append(doi)
+    if alternates:
+        nodes.append(_node('alternateIdentifiers', children=alternates))
+    return nodes
+
+
+def _person(tag, name_tag, value, type_attr=None):
+    name_attrs = []
+    _optional_attrs(name_attrs, value, 'nameType')
+    _lang(name_attrs, value)
+    children = [_node(name_tag, _check(value['name']), name_attrs)]
+    attrs = []
+    if type_attr:
+        _optional_attrs(attrs, value, type_attr)
+    if value.get('givenName'):
+        children.append(_node('givenName', _check(value['givenName'])))
+    if value.get('familyName'):
+        children.append(_node('familyName', _check(value['familyName'])))
+    for identifier in value.get('nameIdentifiers', []):
+        if identifier.get('nameIdentifier'):
+            id_attrs = [
+                ('nameIdentifierScheme', _check(identifier['nameIdentifierScheme']))
+            ]
+            _optional_attrs(id_attrs, identifier, 'schemeURI')
+            children.append(
+                _node('nameIdentifier', _check(identifier['nameIdentifier']), id_attrs)
+            )
+    for affiliation in value.get('affiliations', []):
+        children.append(_node('affiliation', _check(affiliation['affiliation'])))
+    return _node(tag, attrs=attrs, children=children)
+
+
+def _creators(values):
+    return [
+        _node(
+            'creators', children=[_person('creator', 'creatorName', v) for v in values]
+        )
+    ]
+
+
+def _contributors(values):
+    return [
+        _node(
+            'contributors',
+            children=[
+                _person('contributor', 'contributorName', v, 'contributorType')
+                for v in values
+            ],
+        )
+    ]
+
+
+def _titles(values):
+    children = []
+    for value in values:
+        attrs = []
+        _lang(attrs, value)
+        # 'type' was a mistake in the 4.0 serializer and is still supported
+        if value.get('type'):
+            _attr(attrs, 'titleType', value['type'])
+        if value.get('titleType'):
+            _attr(attrs, 'titleType', value['titleType'])
+        children.append(_node('title', _check(value['title'], allow_none=True), attrs))
+    return [_node('titles', children=children)]
+
+
+def _text_element(tag, convert=None):
+    def build(value):
+        if convert is not None:
+            value = convert(value)
+        return [_node(tag, _check(value))]
+
+    return build
+
+
+def _subjects(values):
+    children = []
+    for value in values:
+        attrs = []
+        _lang(attrs, value)
+        _optional_attrs(attrs, value, 'subjectScheme', 'schemeURI', 'valueURI')
+        children.append(_node('subject', _check(value['subject']), attrs))
+    return [_node('subjects', children=children)]
+
+
+def _dates(values):
+    children = []
+    for value in values:
+        attrs = [('dateType', _check(value['dateType']))]
+        _optional_attrs(attrs, value, 'dateInformation')
+        children.append(_node('date', _check(value['date']), attrs))
+    return [_node('dates', children=children)]
+
+
+def _types(value):
+    return [
+        _node(
+            'resourceType',
+            _check(value['resourceType'], allow_none=True),
+            [('resourceTypeGeneral', _check(value['resourceTypeGeneral']))],
+        )
+    ]
+
+
+def _related_identifiers(values):
+    children = []
+    for value in values:
+        attrs = [
+            ('relatedIdentifierType', _check(value['relatedIdentifierType'])),
+            ('relationType', _check(value['relationType'])),
+        ]
+        _optional_attrs(
+            attrs,
+            value,
+            'relatedMetadataScheme',
+            'schemeURI',
+            'schemeType',
+            'resourceTypeGeneral',
+        )
+        children.append(
+            _node(
+                'relatedIdentifier',
+                _check(value['relatedIdentifier'], allow_none=True),
+                attrs,
+            )
+        )
+    return [_node('relatedIdentifiers', children=children)]
+
+
+def _text_list(plural, singular):
+    def build(values):
+        children = [_node(singular, _check(v, allow_none=True)) for v in values]
+        return [_node(plural, children=children)]
+
+    return build
+
+
+def _rights(values):
+    children = []
+    for value in values:
+        text = _check(value['rights']) if 'rights' in value else None
+        attrs = []
+        _optional_attrs(
+            attrs,
+            value,
+            'rightsURI',
+            'rightsIdentifierScheme',
+            'rightsIdentifier',
+            'schemeURI',
+        )
+        _lang(attrs, value)
+        children.append(_node('rights', text, attrs))
+    return [_node('rightsList', children=children)]
+
+
+def _descriptions(values):
+    children = []
+    for value in values:
+        attrs = [('descriptionType', _check(value['descriptionType']))]
+        _lang(attrs, value)
+        children.append(_node('description', _check(value['description']), attrs))
+    return [_node('descriptions', children=children)]
+
+
+def _point(tag, value):
+    return _node(
+        tag,
+        children=[
+            _node('pointLongitude', str(value['pointLongitude'])),
+            _node('pointLatitude', str(value['pointLatitude'])),
+        ],
+    )
+
+
+def _geolocations(values):
+    children = []
+    for value in values:
+        location = []
+        if value.get('geoLocationPlace'):
+            location.append(
+                _node('geoLocationPlace', _check(value['geoLocationPlace']))
+            )
+        if value.get('geoLocationPoint'):
+            location.append(_point('geoLocationPoint', value['geoLocationPoint']))
+        box = value.get('geoLocationBox')
+        if box:
+            location.append(
+                _node(
+                    'geoLocationBox',
+                    children=[
+                        _node(k, str(box[k]))
+                        for k in (
+                            'westBoundLongitude',
+                            'eastBoundLongitude',
+                            'southBoundLatitude',
+                            'northBoundLatitude',
+                        )
+                    ],
+                )
+            )
+        for polygon in value.get('geoLocationPolygons', []):
+            points = [_point('polygonPoint', p) for p in polygon['polygonPoints']]
+            if polygon.get('inPolygonPoint'):
+                points.append(_point('inPolygonPoint', polygon['inPolygonPoint']))
+            location.append(_node('geoLocationPolygon', children=points))
+        children.append(_node('geoLocation', children=location))
+    return [_node('geoLocations', children=children)]
+
+
+def _funding_references(values):
+    children = []
+    for value in values:
+        reference = [_node('funderName', _check(value.get('funderName')))]
+        if value.get('funderIdentifier'):
+            attrs = []
+            if value.get('funderIdentifierType'):
+                _attr(attrs, 'funderIdentifierType', value['funderIdentifierType'])
+            reference.append(
+                _node('funderIdentifier', _check(value['funderIdentifier']), attrs)
+            )
+        if value.get('awardNumber'):
+            attrs = []
+            if value.get('awardURI'):
+                _attr(attrs, 'awardURI', value['awardURI'])
+            reference.append(_node('awardNumber', _check(value['awardNumber']), attrs))
+        if value.get('awardTitle'):
+            reference.append(_node('awardTitle', _check(value['awardTitle'])))
+        children.append(_node('fundingReference', children=reference))
+    return [_node('fundingReferences', children=children)]
+
+
+# the xml_dict keys that are serialised, in the order they appear in the XML, and the
+# functions that turn their values into nodes; keys which aren't here are ignored
+_BUILDERS = [
+    ('identifiers', _identifiers),
+    ('creators', _creators),
+    ('titles', _titles),
+    ('publisher', _text_element('publisher')),
+    ('publicationYear', _text_element('publicationYear', str)),
+    ('subjects', _subjects),
+    ('contributors', _contributors),
+    ('dates', _dates),
+    ('language', _text_element('language')),
+    ('types', _types),
+    ('relatedIdentifiers', _related_identifiers),
+    ('sizes', _text_list('sizes', 'size')),
+    ('formats', _text_list('formats', 'format')),
+    ('version', _text_element('version')),
+    ('rightsList', _rights),
+    ('descriptions', _descriptions),
+    ('geoLocations', _geolocations),
+    ('fundingReferences', _funding_references),
+]
+# schema42 serialises these even if they are empty
+_ALWAYS_BUILT = {'identifiers', 'types'}
+
+
+def _build(xml_dict):
+    nodes = []
+    for key, builder in _BUILDERS:
+        if key not in xml_dict:
+            continue
+        value = xml_dict[key]
+        if not value and key not in _ALWAYS_BUILT:
+            continue
+        nodes.extend(builder(value))
+    return nodes
+
+
+# writing nodes as XML
+
+
+def _write(node, depth, out):
+    tag, attrs, text, children = node
+    indent = '  ' * depth
+    attr_str = ''.join(
+        f' {name}="{value.translate(_ATTR_ESCAPES)}"' for name, value in attrs
+    )
+    if children:
+        out.append(f'{indent}<{tag}{attr_str}>\n')
+        for child in children:
+            _write(child, depth + 1, out)
+        out.append(f'{indent}</{tag}>\n')
+    elif text is None:
+        out.append(f'{indent}<{tag}{attr_str}/>\n')
+    else:
+        out.append(
+            f'{indent}<{tag}{attr_str}>{text.translate(_TEXT_ESCAPES)}</{tag}>\n'
+        )
+
+
+def to_xml(xml_dict):
+    """
+    Serialise an xml_dict as DataCite 4.2 XML. The output is identical to
+    datacite.schema42.tostring's, encoded as UTF-8.
+
+    :param xml_dict: the xml_dict, usually with the DOI added
+    :returns: the XML document as bytes
+    """
+    nodes = _build(xml_dict)
+    if not nodes:
+        return f'{_HEADER}/>\n'.encode('utf-8')
+    out = [_HEADER, '>\n']
+    for node in nodes:
+        _write(node, 1, out)
+    out.append('</resource>\n')
+    return ''.join(out).encode('utf-8')
+
+
+# reading nodes into normalised dicts; used for both built and parsed nodes
+
+
+def _compact(d):
+    """
+    Remove empty values from a dict.
+    """
+    return {k: v for k, v in d.items() if v not in (None, '', [], {})}
+
+
+def _attrs_of(node):
+    return dict(node[1])
+
+
+def _children(node, tag=None):
+    return [c for c in node[3] if tag is None or c[0] == tag]
+
+
+def _child_text(node, tag):
+    for child in node[3]:
+        if child[0] == tag:
+            return child[2]
+    return None
+
+
+def _read_person(node, name_tag, type_attr=None):
+    attrs = _attrs_of(node)
+    person = {}
+    if type_attr:
+        person[type_attr] = attrs.get(type_attr)
+    for child in node[3]:
+        tag, child_attrs, text = child[0], _attrs_of(child), child[2]
+        if tag == name_tag:
+            person['name'] = text
+            person['nameType'] = child_attrs.get('nameType')
+            person['lang'] = child_attrs.get(XML_LANG)
+        elif tag in ('givenName', 'familyName'):
+            person[tag] = text
+        elif tag == 'nameIdentifier':
+            person.setdefault('nameIdentifiers', []).append(
+                _compact(
+                    {
+                        'nameIdentifier': text,
+                        'nameIdentifierScheme': child_attrs.get('nameIdentifierScheme'),
+                        'schemeURI': child_attrs.get('schemeURI'),
+                    }
+                )
+            )
+        elif tag == 'affiliation':
+            person.setdefault('affiliations', []).append(
+                _compact({'affiliation': text})
+            )
+    return _compact(person)
+
+
+def _read_text_and_attrs(node, text_key, *names, lang=False):
+    attrs = _attrs_of(node)
+    item = {text_key: node[2]}
+    for name in names:
+        item[name] = attrs.get(name)
+    if lang:
+        item['lang'] = attrs.get(XML_LANG)
+    return _compact(item)
+
+
+def _read_point(node):
+    return _compact(
+        {
+            'pointLongitude': _child_text(node, 'pointLongitude'),
+            'pointLatitude': _child_text(node, 'pointLatitude'),
+        }
+    )
+
+
+def _read_geolocation(node):
+    location = {'geoLocationPlace': _child_text(node, 'geoLocationPlace')}
+    for child in node[3]:
+        if child[0] == 'geoLocationPoint':
+            location['geoLocationPoint'] = _read_point(child)
+        elif child[0] == 'geoLocationBox':
+            location['geoLocationBox'] = _compact({c[0]: c[2] for c in child[3]})
+        elif child[0] == 'geoLocationPolygon':
+            polygon = {
+                'polygonPoints': [
+                    _read_point(p) for p in _children(child, 'polygonPoint')
+                ]
+            }
+            for p in _children(child, 'inPolygonPoint'):
+                polygon['inPolygonPoint'] = _read_point(p)
+            location.setdefault('geoLocationPolygons', []).append(_compact(polygon))
+    return _compact(location)
+
+
+def _read_funding_reference(node):
+    reference = {}
+    for child in node[3]:
+        reference[child[0]] = child[2]
+        attrs = _attrs_of(child)
+        if child[0] == 'funderIdentifier':
+            reference['funderIdentifierType'] = attrs.get('funderIdentifierType')
+        elif child[0] == 'awardNumber':
+            reference['awardURI'] = attrs.get('awardURI')
+    return _compact(reference)
+
+
+def _read_generic(node):
+    return _compact(
+        {
+            'text': node[2],
+            'attributes': _attrs_of(node),
+            'children': [_read_generic(c) for c in node[3]],
+            'tag': node[0],
+        }
+    )
+
+
+def _read_nodes(nodes):
+    result = {}
+    for node in nodes:
+        tag = node[0]
+        if tag == 'identifier':
+            result.setdefault('identifiers', []).append(
+                _compact({'identifierType': 'DOI', 'identifier': node[2]})
+            )
+        elif tag == 'alternateIdentifiers':
+            result.setdefault('identifiers', []).extend(
+                _compact(
+                    {
+                        'identifierType': _attrs_of(c).get('alternateIdentifierType'),
+                        'identifier': c[2],
+                    }
+                )
+                for c in node[3]
+            )
+        elif tag == 'creators':
+            result[tag] = [_read_person(c, 'creatorName') for c in node[3]]
+        elif tag == 'contributors':
+            result[tag] = [
+                _read_person(c, 'contributorName', 'contributorType') for c in node[3]
+            ]
+        elif tag == 'titles':
+            result[tag] = [
+                _read_text_and_attrs(c, 'title', 'titleType', lang=True)
+                for c in node[3]
+            ]
+        elif tag in ('publisher', 'publicationYear', 'language', 'version'):
+            result[tag] = node[2]
+        elif tag == 'subjects':
+            result[tag] = [
+                _read_text_and_attrs(
+                    c, 'subject', 'subjectScheme', 'schemeURI', 'valueURI', lang=True
+                )
+                for c in node[3]
+            ]
+        elif tag == 'dates':
+            result[tag] = [
+                _read_text_and_attrs(c, 'date', 'dateType', 'dateInformation')
+                for c in node[3]
+            ]
+        elif tag == 'resourceType':
+            result['types'] = _read_text_and_attrs(
+                node, 'resourceType', 'resourceTypeGeneral'
+            )
+        elif tag == 'relatedIdentifiers':
+            result[tag] = [
+                _read_text_and_attrs(
+                    c,
+                    'relatedIdentifier',
+                    'relatedIdentifierType',
+                    'relationType',
+                    'relatedMetadataScheme',
+                    'schemeURI',
+                    'schemeType',
+                    'resourceTypeGeneral',
+                )
+                for c in node[3]
+            ]
+        elif tag in ('sizes', 'formats'):
+            result[tag] = [c[2] or '' for c in node[3]]
+        elif tag == 'rightsList':
+            result[tag] = [
+                _read_text_and_attrs(
+                    c,
+                    'rights',
+                    'rightsURI',
+                    'rightsIdentifierScheme',
+                    'rightsIdentifier',
+                    'schemeURI',
+                    lang=True,
+                )
+                for c in node[3]
+            ]
+        elif tag == 'descriptions':
+            result[tag] = [
+                _read_text_and_attrs(c, 'description', 'descriptionType', lang=True)
+                for c in node[3]
+            ]
+        elif tag == 'geoLocations':
+            result[tag] = [_read_geolocation(c) for c in node[3]]
+        elif tag == 'fundingReferences':
+            result[tag] = [_read_funding_reference(c) for c in node[3]]
+        else:
+            # something this module doesn't produce; keep it so it counts as a change
+            result.setdefault('other', []).append(_read_generic(node))
+    return _compact(result)
+
+
+def normalise(xml_dict):
+    """
+    Convert an xml_dict into the form from_xml would return for it once serialised,
+    without actually creating any XML.
+
+    :param xml_dict: the xml_dict
+    :returns: a dict
+    """
+    return _read_nodes(_build(xml_dict))
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def from_xml(xml):
+    """
+    Parse DataCite 4.x XML into a normalised dict. Each top level element is
+    discarded once it has been read, so memory use doesn't grow with the size of the
+    document.
+
+    :param xml: the XML document, as a str or bytes
+    :returns: a dict
+    """
+    if isinstance(xml, str):
+        xml = xml.encode('utf-8')
+    # each entry is the list of child nodes being collected for an open element
+    stack = []
+    nodes = []
+    for event, elem in iterparse(BytesIO(xml), events=('start', 'end')):
+        if event == 'start':
+            stack.append([])
+            continue
+        children = stack.pop()
+        if not stack:
+            # the end of the root element, whose children are the nodes we want
+            nodes = children
+            break
+        attrs = [
+            (XML_LANG if name == _ET_XML_LANG else _local_name(name), value)
+            for name, value in elem.attrib.items()
+        ]
+        text = elem.text if not children else None
+        stack[-1].append((_local_name(elem.tag), attrs, text, children))
+        if len(stack) == 1:
+            # a top level element; we've got everything we need from it
+            elem.clear()
+    return _read_nodes(nodes)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from datacite import schema42
+
+from ckanext.doi.lib.cache import TTLCache
+from ckanext.doi.lib.compare import exact_fingerprint
+from ckanext.doi.lib.errors import DOIValidationError
+
+# fingerprints of metadata that has already passed validation; these never expire as
+# the result can't change
+_valid = TTLCache(10000, float('inf'))
+
+
+def validate_xml_dict(xml_dict):
+    """
+    Check an xml_dict against the DataCite schema. Metadata identical to metadata that
+    has already passed is not checked again.
+
+    :param xml_dict: the xml_dict, with the DOI added
+    :raises DOIValidationError: with all the errors found, if it is not valid
+    """
+    fingerprint = exact_fingerprint(xml_dict)
+    if _valid.get(fingerprint) is True:
+        return
+    errors = sorted(
+        schema42.validator.iter_errors(xml_dict),
+        key=lambda e: [str(p) for p in e.absolute_path],
+    )
+    if errors:
+        raise DOIValidationError(errors)
+    _valid.set(fingerprint, True)
+
+
+def clear_validation_cache():
+    """
+    Forget which metadata has passed validation.
+    """
+    _valid.clear()
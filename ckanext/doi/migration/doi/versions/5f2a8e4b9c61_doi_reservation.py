@@ -0,0 +1,28 @@
+"""
+Add DOI reservation pool.
+
+Revision ID: 5f2a8e4b9c61
+Revises: c3e9d1a0f7b2
+Create Date: 2026-10-18 11:03:17.204815
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5f2a8e4b9c61'
+down_revision = 'c3e9d1a0f7b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'doi_reservation',
+        sa.Column('identifier', sa.UnicodeText, primary_key=True),
+        sa.Column('created', sa.DateTime, nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table('doi_reservation')
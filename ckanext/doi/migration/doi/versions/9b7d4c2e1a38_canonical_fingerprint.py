@@ -0,0 +1,26 @@
+"""
+Discard metadata fingerprints made before values were sorted.
+
+Revision ID: 9b7d4c2e1a38
+Revises: 5f2a8e4b9c61
+Create Date: 2026-10-18 14:03:27.118406
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9b7d4c2e1a38'
+down_revision = '5f2a8e4b9c61'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the fingerprint is now calculated from the canonical form of the metadata, so the
+    # old ones will never match; clearing them means the next check compares with the
+    # metadata on DataCite (and stores a new fingerprint) instead of reposting it
+    op.execute('UPDATE doi SET metadata_hash = NULL')
+
+
+def downgrade():
+    op.execute('UPDATE doi SET metadata_hash = NULL')
@@ -0,0 +1,25 @@
+"""
+Add input hash.
+
+Revision ID: a7d3f5c1e2b9
+Revises: e4b7a2d9c815
+Create Date: 2026-10-18 20:42:17.904316
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a7d3f5c1e2b9'
+down_revision = 'e4b7a2d9c815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # hash of the package fields the metadata last posted to DataCite was built from
+    op.add_column('doi', sa.Column('input_hash', sa.UnicodeText, nullable=True))
+
+
+def downgrade():
+    op.drop_column('doi', 'input_hash')
@@ -0,0 +1,28 @@
+"""
+Add metadata fingerprint.
+
+Revision ID: c3e9d1a0f7b2
+Revises: 86a245a136db
+Create Date: 2026-10-18 10:12:41.530218
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c3e9d1a0f7b2'
+down_revision = '86a245a136db'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # hash of the metadata last successfully posted to DataCite
+    op.add_column('doi', sa.Column('metadata_hash', sa.UnicodeText, nullable=True))
+    # when the metadata was last posted to DataCite
+    op.add_column('doi', sa.Column('synced', sa.DateTime, nullable=True))
+
+
+def downgrade():
+    op.drop_column('doi', 'synced')
+    op.drop_column('doi', 'metadata_hash')
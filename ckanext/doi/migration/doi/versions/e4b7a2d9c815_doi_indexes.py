@@ -0,0 +1,39 @@
+"""
+Add indexes for prefix, published and unpublished queries.
+
+Revision ID: e4b7a2d9c815
+Revises: 9b7d4c2e1a38
+Create Date: 2026-10-18 16:21:09.372514
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e4b7a2d9c815'
+down_revision = '9b7d4c2e1a38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the primary key index follows the database collation, which LIKE can't use
+    op.create_index(
+        'doi_identifier_pattern_idx',
+        'doi',
+        ['identifier'],
+        postgresql_ops={'identifier': 'text_pattern_ops'},
+    )
+    op.create_index('doi_published_idx', 'doi', ['published'])
+    op.create_index(
+        'doi_unpublished_idx',
+        'doi',
+        ['identifier'],
+        postgresql_where=sa.text('published IS NULL'),
+    )
+
+
+def downgrade():
+    op.drop_index('doi_unpublished_idx', table_name='doi')
+    op.drop_index('doi_published_idx', table_name='doi')
+    op.drop_index('doi_identifier_pattern_idx', table_name='doi')
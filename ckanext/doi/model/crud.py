@@ -4,15 +4,52 @@
 # This file is part of ckanext-doi
 # Created by the Natural History Museum in London, UK
 
+from collections import namedtuple
+
 from ckan.model import Session
+from sqlalchemy import inspect
+from sqlalchemy.dialects.postgresql import insert
 
+from ckanext.doi.lib.cache import MISSING, TTLCache
+from ckanext.doi.lib.helpers import doi_cache_size, doi_cache_ttl
 from ckanext.doi.model.doi import DOI, doi_table
+from ckanext.doi.model.reservation import DOIReservation
+
+# a detached copy of a DOI record, safe to keep between requests
+CachedDOI = namedtuple('CachedDOI', ['identifier', 'package_id', 'published'])
 
 
 class DOIQuery:
     # convenience properties
     m = DOI
     cols = [c.name for c in doi_table.c]
+    # package_id -> CachedDOI, for published DOIs only (see read_package_cached)
+    _cache = None
+
+    @classmethod
+    def cache(cls):
+        """
+        Get the cache used by read_package_cached, creating it if necessary.
+
+        :returns: a TTLCache
+        """
+        if cls._cache is None:
+            cls._cache = TTLCache(doi_cache_size(), doi_cache_ttl())
+        return cls._cache
+
+    @classmethod
+    def clear_cache(cls):
+        """
+        Discard the cache; a new one will be created from the current config when it is
+        next needed.
+        """
+        cls._cache = None
+
+    @classmethod
+    def _invalidate(cls, *package_ids):
+        if cls._cache is not None:
+            for package_id in package_ids:
+                cls._cache.invalidate(package_id)
 
     @classmethod
     def create(cls, identifier, package_id, published=None):
@@ -29,8 +66,122 @@ class DOIQuery:
         )
         Session.add(new_record)
         Session.commit()
+        cls._invalidate(package_id)
         return new_record
 
+    @classmethod
+    def bulk_create(cls, records):
+        """
+        Create many records with one statement and one commit. Records whose DOI is
+        already in the table are ignored.
+
+        :param records: a list of dicts, each with an identifier and package_id and
+            optionally the other columns
+        :returns: a set of the DOIs that were created
+        """
+        if not records:
+            return set()
+        values = [{c: record.get(c) for c in cls.cols} for record in records]
+        stmt = (
+            insert(doi_table)
+            .values(values)
+            .on_conflict_do_nothing()
+            .returning(doi_table.c.identifier)
+        )
+        created = {row[0] for row in Session.execute(stmt)}
+        Session.commit()
+        cls._invalidate(*(v['package_id'] for v in values))
+        return created
+
+    @classmethod
+    def bulk_update(cls, records):
+        """
+        Update many records with one statement and one commit (an "upsert": records
+        that don't exist yet are created). Only the columns given in the records are
+        updated and every record must have the same columns.
+
+        :param records: a list of dicts, each with an identifier and package_id plus
+            the columns to update
+        :returns: a set of the DOIs that were created or updated
+        """
+        if not records:
+            return set()
+        keys = set(records[0])
+        if any(set(record) != keys for record in records):
+            raise ValueError('All records must have the same keys')
+        if not {'identifier', 'package_id'} <= keys:
+            raise ValueError('Records must have an identifier and a package_id')
+        values = [{c: record[c] for c in cls.cols if c in keys} for record in records]
+        stmt = insert(doi_table).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[doi_table.c.identifier],
+            set_={
+                c: stmt.excluded[c] for c in cls.cols if c in keys and c != 'identifier'
+            },
+        ).returning(doi_table.c.identifier)
+        updated = {row[0] for row in Session.execute(stmt)}
+        Session.commit()
+        if cls._cache is not None:
+            # package_id may have changed so we can't tell which entries are affected
+            cls._cache.clear()
+        return updated
+
+    @classmethod
+    def _forget_loaded(cls, package_id, identifier):
+        """
+        Make the session reload its copy of a package's record, if it has loaded one,
+        after it has been changed by a statement that goes around the ORM. CKAN's
+        session doesn't expire objects on commit, so it would otherwise keep the old
+        values.
+
+        :param package_id: the id of the package
+        :param identifier: the DOI the package's record now has
+        """
+        for loaded in list(Session.identity_map.values()):
+            if not isinstance(loaded, DOI):
+                continue
+            state = inspect(loaded)
+            # use the loaded values so that expired objects aren't loaded to check them
+            if state.dict.get('package_id') != package_id:
+                continue
+            if state.identity == (identifier,):
+                Session.expire(loaded)
+            else:
+                # the record's DOI (its primary key) has changed, so this copy no
+                # longer matches a row
+                Session.expunge(loaded)
+
+    @classmethod
+    def record_mint(cls, identifier, package_id, published):
+        """
+        Record that a package's DOI has been minted, with one statement and one
+        commit: the package's record is created if it doesn't have one, otherwise its
+        DOI and published date are updated. This is safe if two processes mint the
+        same package's DOI at the same time.
+
+        :param identifier: the DOI that was minted
+        :param package_id: the id of the package the DOI is for
+        :param published: when the DOI was published
+        :returns: a CachedDOI of the record as it now is
+        """
+        stmt = insert(doi_table).values(
+            identifier=identifier, package_id=package_id, published=published
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[doi_table.c.package_id],
+            set_={
+                'identifier': stmt.excluded.identifier,
+                'published': stmt.excluded.published,
+            },
+        ).returning(
+            doi_table.c.identifier, doi_table.c.package_id, doi_table.c.published
+        )
+        row = Session.execute(stmt).first()
+        Session.commit()
+        cls._forget_loaded(package_id, identifier)
+        cls._invalidate(package_id)
+        return CachedDOI(*row)
+
     @classmethod
     def read_doi(cls, identifier):
         """
@@ -51,15 +202,140 @@ class DOIQuery:
             for the given package
         :returns: the record object
         """
-        from ckanext.doi.lib.api import DataciteClient
+        from ckanext.doi.lib.reservations import new_doi
 
         record = Session.query(DOI).filter(DOI.package_id == package_id).first()
         if record is None and create_if_none:
-            client = DataciteClient()
-            new_doi = client.generate_doi()
-            record = cls.create(new_doi, package_id)
+            record = cls.create(new_doi(), package_id)
         return record
 
+    @classmethod
+    def read_dois(cls, identifiers):
+        """
+        Retrieve the records with the given DOIs using one query.
+
+        :param identifiers: a collection of DOI strings
+        :returns: a dict of DOIs and record objects; DOIs without a record are left out
+        """
+        identifiers = list(identifiers)
+        if not identifiers:
+            return {}
+        records = Session.query(DOI).filter(DOI.identifier.in_(identifiers))
+        return {record.identifier: record for record in records}
+
+    @classmethod
+    def read_packages(cls, package_ids):
+        """
+        Retrieve the records associated with the given packages using one query.
+
+        :param package_ids: a collection of package ids
+        :returns: a dict of package ids and record objects; packages without a record
+            are left out
+        """
+        package_ids = list(package_ids)
+        if not package_ids:
+            return {}
+        records = Session.query(DOI).filter(DOI.package_id.in_(package_ids))
+        return {record.package_id: record for record in records}
+
+    @classmethod
+    def read_package_cached(cls, package_id):
+        """
+        Retrieve a copy of the record associated with a given package, using a short
+        lived in-process cache. This is intended for places where the record is read
+        often, like package_show; the cache is cleared when the record is changed
+        through this class, but only in this process.
+
+        Only published records are cached. Packages without a DOI or with one that
+        hasn't been published yet are the ones likely to be changed by another process
+        (e.g. a job worker minting the DOI), so they are always read from the database.
+
+        :param package_id: the id of the package
+        :returns: a CachedDOI, or None if the package doesn't have a DOI
+        """
+        cache = cls.cache()
+        cached = cache.get(package_id)
+        if cached is not MISSING:
+            return cached
+        record = cls.read_package(package_id)
+        if record is None:
+            return None
+        cached = CachedDOI(record.identifier, record.package_id, record.published)
+        if cached.published is not None:
+            cache.set(package_id, cached)
+        return cached
+
+    @classmethod
+    def with_prefix(cls, prefix):
+        """
+        Get a filter matching DOIs with the given prefix. The pattern is anchored to
+        the start of the DOI so that the identifier's text_pattern_ops index can be
+        used.
+
+        :param prefix: the DOI prefix, e.g. 10.1234
+        :returns: an SQLAlchemy filter expression
+        """
+        # backslash is postgres' default escape character
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return DOI.identifier.like(f'{escaped}/%')
+
+    @classmethod
+    def stream(
+        cls,
+        after=None,
+        identifiers=None,
+        batch_size=1000,
+        prefix=None,
+        published=None,
+        published_since=None,
+    ):
+        """
+        Iterate over records in order of their DOI, loading them in batches so that
+        only one batch is held in memory at a time. Batches are fetched using the last
+        DOI of the previous batch rather than an offset, so each one is a cheap index
+        lookup however far through the table we are.
+
+        :param after: only include records with DOIs after this one
+        :param identifiers: only include records with these DOIs
+        :param batch_size: the number of records to load at once
+        :param prefix: only include records with DOIs with this prefix
+        :param published: if True, only include published records; if False, only
+            unpublished ones
+        :param published_since: only include records published at or after this
+            datetime
+        :returns: a generator of record objects
+        """
+        filters = []
+        if prefix is not None:
+            filters.append(cls.with_prefix(prefix))
+        if published is True:
+            filters.append(DOI.published.isnot(None))
+        elif published is False:
+            filters.append(DOI.published.is_(None))
+        if published_since is not None:
+            filters.append(DOI.published >= published_since)
+
+        if identifiers is not None:
+            identifiers = sorted(i for i in identifiers if after is None or i > after)
+            for i in range(0, len(identifiers), batch_size):
+                chunk = identifiers[i : i + batch_size]
+                yield from (
+                    Session.query(DOI)
+                    .filter(DOI.identifier.in_(chunk), *filters)
+                    .order_by(DOI.identifier)
+                )
+            return
+
+        while True:
+            query = Session.query(DOI).filter(*filters)
+            if after is not None:
+                query = query.filter(DOI.identifier > after)
+            batch = query.order_by(DOI.identifier).limit(batch_size).all()
+            if not batch:
+                return
+            yield from batch
+            after = batch[-1].identifier
+
     @classmethod
     def update_doi(cls, identifier, **kwargs):
         """
@@ -72,7 +348,13 @@ class DOIQuery:
         update_dict = {k: v for k, v in kwargs.items() if k in cls.cols}
         Session.query(DOI).filter(DOI.identifier == identifier).update(update_dict)
         Session.commit()
-        return cls.read_doi(identifier)
+        record = cls.read_doi(identifier)
+        if 'package_id' in update_dict and cls._cache is not None:
+            # we don't know which package it used to belong to
+            cls._cache.clear()
+        elif record is not None:
+            cls._invalidate(record.package_id)
+        return record
 
     @classmethod
     def update_package(cls, package_id, **kwargs):
@@ -87,6 +369,7 @@ class DOIQuery:
         update_dict = {k: v for k, v in kwargs.items() if k in cls.cols}
         Session.query(DOI).filter(DOI.package_id == package_id).update(update_dict)
         Session.commit()
+        cls._invalidate(package_id, update_dict.get('package_id'))
         return cls.read_package(package_id)
 
     @classmethod
@@ -99,8 +382,10 @@ class DOIQuery:
         """
         to_delete = cls.read_doi(identifier)
         if to_delete is not None:
+            package_id = to_delete.package_id
             Session.delete(to_delete)
             Session.commit()
+            cls._invalidate(package_id)
             return True
         else:
             return False
@@ -115,8 +400,82 @@ class DOIQuery:
         """
         to_delete = cls.read_package(package_id)
         if to_delete is not None:
+            package_id = to_delete.package_id
             Session.delete(to_delete)
             Session.commit()
+            cls._invalidate(package_id)
             return True
         else:
             return False
+
+
+class ReservationQuery:
+    """
+    Queries for the pool of reserved DOIs.
+    """
+
+    # convenience properties
+    m = DOIReservation
+
+    @classmethod
+    def claim(cls):
+        """
+        Take the oldest DOI from the reservation pool. The row is locked while it is
+        removed and rows locked by other transactions are skipped, so concurrent claims
+        never get the same DOI.
+
+        :returns: the DOI string, or None if the pool is empty
+        """
+        record = (
+            Session.query(DOIReservation)
+            .order_by(DOIReservation.created)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if record is None:
+            # end the transaction we started
+            Session.commit()
+            return None
+        identifier = record.identifier
+        Session.delete(record)
+        Session.commit()
+        return identifier
+
+    @classmethod
+    def add(cls, identifiers):
+        """
+        Add DOIs to the reservation pool.
+
+        :param identifiers: an iterable of DOI strings
+        :returns: the number of DOIs added
+        """
+        records = [DOIReservation(identifier=i) for i in identifiers]
+        Session.add_all(records)
+        Session.commit()
+        return len(records)
+
+    @classmethod
+    def count(cls):
+        """
+        Count the DOIs in the reservation pool.
+
+        :returns: int
+        """
+        return Session.query(DOIReservation).count()
+
+    @classmethod
+    def in_use(cls, identifiers):
+        """
+        Find which of the given DOIs are already assigned to a package or reserved.
+
+        :param identifiers: a collection of DOI strings
+        :returns: a set of the DOI strings that are in use
+        """
+        identifiers = list(identifiers)
+        if not identifiers:
+            return set()
+        assigned = Session.query(DOI.identifier).filter(DOI.identifier.in_(identifiers))
+        reserved = Session.query(DOIReservation.identifier).filter(
+            DOIReservation.identifier.in_(identifiers)
+        )
+        return {row[0] for row in assigned.union(reserved)}
@@ -6,7 +6,7 @@
 
 from ckan.model import Package, meta
 from ckan.model.domain_object import DomainObject
-from sqlalchemy import Column, ForeignKey, Table, types
+from sqlalchemy import Column, ForeignKey, Index, Table, text, types
 from sqlalchemy.orm import backref, relation
 
 doi_table = Table(
@@ -22,6 +22,26 @@ doi_table = Table(
     ),
     # Date DOI was published to DataCite
     Column('published', types.DateTime, nullable=True),
+    # Hash of the metadata last posted to DataCite (see
+    # lib.compare.metadata_fingerprint)
+    Column('metadata_hash', types.UnicodeText, nullable=True),
+    # Date the metadata was last posted to DataCite
+    Column('synced', types.DateTime, nullable=True),
+    # Hash of the package fields the metadata was last built from (see lib.relevance)
+    Column('input_hash', types.UnicodeText, nullable=True),
+    # for prefix matching (identifier LIKE '10.1234/%') whatever the database collation
+    Index(
+        'doi_identifier_pattern_idx',
+        'identifier',
+        postgresql_ops={'identifier': 'text_pattern_ops'},
+    ),
+    Index('doi_published_idx', 'published'),
+    # DOIs that haven't been published yet, in order
+    Index(
+        'doi_unpublished_idx',
+        'identifier',
+        postgresql_where=text('published IS NULL'),
+    ),
 )
 
 
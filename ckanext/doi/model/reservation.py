@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from datetime import datetime
+
+from ckan.model import meta
+from ckan.model.domain_object import DomainObject
+from sqlalchemy import Column, Table, types
+
+doi_reservation_table = Table(
+    'doi_reservation',
+    meta.metadata,
+    # A DOI that has been checked and is not in use, either locally or on DataCite
+    Column('identifier', types.UnicodeText, primary_key=True),
+    # Date the DOI was reserved
+    Column('created', types.DateTime, nullable=False, default=datetime.now),
+)
+
+
+class DOIReservation(DomainObject):
+    """
+    Reserved (generated but not yet assigned) DOI Object.
+    """
+
+    pass
+
+
+meta.mapper(DOIReservation, doi_reservation_table)
@@ -10,14 +10,29 @@ from logging import getLogger
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
 
 from ckanext.doi import cli
-from ckanext.doi.lib.api import DataciteClient
+from ckanext.doi.lib.api import reset_client
+from ckanext.doi.lib.coalesce import SyncLock
+from ckanext.doi.lib.dispatch import reset_plugin_chain
+from ckanext.doi.lib.errors import DataCiteUnavailableError
 from ckanext.doi.lib.helpers import (
+    doi_coalesce_window,
+    doi_details,
+    doi_publish_async,
     doi_test_mode,
     get_site_title,
-    get_site_url,
     package_get_year,
 )
-from ckanext.doi.lib.metadata import build_metadata_dict, build_xml_dict
+from ckanext.doi.lib.metadata import clear_metadata_context
+from ckanext.doi.lib.metrics import reset_metrics, timed
+from ckanext.doi.lib.publish import (
+    CREATED,
+    UPDATED,
+    enqueue_publish,
+    is_publishable,
+    publish_package,
+)
+from ckanext.doi.lib.relevance import is_relevant_update
+from ckanext.doi.lib.resilience import get_breaker
 from ckanext.doi.model.crud import DOIQuery
 
 log = getLogger(__name__)
@@ -43,6 +58,13 @@ class DOIPlugin(SingletonPlugin, toolkit.DefaultDatasetForm):
         Adds templates.
         """
         toolkit.add_template_directory(config, 'theme/templates')
+        # the shared client, caches and metrics sinks are built from config values (and
+        # the plugin chain from the loaded plugins) so make sure fresh ones are used
+        reset_client()
+        reset_plugin_chain()
+        reset_metrics()
+        clear_metadata_context()
+        DOIQuery.clear_cache()
 
     ## IPackageController
     def after_dataset_create(self, context, pkg_dict):
@@ -62,57 +84,77 @@ class DOIPlugin(SingletonPlugin, toolkit.DefaultDatasetForm):
         Check status of the dataset to determine if we should publish DOI to datacite
         network.
         """
-        # Is this active and public? If so we need to make sure we have an active DOI
-        if pkg_dict.get('state', 'active') == 'active' and not pkg_dict.get(
-            'private', False
-        ):
+        # Is this active and public? If so we need to make sure we have an active DOI,
+        # unless nothing the DOI metadata is built from has changed
+        if is_publishable(pkg_dict) and is_relevant_update(pkg_dict):
             package_id = pkg_dict['id']
 
-            # remove user-defined update schemas first (if needed)
-            context.pop('schema', None)
-
-            # Load the package_show version of the dict
-            pkg_show_dict = toolkit.get_action('package_show')(
-                context, {'id': package_id}
-            )
-
-            # Load or create the local DOI (package may not have a DOI if extension was loaded
-            # after package creation)
-            doi = DOIQuery.read_package(package_id, create_if_none=True)
+            if doi_publish_async():
+                # hand the DataCite calls off to a worker so the request isn't held up
+                with timed('enqueue_publish'):
+                    enqueue_publish(package_id)
+            elif not get_breaker().available:
+                # DataCite isn't responding, so don't make the user wait to find out
+                self._defer_publish(package_id)
+            elif doi_coalesce_window() > 0:
+                lock = SyncLock(package_id, doi_coalesce_window())
+                if lock.acquire(blocking=False):
+                    synced = False
+                    try:
+                        synced = self._publish(package_id, context)
+                    finally:
+                        lock.release(synced=synced)
+                else:
+                    # the package was synced moments ago, or is being synced, so leave
+                    # this update to a job that waits for the window to pass
+                    with timed('enqueue_publish'):
+                        enqueue_publish(package_id)
+            else:
+                self._publish(package_id, context)
 
-            metadata_dict = build_metadata_dict(pkg_show_dict)
-            xml_dict = build_xml_dict(metadata_dict)
+        return pkg_dict
 
-            client = DataciteClient()
+    def _publish(self, package_id, context):
+        """
+        Sync the DOI with DataCite now, or defer it if DataCite is unavailable.
 
-            if doi.published is None:
-                # metadata gets created before minting
-                client.set_metadata(doi.identifier, xml_dict)
-                client.mint_doi(doi.identifier, package_id)
-                toolkit.h.flash_success('DataCite DOI created')
-            else:
-                same = client.check_for_update(doi.identifier, xml_dict)
-                if not same:
-                    # Not the same, so we want to update the metadata
-                    client.set_metadata(doi.identifier, xml_dict)
-                    toolkit.h.flash_success('DataCite DOI metadata updated')
+        :param package_id: the id of the package
+        :param context: the action context
+        :returns: True if the DOI was synced, False if it was deferred
+        """
+        try:
+            with timed('after_dataset_update') as timer:
+                doi, status = publish_package(package_id, context)
+                timer.tag(result=status)
+        except DataCiteUnavailableError:
+            self._defer_publish(package_id)
+            return False
+        if status == CREATED:
+            toolkit.h.flash_success('DataCite DOI created')
+        elif status == UPDATED:
+            toolkit.h.flash_success('DataCite DOI metadata updated')
+        return True
+
+    def _defer_publish(self, package_id):
+        """
+        Queue a job to sync the DOI later because DataCite is unavailable.
 
-        return pkg_dict
+        :param package_id: the id of the package
+        """
+        log.warning(f'DataCite is unavailable; deferring DOI sync for {package_id}')
+        enqueue_publish(package_id)
+        toolkit.h.flash_notice(
+            'DataCite is currently unavailable; the DOI will be updated shortly'
+        )
 
     # IPackageController
     def after_dataset_show(self, context, pkg_dict):
         """
         Add the DOI details to the pkg_dict so it can be displayed.
         """
-        doi = DOIQuery.read_package(pkg_dict['id'])
+        doi = DOIQuery.read_package_cached(pkg_dict['id'])
         if doi:
-            pkg_dict['doi'] = doi.identifier
-            pkg_dict['doi_status'] = True if doi.published else False
-            pkg_dict['domain'] = get_site_url().replace('http://', '')
-            pkg_dict['doi_date_published'] = (
-                datetime.strftime(doi.published, '%Y-%m-%d') if doi.published else None
-            )
-            pkg_dict['doi_publisher'] = toolkit.config.get('ckanext.doi.publisher')
+            pkg_dict.update(doi_details(doi.identifier, doi.published))
 
     def after_create(self, *args, **kwargs):
         """
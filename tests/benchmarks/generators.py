@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+Synthetic data for the benchmarks, based on the package dict in tests.helpers.constants.
+Everything is generated from a seeded random number generator so that runs are
+repeatable.
+"""
+
+import copy
+import random
+import uuid
+
+from tests.helpers import constants
+
+FORMATS = ['CSV', 'JSON', 'XLSX', 'ZIP', 'PNG', 'JPEG', 'TXT', 'DwC-A', 'GeoJSON']
+WORDS = (
+    'specimen collection museum natural history dataset record taxon locality '
+    'catalogue digitised herbarium type sample botany zoology palaeontology mineral'
+).split()
+
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def _words(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+def make_resources(count, rng):
+    """
+    Generate resource dicts.
+
+    :param count: the number of resources
+    :param rng: a random.Random
+    :returns: a list of dicts
+    """
+    return [
+        {
+            'id': _uuid(rng),
+            'name': f'Resource {i}',
+            'format': rng.choice(FORMATS),
+            'size': rng.randint(0, 10**9),
+            'url': f'https://data.example.com/resource/{i}',
+            'state': 'active',
+        }
+        for i in range(count)
+    ]
+
+
+def make_tags(count, rng):
+    """
+    Generate tag dicts, all with distinct names.
+
+    :param count: the number of tags
+    :param rng: a random.Random
+    :returns: a list of dicts
+    """
+    tags = []
+    for i in range(count):
+        name = f'{rng.choice(WORDS)}-{i}'
+        tags.append(
+            {
+                'vocabulary_id': None,
+                'state': 'active',
+                'display_name': name,
+                'id': _uuid(rng),
+                'name': name,
+            }
+        )
+    return tags
+
+
+def make_authors(count, rng):
+    """
+    Generate an author string listing several people, in the "Family, Given" form.
+
+    :param count: the number of authors
+    :param rng: a random.Random
+    :returns: a str
+    """
+    return '; '.join(
+        f'{rng.choice(WORDS).title()}{i}, {rng.choice(WORDS).title()}'
+        for i in range(count)
+    )
+
+
+def make_notes(length, rng):
+    """
+    Generate notes text of (exactly) the given length.
+
+    :param length: the number of characters
+    :param rng: a random.Random
+    :returns: a str
+    """
+    text = _words(rng, length // 6 + 1)
+    while len(text) < length:
+        text += ' ' + text
+    return text[:length]
+
+
+def make_package(resources=0, tags=2, authors=1, notes_length=40, seed=0):
+    """
+    Generate a package dict like tests.helpers.constants.PKG_DICT, scaled up.
+
+    :param resources: the number of resources
+    :param tags: the number of tags
+    :param authors: the number of people in the author field
+    :param notes_length: the length of the notes
+    :param seed: seed for the random number generator
+    :returns: a dict
+    """
+    rng = random.Random(seed)
+    pkg_dict = copy.deepcopy(constants.PKG_DICT)
+    pkg_dict['resources'] = make_resources(resources, rng)
+    pkg_dict['num_resources'] = resources
+    pkg_dict['tags'] = make_tags(tags, rng)
+    pkg_dict['num_tags'] = tags
+    pkg_dict['author'] = make_authors(authors, rng)
+    pkg_dict['notes'] = make_notes(notes_length, rng)
+    return pkg_dict
+
+
+def make_contributors(count, seed=0):
+    """
+    Generate keyword arguments for xml_utils.create_contributor, mixing people given as
+    full names, people given as separate names, and organisations.
+
+    :param count: the number of contributors
+    :param seed: seed for the random number generator
+    :returns: a list of dicts
+    """
+    rng = random.Random(seed)
+    contributors = []
+    for i in range(count):
+        family = f'{rng.choice(WORDS).title()}{i}'
+        given = rng.choice(WORDS).title()
+        kind = i % 3
+        if kind == 0:
+            contributor = {'full_name': f'{family}, {given}'}
+        elif kind == 1:
+            contributor = {
+                'family_name': family,
+                'given_name': given,
+                'affiliations': ['Natural History Museum', 'Example University'],
+                'identifiers': [
+                    {
+                        'identifier': f'0000-0000-0000-{i:04d}',
+                        'scheme': 'ORCID',
+                        'scheme_uri': 'https://orcid.org',
+                    }
+                ],
+            }
+        else:
+            contributor = {'full_name': f'{family} Society', 'is_org': True}
+        contributor['contributor_type'] = 'Researcher'
+        contributors.append(contributor)
+    return contributors
+
+
+# the package shapes to benchmark at each scale, as make_package kwargs
+SCALES = {
+    # quick check that everything runs
+    'smoke': [
+        {'resources': 1},
+    ],
+    # the sort of packages seen on a busy portal
+    'realistic': [
+        {'resources': 1},
+        {'resources': 10, 'tags': 10, 'authors': 3, 'notes_length': 2000},
+        {'resources': 100, 'tags': 25, 'authors': 10, 'notes_length': 10000},
+    ],
+    # the worst packages we've ever seen, and then some
+    'extreme': [
+        {'resources': 1000, 'tags': 100, 'authors': 50, 'notes_length': 100000},
+        {'resources': 10000, 'tags': 500, 'authors': 200, 'notes_length': 500000},
+        {'resources': 50000, 'tags': 1000, 'authors': 500, 'notes_length': 1000000},
+    ],
+}
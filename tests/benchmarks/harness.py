@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+Timing and memory measurement for the benchmarks, plus a command for comparing two
+saved results files:
+
+    python -m tests.benchmarks.harness old.json new.json [--threshold 0.1]
+"""
+
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+
+def _percentile(ordered, fraction):
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(func, min_time=0.5, min_rounds=5, max_rounds=10000):
+    """
+    Call a function repeatedly and measure how long each call takes, then call it once
+    more with tracemalloc running to find its peak memory use. Tracing slows everything
+    down so it isn't running during the timed calls.
+
+    :param func: a function taking no arguments
+    :param min_time: keep calling the function for at least this many seconds
+    :param min_rounds: call the function at least this many times
+    :param max_rounds: call the function at most this many times
+    :returns: a dict of the results
+    """
+    timings = []
+    gc.collect()
+    started = time.perf_counter()
+    while len(timings) < max_rounds and (
+        len(timings) < min_rounds or time.perf_counter() - started < min_time
+    ):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    ordered = sorted(timings)
+    return {
+        'rounds': len(timings),
+        'ops_per_sec': len(timings) / sum(timings) if sum(timings) else None,
+        'p50_ms': _percentile(ordered, 0.5) * 1000,
+        'p99_ms': _percentile(ordered, 0.99) * 1000,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+class Results:
+    """
+    Collects benchmark results and saves them as JSON.
+    """
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.results = []
+
+    def add(self, stage, params, result):
+        """
+        Record the result of one benchmark.
+
+        :param stage: the name of the thing being benchmarked
+        :param params: dict describing the input it was benchmarked with
+        :param result: the dict returned by measure
+        """
+        self.results.append({'stage': stage, 'params': params, **result})
+
+    def as_dict(self):
+        try:
+            from importlib.metadata import version
+
+            doi_version = version('ckanext-doi')
+        except Exception:
+            doi_version = None
+        return {
+            'meta': {
+                'created': datetime.now().isoformat(),
+                'scale': self.scale,
+                'ckanext_doi': doi_version,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+            },
+            'results': self.results,
+        }
+
+    def save(self, path):
+        """
+        Write the results to a JSON file.
+
+        :param path: the path to write to
+        """
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+def _key(result):
+    return result['stage'], json.dumps(result['params'], sort_keys=True)
+
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare two sets of results, as saved by Results.save.
+
+    :param old: the old results dict
+    :param new: the new results dict
+    :param threshold: how much slower (as a fraction) or more memory hungry a benchmark
+        must be before it counts as a regression
+    :returns: a list of (stage, params, p50 change, memory change, regressed) tuples for
+        the benchmarks in both sets; the changes are fractions (0.1 = 10% more)
+    """
+    old_results = {_key(r): r for r in old['results']}
+    rows = []
+    for result in new['results']:
+        previous = old_results.get(_key(result))
+        if previous is None:
+            continue
+        time_change = result['p50_ms'] / previous['p50_ms'] - 1
+        memory_change = (
+            result['peak_memory_kb'] / previous['peak_memory_kb'] - 1
+            if previous['peak_memory_kb']
+            else 0
+        )
+        regressed = time_change > threshold or memory_change > threshold
+        rows.append(
+            (result['stage'], result['params'], time_change, memory_change, regressed)
+        )
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark results files.')
+    parser.add_argument('old', help='the results to compare against')
+    parser.add_argument('new', help='the new results')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='fractional slowdown or memory increase that counts as a regression',
+    )
+    args = parser.parse_args(argv)
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    rows = compare(old, new, args.threshold)
+    for stage, params, time_change, memory_change, regressed in rows:
+        flag = 'REGRESSION' if regressed else ''
+        print(
+            f'{stage:<24} {json.dumps(params, sort_keys=True):<70} '
+            f'p50 {time_change:+7.1%}  memory {memory_change:+7.1%}  {flag}'
+        )
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
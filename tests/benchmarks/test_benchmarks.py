@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+Benchmarks for the metadata pipeline. These are skipped unless the
+CKANEXT_DOI_BENCHMARK environment variable is set to one of the scales in
+generators.SCALES, e.g.:
+
+    CKANEXT_DOI_BENCHMARK=realistic pytest --ckan-ini=test.ini tests/benchmarks
+
+The results are saved to the file named by CKANEXT_DOI_BENCHMARK_OUTPUT (default
+benchmark-results.json) and can be compared with previous results using
+tests.benchmarks.harness.
+"""
+
+import copy
+import os
+from unittest.mock import MagicMock, patch
+
+import dateutil.parser
+import pytest
+
+from ckanext.doi.lib import xml_utils
+from ckanext.doi.lib.api import DataciteClient
+from ckanext.doi.lib.compare import metadata_fingerprint
+from ckanext.doi.lib.dates import parse_date
+from ckanext.doi.lib.metadata import build_metadata_dict, build_xml_dict
+from ckanext.doi.lib.serialisation import to_xml
+from ckanext.doi.lib.validation import clear_validation_cache
+
+from .generators import SCALES, make_contributors, make_package
+from .harness import Results, measure
+
+SCALE = os.environ.get('CKANEXT_DOI_BENCHMARK')
+OUTPUT = os.environ.get('CKANEXT_DOI_BENCHMARK_OUTPUT', 'benchmark-results.json')
+DOI = '10.4124/abcd1234'
+
+if not SCALE:
+    # skip the whole module, as the shape fixture has no parameters without a scale
+    pytest.skip(
+        'set CKANEXT_DOI_BENCHMARK to run the benchmarks', allow_module_level=True
+    )
+
+pytestmark = [
+    pytest.mark.ckan_config('ckanext.doi.publisher', 'Example Publisher'),
+    pytest.mark.ckan_config('ckanext.doi.prefix', '10.4124'),
+]
+
+SHAPES = SCALES[SCALE]
+
+
+def _id(shape):
+    return ','.join(f'{k}={v}' for k, v in sorted(shape.items()))
+
+
+@pytest.fixture(scope='module')
+def results():
+    collected = Results(SCALE)
+    yield collected
+    collected.save(OUTPUT)
+
+
+@pytest.fixture(params=SHAPES, ids=_id)
+def shape(request):
+    return request.param
+
+
+@pytest.fixture
+def pkg_dict(shape):
+    return make_package(**shape)
+
+
+@pytest.fixture
+def xml_dict(pkg_dict):
+    xml_dict = build_xml_dict(build_metadata_dict(pkg_dict))
+    xml_dict['identifiers'] = [{'identifierType': 'DOI', 'identifier': DOI}]
+    return xml_dict
+
+
+def test_build_metadata_dict(results, shape, pkg_dict):
+    results.add(
+        'build_metadata_dict', shape, measure(lambda: build_metadata_dict(pkg_dict))
+    )
+
+
+def test_build_xml_dict(results, shape, pkg_dict):
+    metadata_dict = build_metadata_dict(pkg_dict)
+    results.add('build_xml_dict', shape, measure(lambda: build_xml_dict(metadata_dict)))
+
+
+def test_create_contributor(results, shape):
+    contributors = make_contributors(shape.get('authors', 1))
+
+    def create_all():
+        return [xml_utils.create_contributor(**c) for c in contributors]
+
+    results.add('create_contributor', {'count': len(contributors)}, measure(create_all))
+
+
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+@patch('ckanext.doi.lib.api.DOIQuery')
+def test_check_for_update_local(mock_crud, mock_client, results, shape, xml_dict):
+    mock_crud.read_doi = MagicMock(
+        return_value=MagicMock(metadata_hash=metadata_fingerprint(xml_dict))
+    )
+    client = DataciteClient()
+    results.add(
+        'check_for_update[local]',
+        shape,
+        measure(lambda: client.check_for_update(DOI, xml_dict, verify_remote=False)),
+    )
+
+
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+@patch('ckanext.doi.lib.api.DOIQuery')
+def test_check_for_update_remote(mock_crud, mock_client, results, shape, xml_dict):
+    mock_client.return_value.metadata_get = MagicMock(return_value=to_xml(xml_dict))
+    client = DataciteClient()
+    results.add(
+        'check_for_update[remote]',
+        shape,
+        measure(lambda: client.check_for_update(DOI, xml_dict, verify_remote=True)),
+    )
+
+
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+@patch('ckanext.doi.lib.api.DOIQuery')
+def test_set_metadata(mock_crud, mock_client, results, shape, xml_dict):
+    client = DataciteClient()
+
+    def set_metadata():
+        # make sure the metadata is validated every time
+        clear_validation_cache()
+        client.set_metadata(DOI, copy.copy(xml_dict))
+
+    results.add('set_metadata', shape, measure(set_metadata))
+
+
+@pytest.mark.parametrize(
+    'value',
+    ['2020-11-09T17:14:06.700561', '2020-11-09', '9 November 2020'],
+    ids=['ckan', 'date', 'other'],
+)
+def test_parse_date(results, value):
+    params = {'value': value}
+    # dateutil is what was used for every date before parse_date
+    results.add(
+        'parse_date[dateutil]', params, measure(lambda: dateutil.parser.parse(value))
+    )
+    results.add(
+        'parse_date[uncached]', params, measure(lambda: parse_date.__wrapped__(value))
+    )
+    results.add('parse_date[cached]', params, measure(lambda: parse_date(value)))
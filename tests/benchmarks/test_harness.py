@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import json
+
+from .generators import make_contributors, make_package
+from .harness import Results, compare, main, measure
+
+
+def test_make_package():
+    pkg_dict = make_package(resources=5, tags=3, authors=4, notes_length=100)
+    assert len(pkg_dict['resources']) == 5
+    assert len({tag['name'] for tag in pkg_dict['tags']}) == 3
+    assert pkg_dict['author'].count(';') == 3
+    assert len(pkg_dict['notes']) == 100
+    # the same seed gives the same package
+    assert make_package(resources=5, tags=3) == make_package(resources=5, tags=3)
+
+
+def test_make_contributors():
+    assert len(make_contributors(7)) == 7
+
+
+def test_measure():
+    calls = []
+    result = measure(lambda: calls.append(1), min_time=0, min_rounds=3)
+    assert result['rounds'] == 3
+    # the extra call is for measuring memory
+    assert len(calls) == 4
+    assert result['p50_ms'] <= result['p99_ms']
+    assert set(result) == {
+        'rounds',
+        'ops_per_sec',
+        'p50_ms',
+        'p99_ms',
+        'peak_memory_kb',
+    }
+
+
+def _results(p50, memory):
+    results = Results('smoke')
+    results.add(
+        'stage',
+        {'resources': 1},
+        {
+            'rounds': 1,
+            'ops_per_sec': 1,
+            'p50_ms': p50,
+            'p99_ms': p50,
+            'peak_memory_kb': memory,
+        },
+    )
+    return results.as_dict()
+
+
+def test_compare():
+    [(stage, params, time_change, memory_change, regressed)] = compare(
+        _results(10, 100), _results(12, 100)
+    )
+    assert stage == 'stage'
+    assert round(time_change, 2) == 0.2
+    assert memory_change == 0
+    assert regressed
+    [row] = compare(_results(10, 100), _results(10.5, 90))
+    assert not row[-1]
+
+
+def test_main(tmp_path):
+    old = tmp_path / 'old.json'
+    new = tmp_path / 'new.json'
+    old.write_text(json.dumps(_results(10, 100)))
+    new.write_text(json.dumps(_results(10, 200)))
+    assert main([str(old), str(new)]) == 1
+    assert main([str(old), str(old)]) == 0
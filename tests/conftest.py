@@ -1,6 +1,14 @@
 import pytest
+from ckan.model import Session
+from sqlalchemy import event
 
+from ckanext.doi.lib.api import DataciteClient, reset_client
+from ckanext.doi.lib.dispatch import reset_plugin_chain
+from ckanext.doi.lib.metadata import clear_metadata_context
 from ckanext.doi.model.doi import doi_table
+from ckanext.doi.model.reservation import doi_reservation_table
+
+from .helpers.datacite_server import FakeDataCiteServer
 
 try:
     # 2.11 compatibility
@@ -11,11 +19,78 @@ except ImportError:
         return None
 
 
+@pytest.fixture(autouse=True)
+def fresh_metadata_context():
+    """
+    The metadata context and plugin chain are built from config values and the loaded
+    plugins, which tests change, so make sure each test starts with fresh ones.
+    """
+    clear_metadata_context()
+    reset_plugin_chain()
+    yield
+    clear_metadata_context()
+    reset_plugin_chain()
+
+
 @pytest.fixture
 def with_doi_table(reset_db):
     """
-    Simple fixture which resets the database and creates the doi table.
+    Simple fixture which resets the database and creates the doi tables.
     """
     reset_db()
     engine = ensure_engine()
     doi_table.create(engine, checkfirst=True)
+    doi_reservation_table.create(engine, checkfirst=True)
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements executed while it's active.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args, **kwargs):
+        self.count += 1
+
+
+@pytest.fixture
+def query_counter():
+    """
+    Fixture which counts the SQL statements run through the database session.
+    """
+    engine = Session.get_bind()
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter)
+    yield counter
+    event.remove(engine, 'before_cursor_execute', counter)
+
+
+@pytest.fixture(scope='session')
+def _datacite_server():
+    with FakeDataCiteServer() as server:
+        yield server
+
+
+@pytest.fixture
+def datacite_server(_datacite_server, ckan_config, monkeypatch):
+    """
+    Fixture which points the extension at a fake DataCite API running locally (see
+    tests.helpers.datacite_server). The server is shared by the whole session but is
+    reset for each test.
+    """
+    _datacite_server.reset()
+    monkeypatch.setitem(ckan_config, 'ckanext.doi.test_mode', True)
+    monkeypatch.setitem(
+        ckan_config, 'ckanext.doi.account_name', _datacite_server.username
+    )
+    monkeypatch.setitem(
+        ckan_config, 'ckanext.doi.account_password', _datacite_server.password
+    )
+    monkeypatch.setitem(ckan_config, 'ckanext.doi.prefix', _datacite_server.prefix)
+    monkeypatch.setattr(DataciteClient, 'test_url', _datacite_server.url)
+    monkeypatch.setattr(DataciteClient, 'rest_test_url', _datacite_server.url)
+    reset_client()
+    yield _datacite_server
+    reset_client()
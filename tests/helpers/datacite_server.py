@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+"""
+A stand-in for the DataCite MDS and REST APIs which keeps everything in memory, so that
+the HTTP side of the extension (connection reuse, timeouts, concurrency, retries) can be
+tested offline. Latency, errors, rate limiting and outages can be switched on to see how
+the extension copes with them.
+
+Use the datacite_server fixture in the tests, or run it as a separate process for load
+testing:
+
+    python -m tests.helpers.datacite_server --port 8080 --latency 0.05
+
+and point the extension at it by setting ckanext.doi.test_mode = True and patching
+DataciteClient.test_url and DataciteClient.rest_test_url (the fixture does all three).
+"""
+
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote
+
+NAMESPACE = '{http://datacite.org/schema/kernel-4}'
+JSON_API = 'application/vnd.api+json'
+# the REST API includes every field in its responses, whether it has a value or not
+EMPTY_ATTRIBUTES = {
+    'contributors': [],
+    'language': None,
+    'sizes': [],
+    'formats': [],
+    'version': None,
+    'relatedIdentifiers': [],
+    'geoLocations': [],
+    'fundingReferences': [],
+}
+# the fields the REST API needs before it will register a DOI
+REQUIRED_ATTRIBUTES = ('titles', 'creators', 'publisher', 'publicationYear', 'types')
+
+
+class DOIRecord:
+    """
+    Everything the server knows about one DOI.
+    """
+
+    def __init__(self, identifier):
+        """
+        :param identifier: the DOI
+        """
+        self.identifier = identifier
+        # XML posted through the MDS API
+        self.metadata = None
+        # JSON attributes put through the REST API
+        self.attributes = None
+        self.url = None
+        self.active = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep connections open between requests, like DataCite does
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.fake._connection_opened()
+
+    def log_message(self, format, *args):
+        if self.server.fake.verbose:
+            super().log_message(format, *args)
+
+    def _respond(
+        self, status, body='', content_type='text/plain;charset=UTF-8', headers=None
+    ):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode('utf-8') if length else ''
+
+    def _handle(self, method):
+        fake = self.server.fake
+        # always read the body so the connection can be reused, even if we fail
+        body = self._body()
+        generation = fake._record_request(method, self.path)
+        fault = fake._fault()
+        if fault is not None:
+            self._respond(*fault)
+            return
+        if not fake._authorised(self.headers.get('Authorization')):
+            self._respond(401, 'Bad credentials')
+            return
+        path, _, query = self.path.partition('?')
+        self._respond(
+            *fake._dispatch(
+                method, unquote(path).strip('/'), body, parse_qs(query), generation
+            )
+        )
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class FakeDataCiteServer:
+    """
+    An in-memory imitation of the DataCite MDS and REST APIs.
+
+    Supported MDS endpoints:
+
+    - GET /doi: list all minted DOIs
+    - GET /doi/<doi>: get the URL a DOI points to
+    - POST /doi: mint a DOI (its metadata must have been posted first)
+    - GET /metadata/<doi>: get the metadata for a DOI
+    - POST /metadata: add or replace the metadata for the DOI it contains
+    - DELETE /metadata/<doi>: mark a DOI as inactive
+
+    Supported REST endpoints:
+
+    - GET /dois: list DOIs, a page at a time (the cursor is just the page number)
+    - GET /dois/<doi>: get a DOI's attributes
+    - PUT /dois/<doi>: create or update a DOI, registering it if the publish event is
+      given
+
+    Both APIs share the same DOIs, but metadata is only returned in the form it was
+    given in (XML through the MDS API, JSON through the REST API).
+
+    All requests must use HTTP basic auth with the configured username and password,
+    and only DOIs with the configured prefix can be created.
+
+    The fault settings are attributes and can be changed while the server is running.
+    Requests which are still being handled when the server is reset (e.g. because the
+    client timed out waiting for them) have no effect.
+    """
+
+    def __init__(
+        self,
+        host='127.0.0.1',
+        port=0,
+        username='username',
+        password='password',
+        prefix='10.4124',
+        latency=0,
+        error_rate=0,
+        rate_limit=None,
+        outage=False,
+        seed=None,
+        verbose=False,
+    ):
+        """
+        :param host: the host to listen on
+        :param port: the port to listen on; 0 picks a free one
+        :param username: the account name the client must use
+        :param password: the password the client must use
+        :param prefix: the DOI prefix the account is allowed to use
+        :param latency: seconds to wait before responding to each request; either a
+            number or a (min, max) tuple to pick a random delay from
+        :param error_rate: fraction of requests (0-1) to fail with a 500 error
+        :param rate_limit: maximum number of requests per second; requests over the
+            limit get a 429 response
+        :param outage: if True, every request gets a 503 response
+        :param seed: seed for the random number generator used for latency and errors
+        :param verbose: log each request to stderr
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.prefix = prefix
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.outage = outage
+        self.verbose = verbose
+        self.dois = {}
+        self.requests = Counter()
+        self.connections = 0
+        self._random = random.Random(seed)
+        self._recent = deque()
+        # incremented by reset, so that requests from before it can be ignored
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        The base URL of the running server.
+        """
+        return f'http://{self.host}:{self.port}/'
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+
+        :returns: self
+        """
+        self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop the server.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        """
+        Start the server.
+        """
+        return self.start()
+
+    def __exit__(self, *args):
+        """
+        Stop the server.
+        """
+        self.stop()
+
+    def reset(self):
+        """
+        Forget all DOIs and counters, and switch off all the faults. Requests which
+        started before the reset and haven't finished yet will no longer change
+        anything.
+        """
+        with self._lock:
+            self._generation += 1
+            self.dois.clear()
+            self.requests.clear()
+            self.connections = 0
+            self._recent.clear()
+        self.latency = 0
+        self.error_rate = 0
+        self.rate_limit = None
+        self.outage = False
+
+    def _connection_opened(self):
+        with self._lock:
+            self.connections += 1
+
+    def _record_request(self, method, path):
+        """
+        Count a request.
+
+        :returns: the generation the request belongs to
+        """
+        endpoint = path.split('?', 1)[0].strip('/').split('/', 1)[0]
+        with self._lock:
+            self.requests[(method, endpoint)] += 1
+            return self._generation
+
+    def _authorised(self, header):
+        if not header or not header.startswith('Basic '):
+            return False
+        try:
+            decoded = base64.b64decode(header[6:]).decode('utf-8')
+        except ValueError:
+            return False
+        return decoded == f'{self.username}:{self.password}'
+
+    def _fault(self):
+        """
+        Apply the configured latency and decide whether this request should fail.
+
+        :returns: None, or a (status, body, content type, headers) tuple to respond with
+        """
+        with self._lock:
+            latency = self.latency
+            if isinstance(latency, (tuple, list)):
+                latency = self._random.uniform(*latency)
+            fail = self.error_rate and self._random.random() < self.error_rate
+            limited = False
+            if self.rate_limit:
+                now = time.monotonic()
+                while self._recent and self._recent[0] <= now - 1:
+                    self._recent.popleft()
+                limited = len(self._recent) >= self.rate_limit
+                if not limited:
+                    self._recent.append(now)
+        if latency:
+            time.sleep(latency)
+        if self.outage:
+            return 503, 'Service unavailable', 'text/plain;charset=UTF-8'
+        if limited:
+            return (
+                429,
+                'Too many requests',
+                'text/plain;charset=UTF-8',
+                {'Retry-After': '1'},
+            )
+        if fail:
+            return 500, 'Internal server error', 'text/plain;charset=UTF-8'
+        return None
+
+    def _dispatch(self, method, path, body, query, generation):
+        """
+        Handle an authorised request.
+
+        :param generation: the generation the request belongs to; if the server has
+            been reset since, the request is ignored
+        :returns: a (status, body[, content type]) tuple
+        """
+        endpoint, _, doi = path.partition('/')
+        with self._lock:
+            if generation != self._generation:
+                return 503, 'Service unavailable'
+            if endpoint == 'dois':
+                if method == 'GET' and not doi:
+                    return self._rest_list(query)
+                if method == 'GET':
+                    return self._rest_get(doi)
+                if method == 'PUT' and doi:
+                    return self._rest_put(body, doi)
+            if endpoint == 'doi':
+                if method == 'GET' and not doi:
+                    return self._list_dois()
+                if method == 'GET':
+                    return self._get_doi(doi)
+                if method in ('POST', 'PUT'):
+                    return self._mint_doi(body, doi)
+            elif endpoint == 'metadata':
+                if method == 'GET' and doi:
+                    return self._get_metadata(doi)
+                if method in ('POST', 'PUT'):
+                    return self._post_metadata(body)
+                if method == 'DELETE' and doi:
+                    return self._delete_metadata(doi)
+        return 405, 'Method not allowed'
+
+    def _list_dois(self):
+        minted = sorted(d.identifier for d in self.dois.values() if d.url)
+        if not minted:
+            return 204, ''
+        return 200, '\n'.join(minted)
+
+    def _get_doi(self, doi):
+        record = self.dois.get(doi.lower())
+        if record is None:
+            return 404, 'DOI not found'
+        if not record.url:
+            return 204, ''
+        return 200, record.url
+
+    def _mint_doi(self, body, doi=None):
+        values = dict(line.split('=', 1) for line in body.splitlines() if '=' in line)
+        doi = values.get('doi', doi)
+        url = values.get('url')
+        if not doi or not url:
+            return 400, 'Parameters doi and url are required'
+        if not doi.startswith(f'{self.prefix}/'):
+            return 403, 'Cannot access this prefix'
+        record = self.dois.get(doi.lower())
+        if record is None or record.metadata is None:
+            return 412, "Can't be minted. Please register metadata first."
+        record.url = url
+        return 201, 'OK'
+
+    def _get_metadata(self, doi):
+        record = self.dois.get(doi.lower())
+        if record is None or record.metadata is None:
+            return 404, 'DOI not found'
+        if not record.active:
+            return 410, 'DOI is inactive'
+        return 200, record.metadata, 'application/xml;charset=UTF-8'
+
+    def _post_metadata(self, body):
+        try:
+            tree = ET.fromstring(body.encode('utf-8'))
+        except ET.ParseError as e:
+            return 400, f'Invalid XML: {e}'
+        doi = tree.findtext(f'{NAMESPACE}identifier')
+        if not doi:
+            return 400, 'Metadata must include a DOI identifier'
+        if not doi.startswith(f'{self.prefix}/'):
+            return 403, 'Cannot access this prefix'
+        record = self.dois.setdefault(doi.lower(), DOIRecord(doi))
+        record.metadata = body
+        record.active = True
+        return 201, f'OK ({doi})'
+
+    def _delete_metadata(self, doi):
+        record = self.dois.get(doi.lower())
+        if record is None or record.metadata is None:
+            return 404, 'DOI not found'
+        record.active = False
+        return 200, 'OK'
+
+    @staticmethod
+    def _json(status, body):
+        return status, json.dumps(body), JSON_API
+
+    def _json_error(self, status, title, source=None):
+        error = {'status': str(status), 'title': title}
+        if source:
+            error['source'] = source
+        return self._json(status, {'errors': [error]})
+
+    def _rest_resource(self, record):
+        attributes = {
+            **EMPTY_ATTRIBUTES,
+            **(record.attributes or {}),
+            'doi': record.identifier,
+            'url': record.url,
+            'state': 'findable' if record.url else 'draft',
+        }
+        year = attributes.get('publicationYear')
+        if isinstance(year, str) and year.isdigit():
+            # strings are accepted but it comes back as a number
+            attributes['publicationYear'] = int(year)
+        return {
+            'id': record.identifier.lower(),
+            'type': 'dois',
+            'attributes': attributes,
+        }
+
+    def _rest_list(self, query):
+        prefix = query.get('prefix', [''])[0].lower()
+        size = int(query.get('page[size]', ['25'])[0])
+        page = int(query.get('page[cursor]', ['1'])[0])
+        records = sorted(
+            (r for k, r in self.dois.items() if k.startswith(f'{prefix}/')),
+            key=lambda r: r.identifier,
+        )
+        start = (page - 1) * size
+        body = {'data': [self._rest_resource(r) for r in records[start : start + size]]}
+        if start + size < len(records):
+            body['links'] = {
+                'next': f'{self.url}dois?page[cursor]={page + 1}&page[size]={size}'
+            }
+        return self._json(200, body)
+
+    def _rest_get(self, doi):
+        record = self.dois.get(doi.lower())
+        if record is None:
+            return self._json_error(
+                404, 'The resource you are looking for does not exist.'
+            )
+        return self._json(200, {'data': self._rest_resource(record)})
+
+    def _rest_put(self, body, doi):
+        try:
+            attributes = dict(json.loads(body)['data']['attributes'])
+        except (ValueError, KeyError, TypeError):
+            return self._json_error(400, 'Invalid JSON:API document')
+        if attributes.pop('doi', doi).lower() != doi.lower():
+            return self._json_error(422, 'DOI does not match the URL', 'doi')
+        if not doi.startswith(f'{self.prefix}/'):
+            return self._json_error(
+                403, 'You are not authorized to access this resource.'
+            )
+        attributes.pop('prefix', None)
+        event = attributes.pop('event', None)
+        url = attributes.pop('url', None)
+
+        record = self.dois.get(doi.lower())
+        created = record is None
+        if created:
+            record = DOIRecord(doi)
+        merged = {**(record.attributes or {}), **attributes}
+        if event == 'publish':
+            if not (url or record.url):
+                return self._json_error(422, "can't be blank", 'url')
+            if record.metadata is None:
+                for field in REQUIRED_ATTRIBUTES:
+                    if not merged.get(field):
+                        return self._json_error(422, "can't be blank", field)
+        if created:
+            self.dois[doi.lower()] = record
+        if merged:
+            record.attributes = merged
+        if url and (event == 'publish' or record.url):
+            # drafts don't have a URL until they are registered
+            record.url = url
+        record.active = True
+        return self._json(
+            201 if created else 200, {'data': self._rest_resource(record)}
+        )
+
+
+def main(argv=None):
+    """
+    Run the server until interrupted.
+    """
+    parser = argparse.ArgumentParser(description='Run a fake DataCite API.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--username', default='username')
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--prefix', default='10.4124')
+    parser.add_argument(
+        '--latency', type=float, default=0, help='seconds to wait before responding'
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0, help='fraction of requests to fail'
+    )
+    parser.add_argument(
+        '--rate-limit', type=int, default=None, help='maximum requests per second'
+    )
+    parser.add_argument(
+        '--outage', action='store_true', help='fail every request with a 503 error'
+    )
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    server = FakeDataCiteServer(
+        host=args.host,
+        port=args.port,
+        username=args.username,
+        password=args.password,
+        prefix=args.prefix,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        rate_limit=args.rate_limit,
+        outage=args.outage,
+        seed=args.seed,
+        verbose=args.verbose,
+    ).start()
+    print(f'Fake DataCite API running at {server.url}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
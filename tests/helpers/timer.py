@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+
+class FakeTimer:
+    """
+    A clock for the code under test which only moves when the test moves it, by
+    setting now.
+    """
+
+    def __init__(self):
+        """
+        Start the clock at 0.
+        """
+        self.now = 0
+
+    def __call__(self):
+        """
+        :returns: the current time
+        """
+        return self.now
@@ -5,12 +5,16 @@
 # Created by the Natural History Museum in London, UK
 
 import xml.etree.ElementTree as ET
+from datetime import datetime
 from unittest.mock import MagicMock, patch
 
 import pytest
+from datacite import schema42
 from datacite.errors import DataCiteError, DataCiteNotFoundError
 
-from ckanext.doi.lib.api import DataciteClient
+from ckanext.doi.lib.api import DataciteClient, get_client, reset_client
+from ckanext.doi.lib.compare import FieldChange, metadata_fingerprint
+from ckanext.doi.lib.http import PooledDataCiteRequest, get_session, reset_session
 
 from .helpers import constants
 
@@ -51,7 +55,8 @@ class TestGenerateNewDOI:
         mock_read_doi = MagicMock(return_value=None)
 
         with patch(
-            'ckanext.doi.lib.api.DataCiteMDSClient', MagicMock(return_value=mock_client)
+            'ckanext.doi.lib.api.PooledDataCiteMDSClient',
+            MagicMock(return_value=mock_client),
         ):
             with patch('ckanext.doi.lib.api.DOIQuery.read_doi', mock_read_doi):
                 api = DataciteClient()
@@ -72,7 +77,8 @@ class TestGenerateNewDOI:
         mock_read_doi = MagicMock(side_effect=first_then(MagicMock(), None))
 
         with patch(
-            'ckanext.doi.lib.api.DataCiteMDSClient', MagicMock(return_value=mock_client)
+            'ckanext.doi.lib.api.PooledDataCiteMDSClient',
+            MagicMock(return_value=mock_client),
         ):
             with patch('ckanext.doi.lib.api.DOIQuery.read_doi', mock_read_doi):
                 api = DataciteClient()
@@ -90,7 +96,8 @@ class TestGenerateNewDOI:
         mock_read_doi = MagicMock(return_value=None)
 
         with patch(
-            'ckanext.doi.lib.api.DataCiteMDSClient', MagicMock(return_value=mock_client)
+            'ckanext.doi.lib.api.PooledDataCiteMDSClient',
+            MagicMock(return_value=mock_client),
         ):
             with patch('ckanext.doi.lib.api.DOIQuery.read_doi', mock_read_doi):
                 api = DataciteClient()
@@ -108,7 +115,8 @@ class TestGenerateNewDOI:
         mock_read_doi = MagicMock(side_effect=first_then(MagicMock(), None))
 
         with patch(
-            'ckanext.doi.lib.api.DataCiteMDSClient', MagicMock(return_value=mock_client)
+            'ckanext.doi.lib.api.PooledDataCiteMDSClient',
+            MagicMock(return_value=mock_client),
         ):
             with patch('ckanext.doi.lib.api.DOIQuery.read_doi', mock_read_doi):
                 api = DataciteClient()
@@ -121,7 +129,7 @@ class TestGenerateNewDOI:
         # the db returns an existing (mock) doi every time, so unlikely!
         mock_read_doi = MagicMock()
 
-        with patch('ckanext.doi.lib.api.DataCiteMDSClient', mock_client):
+        with patch('ckanext.doi.lib.api.PooledDataCiteMDSClient', mock_client):
             with patch('ckanext.doi.lib.api.DOIQuery.read_doi', mock_read_doi):
                 api = DataciteClient()
                 with pytest.raises(Exception, match='Failed to generate a DOI'):
@@ -153,7 +161,7 @@ class MockDataciteMDSClient(object):
 
 
 @pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
-@patch('ckanext.doi.lib.api.DataCiteMDSClient', MockDataciteMDSClient)
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient', MockDataciteMDSClient)
 @patch('ckanext.doi.lib.api.DOIQuery')
 class TestMintNewDOI(object):
     def test_datacite_api_order(self, mock_crud):
@@ -170,71 +178,38 @@ class TestMintNewDOI(object):
         api.set_metadata(doi, constants.XML_DICT)
         api.mint_doi(doi, pkg_id)
 
-    def test_new_doi(self, mock_crud):
-        mock_crud.read_doi = MagicMock(return_value=None)
-        mock_crud.read_package = MagicMock(return_value=None)
-
+    def test_records_mint(self, mock_crud):
         api = DataciteClient()
         doi = constants.XML_DICT['identifiers'][0]['identifier']
         pkg_id = MagicMock()
 
         api.set_metadata(doi, constants.XML_DICT)
-        api.mint_doi(doi, pkg_id)
-
-        assert mock_crud.create.called
-        assert not mock_crud.update_package.called
-        assert mock_crud.update_doi.called
-
-    def test_existing_doi(self, mock_crud):
-        mock_crud.read_doi = MagicMock(return_value=MagicMock())
-        mock_crud.read_package = MagicMock(return_value=None)
-
-        api = DataciteClient()
-        doi = constants.XML_DICT['identifiers'][0]['identifier']
-        pkg_id = MagicMock()
-
-        api.set_metadata(doi, constants.XML_DICT)
-        api.mint_doi(doi, pkg_id)
-
+        record = api.mint_doi(doi, pkg_id)
+
+        # all the bookkeeping is done in one statement
+        assert mock_crud.record_mint.call_count == 1
+        args = mock_crud.record_mint.call_args.args
+        assert args[:2] == (doi, pkg_id)
+        assert isinstance(args[2], datetime)
+        assert record is mock_crud.record_mint.return_value
+        assert not mock_crud.read_doi.called
+        assert not mock_crud.read_package.called
         assert not mock_crud.create.called
         assert not mock_crud.update_package.called
-        assert mock_crud.update_doi.called
-
-    def test_existing_package(self, mock_crud):
-        mock_crud.read_doi = MagicMock(return_value=None)
-        mock_crud.read_package = MagicMock(return_value=MagicMock())
 
+    def test_nothing_recorded_if_mint_fails(self, mock_crud):
         api = DataciteClient()
         doi = constants.XML_DICT['identifiers'][0]['identifier']
-        pkg_id = MagicMock()
 
-        api.set_metadata(doi, constants.XML_DICT)
-        api.mint_doi(doi, pkg_id)
-
-        assert not mock_crud.create.called
-        assert mock_crud.update_package.called
-        assert mock_crud.update_doi.called
-
-    def test_both_exist(self, mock_crud):
-        mock_crud.read_doi = MagicMock(return_value=MagicMock())
-        mock_crud.read_package = MagicMock(return_value=MagicMock())
-
-        api = DataciteClient()
-        doi = constants.XML_DICT['identifiers'][0]['identifier']
-        pkg_id = MagicMock()
-
-        api.set_metadata(doi, constants.XML_DICT)
-        api.mint_doi(doi, pkg_id)
-
-        assert not mock_crud.create.called
-        assert not mock_crud.update_package.called
-        assert mock_crud.update_doi.called
+        with pytest.raises(DataCiteError):
+            api.mint_doi(doi, MagicMock())
+        assert not mock_crud.record_mint.called
 
 
 @pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
 @pytest.mark.ckan_config('ckanext.doi.account_name', 'goat!')
 @pytest.mark.ckan_config('ckanext.doi.account_password', 'hammocks?')
-@patch('ckanext.doi.lib.api.DataCiteMDSClient')
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
 class TestDataciteClientCreation(object):
     @pytest.mark.ckan_config('ckanext.doi.test_mode', False)
     def test_basics(self, mock_client):
@@ -254,3 +229,166 @@ class TestDataciteClientCreation(object):
             test_mode=True,
             url=DataciteClient.test_url,
         )
+
+    @pytest.mark.ckan_config('ckanext.doi.timeout.connect', '2')
+    @pytest.mark.ckan_config('ckanext.doi.timeout.read', '20')
+    def test_timeouts(self, mock_client):
+        DataciteClient()
+        assert mock_client.call_args.kwargs['timeout'] == (2.0, 20.0)
+
+    def test_shared_client(self, mock_client):
+        reset_client()
+        try:
+            assert get_client() is get_client()
+            assert mock_client.call_count == 1
+        finally:
+            reset_client()
+
+    @pytest.mark.ckan_config('ckanext.doi.api', 'rest')
+    @pytest.mark.ckan_config('ckanext.doi.test_mode', True)
+    def test_rest_api(self, mock_client):
+        with patch('ckanext.doi.lib.api.PooledDataCiteRESTClient') as mock_rest_client:
+            client = DataciteClient()
+        assert not mock_client.called
+        assert client.client is mock_rest_client.return_value
+        assert client.backend.name == 'rest'
+        kwargs = mock_rest_client.call_args.kwargs
+        assert kwargs['url'] == DataciteClient.rest_test_url
+        assert kwargs['prefix'] == 'testing'
+
+    @pytest.mark.ckan_config('ckanext.doi.api', 'xml')
+    def test_unknown_api(self, mock_client):
+        with pytest.raises(ValueError):
+            DataciteClient()
+
+
+class TestPooledSession:
+    def test_session_is_shared(self):
+        reset_session()
+        try:
+            assert get_session() is get_session()
+        finally:
+            reset_session()
+
+    @pytest.mark.ckan_config('ckanext.doi.pool_size', '3')
+    def test_pool_size(self):
+        reset_session()
+        try:
+            adapter = get_session().get_adapter('https://mds.datacite.org/')
+            assert adapter._pool_maxsize == 3
+        finally:
+            reset_session()
+
+    def test_requests_use_session(self):
+        request = PooledDataCiteRequest(
+            base_url='https://mds.datacite.org/',
+            username='goat!',
+            password='hammocks?',
+            timeout=(1, 2),
+        )
+        with patch('ckanext.doi.lib.http.get_session') as mock_get_session:
+            mock_request = mock_get_session.return_value.request
+            mock_request.return_value = MagicMock(status_code=200, headers={})
+            request.get('doi/10.4124/abcd1234')
+        assert mock_request.call_count == 1
+        assert mock_request.call_args.args == (
+            'GET',
+            'https://mds.datacite.org/doi/10.4124/abcd1234',
+        )
+        assert mock_request.call_args.kwargs['timeout'] == (1, 2)
+
+
+@pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+@patch('ckanext.doi.lib.api.DOIQuery')
+class TestCheckForUpdate:
+    def test_uses_local_fingerprint(self, mock_crud, mock_client):
+        mock_crud.read_doi = MagicMock(
+            return_value=MagicMock(
+                metadata_hash=metadata_fingerprint(constants.XML_DICT)
+            )
+        )
+        api = DataciteClient()
+        assert api.check_for_update('10.4124/abcd1234', constants.XML_DICT)
+        assert not mock_client.return_value.metadata_get.called
+
+    def test_local_fingerprint_differs(self, mock_crud, mock_client):
+        mock_crud.read_doi = MagicMock(return_value=MagicMock(metadata_hash='nope'))
+        api = DataciteClient()
+        assert not api.check_for_update('10.4124/abcd1234', constants.XML_DICT)
+        assert not mock_client.return_value.metadata_get.called
+
+    def test_no_local_fingerprint(self, mock_crud, mock_client):
+        mock_crud.read_doi = MagicMock(return_value=MagicMock(metadata_hash=None))
+        mock_client.return_value.metadata_get = MagicMock(
+            side_effect=DataCiteNotFoundError()
+        )
+        api = DataciteClient()
+        assert not api.check_for_update('10.4124/abcd1234', constants.XML_DICT)
+        assert mock_client.return_value.metadata_get.called
+
+    def test_verify_remote(self, mock_crud, mock_client):
+        mock_crud.read_doi = MagicMock(
+            return_value=MagicMock(
+                metadata_hash=metadata_fingerprint(constants.XML_DICT)
+            )
+        )
+        mock_client.return_value.metadata_get = MagicMock(
+            side_effect=DataCiteNotFoundError()
+        )
+        api = DataciteClient()
+        assert not api.check_for_update(
+            '10.4124/abcd1234', constants.XML_DICT, verify_remote=True
+        )
+        assert mock_client.return_value.metadata_get.called
+
+    def test_set_metadata_records_fingerprint(self, mock_crud, mock_client):
+        api = DataciteClient()
+        api.set_metadata('10.4124/abcd1234', dict(constants.XML_DICT))
+        assert mock_crud.update_doi.call_args.kwargs[
+            'metadata_hash'
+        ] == metadata_fingerprint(constants.XML_DICT)
+
+    def test_remote_ignores_updated_date(self, mock_crud, mock_client):
+        mock_crud.read_doi = MagicMock(return_value=MagicMock(metadata_hash=None))
+        posted = dict(constants.XML_DICT)
+        posted['dates'] = [
+            {'dateType': 'Created', 'date': '2020-01-01'},
+            {'dateType': 'Updated', 'date': '2020-01-02'},
+        ]
+        mock_client.return_value.metadata_get = MagicMock(
+            return_value=schema42.tostring(posted)
+        )
+        new = dict(constants.XML_DICT)
+        # no DOI yet, and a later update date
+        new['identifiers'] = []
+        new['dates'] = [
+            {'dateType': 'Created', 'date': '2020-01-01'},
+            {'dateType': 'Updated', 'date': '2021-06-30'},
+        ]
+        api = DataciteClient()
+        assert api.check_for_update('10.4124/abcd1234', new)
+
+        new['titles'] = [{'title': 'A different title'}]
+        assert not api.check_for_update('10.4124/abcd1234', new)
+
+    def test_remote_ignores_format_order(self, mock_crud, mock_client):
+        posted = dict(constants.XML_DICT)
+        posted['dates'] = [{'dateType': 'Created', 'date': '2020-01-01'}]
+        posted['formats'] = ['text/csv', 'image/png']
+        mock_client.return_value.metadata_get = MagicMock(
+            return_value=schema42.tostring(posted)
+        )
+        new = dict(posted)
+        new['formats'] = ['image/png', 'text/csv']
+        api = DataciteClient()
+        assert api.find_changes('10.4124/abcd1234', new, verify_remote=True) == []
+
+        new['formats'] = ['image/png']
+        changes = api.find_changes('10.4124/abcd1234', new, verify_remote=True)
+        assert changes == [FieldChange('formats', ['text/csv'], [])]
+
+    def test_local_changes_unknown(self, mock_crud, mock_client):
+        mock_crud.read_doi = MagicMock(return_value=MagicMock(metadata_hash='nope'))
+        api = DataciteClient()
+        assert api.find_changes('10.4124/abcd1234', constants.XML_DICT) is None
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import copy
+from unittest.mock import MagicMock
+
+import pytest
+from datacite.errors import DataCiteNotFoundError
+
+from ckanext.doi.lib.backends import (
+    MDSBackend,
+    RESTBackend,
+    from_attributes,
+    to_attributes,
+)
+from ckanext.doi.lib.compare import canonical_metadata, canonicalise
+from ckanext.doi.lib.serialisation import normalise
+
+from .helpers import constants
+from .test_serialisation import FULL_XML_DICT
+
+DOI = '10.4124/abcd1234'
+
+
+def returned(attributes):
+    """
+    Imitate what the REST API returns for the attributes we put.
+    """
+    # every field is included, whether it has a value or not
+    attributes = {'language': None, 'sizes': [], **copy.deepcopy(attributes)}
+    attributes.update(doi=DOI, url=None, state='draft')
+    if 'publicationYear' in attributes:
+        attributes['publicationYear'] = int(attributes['publicationYear'])
+    return attributes
+
+
+class TestConversion:
+    def test_keys_renamed(self):
+        attributes = to_attributes(FULL_XML_DICT)
+        assert attributes['rightsList'][0]['rightsUri'] == 'https://creativecommons.org'
+        assert attributes['subjects'][0]['schemeUri'] == 'https://example.com'
+        assert attributes['subjects'][0]['valueUri'] == 'https://example.com/zoology'
+        assert attributes['fundingReferences'][0]['awardUri'] == (
+            'https://example.com/award'
+        )
+        assert attributes['creators'][1]['affiliation'] == [
+            {'name': 'Natural History Museum'}
+        ]
+
+    def test_doi_not_an_identifier(self):
+        attributes = to_attributes(FULL_XML_DICT)
+        assert attributes['identifiers'] == [
+            {'identifier': 'https://data.nhm.ac.uk/dataset/1', 'identifierType': 'URL'}
+        ]
+        assert 'identifiers' not in to_attributes(constants.XML_DICT)
+
+    def test_xml_dict_unchanged(self):
+        xml_dict = copy.deepcopy(FULL_XML_DICT)
+        to_attributes(xml_dict)
+        assert xml_dict == FULL_XML_DICT
+
+    @pytest.mark.parametrize(
+        'xml_dict', [constants.XML_DICT, FULL_XML_DICT], ids=['minimal', 'full']
+    )
+    def test_round_trip(self, xml_dict):
+        converted = from_attributes(returned(to_attributes(xml_dict)))
+        assert canonicalise(normalise(converted)) == canonical_metadata(xml_dict)
+
+    def test_publisher_object(self):
+        attributes = returned(to_attributes(constants.XML_DICT))
+        attributes['publisher'] = {'name': 'Invenio Software'}
+        assert from_attributes(attributes)['publisher'] == 'Invenio Software'
+
+
+class TestMDSBackend:
+    def test_publish_posts_metadata_first(self):
+        client = MagicMock()
+        MDSBackend(client).publish(DOI, copy.deepcopy(constants.XML_DICT), 'url')
+        assert [c[0] for c in client.method_calls] == ['metadata_post', 'doi_post']
+
+    def test_not_found(self):
+        client = MagicMock(metadata_get=MagicMock(side_effect=DataCiteNotFoundError()))
+        assert MDSBackend(client).get_canonical(DOI) is None
+
+
+class TestRESTBackend:
+    def test_publish_is_one_request(self):
+        client = MagicMock()
+        RESTBackend(client).publish(DOI, copy.deepcopy(constants.XML_DICT), 'url')
+        assert client.put_doi.call_count == 1
+        doi, data = client.put_doi.call_args.args
+        assert doi == DOI
+        assert data['type'] == 'dois'
+        assert data['attributes']['doi'] == DOI
+        assert data['attributes']['url'] == 'url'
+        assert data['attributes']['event'] == 'publish'
+        assert data['attributes']['titles'] == constants.XML_DICT['titles']
+
+    def test_get_canonical(self):
+        attributes = returned(to_attributes(constants.XML_DICT))
+        client = MagicMock(get_metadata=MagicMock(return_value=attributes))
+        assert RESTBackend(client).get_canonical(DOI) == canonical_metadata(
+            constants.XML_DICT
+        )
+
+    def test_get_canonical_not_found(self):
+        client = MagicMock(get_metadata=MagicMock(side_effect=DataCiteNotFoundError()))
+        assert RESTBackend(client).get_canonical(DOI) is None
+
+    def test_drafts_have_no_url(self):
+        attributes = returned(to_attributes(constants.XML_DICT))
+        attributes['url'] = 'url'
+        client = MagicMock(get_metadata=MagicMock(return_value=attributes))
+        assert RESTBackend(client).get_url(DOI) is None
+        attributes['state'] = 'findable'
+        assert RESTBackend(client).get_url(DOI) == 'url'
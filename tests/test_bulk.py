@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from ckanext.doi.lib.bulk import Checkpoint, DOIUpdater, load_packages
+from ckanext.doi.lib.publish import SKIPPED
+
+
+class TestCheckpoint:
+    def test_last_only_moves_past_finished_dois(self, tmp_path):
+        checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+        for doi in ['a', 'b', 'c']:
+            checkpoint.started(doi)
+        checkpoint.finished('b')
+        assert checkpoint.last is None
+        checkpoint.finished('a')
+        assert checkpoint.last == 'b'
+        checkpoint.finished('c', failed=True)
+        assert checkpoint.last == 'c'
+        assert checkpoint.failed == {'c'}
+
+    def test_save_and_load(self, tmp_path):
+        path = str(tmp_path / 'checkpoint.json')
+        checkpoint = Checkpoint(path)
+        for doi in ['a', 'b']:
+            checkpoint.started(doi)
+        checkpoint.finished('a', failed=True)
+        checkpoint.save()
+
+        loaded = Checkpoint(path).load()
+        assert loaded.last == 'a'
+        assert loaded.failed == {'a'}
+        assert not loaded.complete
+
+    def test_saves_periodically(self, tmp_path):
+        path = tmp_path / 'checkpoint.json'
+        checkpoint = Checkpoint(str(path), save_every=2)
+        checkpoint.started('a')
+        checkpoint.started('b')
+        checkpoint.finished('a')
+        assert not path.exists()
+        checkpoint.finished('b')
+        assert Checkpoint(str(path)).load().last == 'b'
+
+    def test_finish_run(self, tmp_path):
+        path = str(tmp_path / 'checkpoint.json')
+        checkpoint = Checkpoint(path)
+        checkpoint.started('a')
+        checkpoint.finished('a')
+        checkpoint.finish_run()
+        assert Checkpoint(path).load().complete
+
+    def test_retried(self, tmp_path):
+        checkpoint = Checkpoint(str(tmp_path / 'checkpoint.json'))
+        checkpoint.failed = {'a', 'b'}
+        checkpoint.last = 'z'
+        checkpoint.retried('a')
+        checkpoint.retried('b', failed=True)
+        assert checkpoint.failed == {'b'}
+        assert checkpoint.last == 'z'
+
+    def test_load_missing_file(self, tmp_path):
+        checkpoint = Checkpoint(str(tmp_path / 'nope.json')).load()
+        assert checkpoint.last is None
+        assert checkpoint.failed == set()
+
+
+class TestLoadPackages:
+    def test_one_search_for_all_packages(self):
+        results = [{'id': 'a', 'title': 'A'}, {'id': 'b', 'title': 'B'}]
+        mock_search = MagicMock(return_value={'results': results, 'count': 2})
+        with patch('ckan.plugins.toolkit.get_action', return_value=mock_search):
+            pkg_dicts = load_packages(['a', 'b', 'c'])
+        assert mock_search.call_count == 1
+        data_dict = mock_search.call_args.args[1]
+        assert data_dict['fq'] == 'id:("a" OR "b" OR "c")'
+        assert data_dict['rows'] == 3
+        assert pkg_dicts == {'a': results[0], 'b': results[1]}
+
+    def test_no_packages(self):
+        with patch('ckan.plugins.toolkit.get_action') as mock_get_action:
+            assert load_packages([]) == {}
+        assert not mock_get_action.called
+
+
+class TestDOIUpdaterLoading:
+    def test_packages_loaded_in_batches(self):
+        records = [
+            MagicMock(identifier=f'10.4124/{i}', package_id=str(i), published=None)
+            for i in range(5)
+        ]
+        with patch('ckanext.doi.lib.bulk.get_client'), patch(
+            'ckanext.doi.lib.bulk.load_packages',
+            side_effect=lambda ids: {i: {'id': i} for i in ids},
+        ) as mock_load:
+            updater = DOIUpdater(batch_size=2)
+            items = list(updater._load(records))
+        assert [len(c.args[0]) for c in mock_load.call_args_list] == [2, 2, 1]
+        assert [item[3] for item in items] == [{'id': str(i)} for i in range(5)]
+
+    def test_indexed_packages_get_doi_details(self):
+        with patch('ckanext.doi.lib.bulk.get_client'), patch(
+            'ckan.plugins.toolkit.get_action'
+        ) as mock_get_action:
+            updater = DOIUpdater()
+            task = MagicMock(
+                item=('10.4124/abc', 'a', datetime(2020, 1, 2), {'id': 'a'})
+            )
+            updater.load_package(task)
+        # it was in the search results so it shouldn't be loaded again
+        assert not mock_get_action.called
+        assert task.pkg_dict['doi'] == '10.4124/abc'
+        assert task.pkg_dict['doi_date_published'] == '2020-01-02'
+
+    def test_missing_packages_loaded_individually(self):
+        with patch('ckanext.doi.lib.bulk.get_client'), patch(
+            'ckan.plugins.toolkit.get_action'
+        ) as mock_get_action:
+            mock_get_action.return_value.return_value = {'id': 'a', 'private': True}
+            updater = DOIUpdater()
+            task = MagicMock(item=('10.4124/abc', 'a', datetime(2020, 1, 2), None))
+            updater.load_package(task)
+        mock_get_action.assert_called_with('package_show')
+        task.finish.assert_called_with(SKIPPED, 'is inactive or private; ignoring')
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from ckanext.doi.lib.cache import MISSING, TTLCache
+
+from .helpers.timer import FakeTimer
+
+
+class TestTTLCache:
+    def test_get_and_set(self):
+        cache = TTLCache(10, 60)
+        assert cache.get('a') is MISSING
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+
+    def test_caches_none(self):
+        cache = TTLCache(10, 60)
+        cache.set('a', None)
+        assert cache.get('a') is None
+
+    def test_expiry(self):
+        timer = FakeTimer()
+        cache = TTLCache(10, 60, timer=timer)
+        cache.set('a', 1)
+        timer.now = 59
+        assert cache.get('a') == 1
+        timer.now = 60
+        assert cache.get('a') is MISSING
+        assert len(cache) == 0
+
+    def test_least_recently_used_dropped(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # use a so that b is the least recently used
+        cache.get('a')
+        cache.set('c', 3)
+        assert cache.get('b') is MISSING
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_invalidate(self):
+        cache = TTLCache(10, 60)
+        cache.set('a', 1)
+        cache.invalidate('a')
+        cache.invalidate('not-there')
+        assert cache.get('a') is MISSING
+
+    def test_disabled(self):
+        cache = TTLCache(10, 0)
+        cache.set('a', 1)
+        assert cache.get('a') is MISSING
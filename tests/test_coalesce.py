@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import uuid
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.doi.lib.coalesce import SyncLock, claim_pending
+from ckanext.doi.lib.helpers import doi_coalesce_window
+from ckanext.doi.lib.publish import UNCHANGED, enqueue_publish, publish_package_job
+
+
+@pytest.fixture
+def package_id():
+    package_id = str(uuid.uuid4())
+    yield package_id
+    conn = connect_to_redis()
+    for kind in ('pending', 'synced', 'lock'):
+        conn.delete(f'ckanext-doi:{kind}:{package_id}')
+
+
+class TestClaimPending:
+    def test_once(self, package_id):
+        assert claim_pending(package_id)
+        assert not claim_pending(package_id)
+
+
+class TestSyncLock:
+    def test_not_synced(self, package_id):
+        lock = SyncLock(package_id, 10)
+        assert lock.acquire(blocking=False)
+        lock.release()
+
+    def test_recently_synced(self, package_id):
+        with SyncLock(package_id, 10):
+            pass
+        assert not SyncLock(package_id, 10).acquire(blocking=False)
+
+    def test_not_synced_if_failed(self, package_id):
+        with pytest.raises(ValueError):
+            with SyncLock(package_id, 10):
+                raise ValueError()
+        lock = SyncLock(package_id, 10)
+        assert lock.acquire(blocking=False)
+        lock.release()
+
+    def test_pending(self, package_id):
+        claim_pending(package_id)
+        assert not SyncLock(package_id, 10).acquire(blocking=False)
+
+    def test_locked(self, package_id):
+        with SyncLock(package_id, 0):
+            assert not SyncLock(package_id, 0).acquire(blocking=False)
+
+    def test_waits_for_window(self, package_id):
+        with SyncLock(package_id, 10):
+            pass
+        claim_pending(package_id)
+        # the window has passed by the time the sleep returns
+        sleep = MagicMock(
+            side_effect=lambda _: connect_to_redis().delete(
+                f'ckanext-doi:synced:{package_id}'
+            )
+        )
+        lock = SyncLock(package_id, 10, sleep=sleep)
+        with patch.object(lock._lock, 'acquire', wraps=lock._lock.acquire) as acquire:
+            with lock:
+                # the pending job is now running so later updates need another one
+                assert claim_pending(package_id)
+                # the lock isn't taken until the window has passed
+                assert sleep.call_count == 1
+                assert acquire.call_count == 1
+        wait = sleep.call_args.args[0]
+        assert 9 < wait <= 10
+
+    @patch('ckanext.doi.lib.coalesce.LOCK_TIMEOUT', 0.1)
+    def test_timed_out(self, package_id):
+        with SyncLock(package_id, 0):
+            claim_pending(package_id)
+            with pytest.raises(TimeoutError):
+                with SyncLock(package_id, 10):
+                    pass
+        # a later update can queue another job
+        assert claim_pending(package_id)
+
+
+class TestCoalescing:
+    # marks on the class would override the ones on the methods, so each test sets the
+    # window itself
+    @pytest.mark.ckan_config('ckanext.doi.coalesce_window', '10')
+    @patch('ckanext.doi.lib.publish.toolkit.enqueue_job')
+    def test_one_job_queued(self, mock_enqueue, package_id):
+        enqueue_publish(package_id)
+        assert enqueue_publish(package_id) is None
+        assert mock_enqueue.call_count == 1
+
+    @pytest.mark.ckan_config('ckanext.doi.coalesce_window', '10')
+    @patch('ckanext.doi.lib.publish.toolkit.enqueue_job')
+    @patch('ckanext.doi.lib.publish.publish_package', return_value=(None, UNCHANGED))
+    def test_job_clears_pending(self, mock_publish, mock_enqueue, package_id):
+        enqueue_publish(package_id)
+        with patch('ckanext.doi.lib.coalesce.time.sleep'):
+            publish_package_job(package_id)
+        mock_publish.assert_called_once_with(package_id)
+        enqueue_publish(package_id)
+        assert mock_enqueue.call_count == 2
+
+    @pytest.mark.ckan_config('ckanext.doi.coalesce_window', '10')
+    @patch('ckanext.doi.lib.coalesce.LOCK_TIMEOUT', 0.1)
+    @patch('ckanext.doi.lib.publish.toolkit.enqueue_job')
+    @patch('ckanext.doi.lib.publish.publish_package')
+    def test_job_timed_out(self, mock_publish, mock_enqueue, package_id):
+        enqueue_publish(package_id)
+        with SyncLock(package_id, 0):
+            publish_package_job(package_id)
+        mock_publish.assert_not_called()
+        # the job queued another one to sync the update later
+        assert mock_enqueue.call_count == 2
+        # and later updates are left to that job
+        assert enqueue_publish(package_id) is None
+        assert mock_enqueue.call_count == 2
+
+    @pytest.mark.ckan_config('ckanext.doi.coalesce_window', '300')
+    def test_window_too_long(self):
+        with pytest.raises(ValueError):
+            doi_coalesce_window()
+
+    @pytest.mark.ckan_config('ckanext.doi.coalesce_window', '0')
+    @patch('ckanext.doi.lib.publish.toolkit.enqueue_job')
+    def test_disabled(self, mock_enqueue, package_id):
+        enqueue_publish(package_id)
+        enqueue_publish(package_id)
+        assert mock_enqueue.call_count == 2
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import copy
+
+from ckanext.doi.lib.compare import (
+    FieldChange,
+    canonical_metadata,
+    canonical_xml,
+    diff_metadata,
+    format_changes,
+    metadata_fingerprint,
+)
+from ckanext.doi.lib.serialisation import to_xml
+
+from .helpers import constants
+
+
+def with_dates(xml_dict, updated):
+    xml_dict = copy.deepcopy(xml_dict)
+    xml_dict['dates'] = [
+        {'dateType': 'Created', 'date': '2020-11-09 17:14:06.700561'},
+        {'dateType': 'Updated', 'date': updated},
+    ]
+    return xml_dict
+
+
+class TestFingerprint:
+    def test_same_metadata(self):
+        assert metadata_fingerprint(constants.XML_DICT) == metadata_fingerprint(
+            copy.deepcopy(constants.XML_DICT)
+        )
+
+    def test_ignores_identifier(self):
+        xml_dict = copy.deepcopy(constants.XML_DICT)
+        del xml_dict['identifiers']
+        assert metadata_fingerprint(constants.XML_DICT) == metadata_fingerprint(
+            xml_dict
+        )
+
+    def test_ignores_updated_date(self):
+        first = with_dates(constants.XML_DICT, '2020-11-09 17:14:07.225364')
+        second = with_dates(constants.XML_DICT, '2021-01-01 00:00:00')
+        assert metadata_fingerprint(first) == metadata_fingerprint(second)
+
+    def test_different_metadata(self):
+        xml_dict = copy.deepcopy(constants.XML_DICT)
+        xml_dict['titles'] = [{'title': 'A different title'}]
+        assert metadata_fingerprint(constants.XML_DICT) != metadata_fingerprint(
+            xml_dict
+        )
+
+    def test_ignores_order_of_unordered_fields(self):
+        first = copy.deepcopy(constants.XML_DICT)
+        first['formats'] = ['text/csv', 'image/png']
+        first['subjects'] = [{'subject': 'a'}, {'subject': 'b'}]
+        second = copy.deepcopy(constants.XML_DICT)
+        second['formats'] = ['image/png', 'text/csv']
+        second['subjects'] = [{'subject': 'b'}, {'subject': 'a'}]
+        assert metadata_fingerprint(first) == metadata_fingerprint(second)
+
+    def test_respects_order_of_ordered_fields(self):
+        first = copy.deepcopy(constants.XML_DICT)
+        first['creators'] = [{'name': 'a'}, {'name': 'b'}]
+        second = copy.deepcopy(constants.XML_DICT)
+        second['creators'] = [{'name': 'b'}, {'name': 'a'}]
+        assert metadata_fingerprint(first) != metadata_fingerprint(second)
+
+    def test_ignores_values_that_are_not_posted(self):
+        xml_dict = copy.deepcopy(constants.XML_DICT)
+        xml_dict['schemaVersion'] = 'http://datacite.org/schema/kernel-4'
+        xml_dict['version'] = ''
+        assert metadata_fingerprint(constants.XML_DICT) == metadata_fingerprint(
+            xml_dict
+        )
+
+
+class TestDiff:
+    def test_same(self):
+        posted = with_dates(constants.XML_DICT, '2020-11-09 17:14:07.225364')
+        new = with_dates(constants.XML_DICT, '2021-01-01 00:00:00')
+        new['identifiers'] = []
+        assert (
+            diff_metadata(canonical_xml(to_xml(posted)), canonical_metadata(new)) == []
+        )
+
+    def test_unordered_fields(self):
+        posted = copy.deepcopy(constants.XML_DICT)
+        posted['formats'] = ['text/csv', 'image/png']
+        new = copy.deepcopy(constants.XML_DICT)
+        new['formats'] = ['image/png', 'application/json', 'text/csv']
+        changes = diff_metadata(canonical_xml(to_xml(posted)), canonical_metadata(new))
+        assert changes == [FieldChange('formats', [], ['application/json'])]
+
+    def test_ordered_fields(self):
+        posted = copy.deepcopy(constants.XML_DICT)
+        posted['creators'] = [{'name': 'a'}, {'name': 'b'}]
+        new = copy.deepcopy(constants.XML_DICT)
+        new['creators'] = [{'name': 'b'}, {'name': 'a'}]
+        changes = diff_metadata(canonical_metadata(posted), canonical_metadata(new))
+        assert changes == [
+            FieldChange(
+                'creators',
+                [{'name': 'a'}, {'name': 'b'}],
+                [{'name': 'b'}, {'name': 'a'}],
+            )
+        ]
+
+    def test_added_and_removed_fields(self):
+        posted = copy.deepcopy(constants.XML_DICT)
+        posted['version'] = '1'
+        posted['formats'] = ['text/csv']
+        new = copy.deepcopy(constants.XML_DICT)
+        new['language'] = 'en'
+        changes = diff_metadata(canonical_metadata(posted), canonical_metadata(new))
+        assert changes == [
+            FieldChange('formats', ['text/csv'], []),
+            FieldChange('language', [], ['en']),
+            FieldChange('version', ['1'], []),
+        ]
+
+    def test_format_changes(self):
+        changes = [
+            FieldChange('formats', ['text/csv'], ['image/png']),
+            FieldChange('titles', [], [{'title': 'New'}]),
+        ]
+        assert (
+            format_changes(changes)
+            == 'formats: -"text/csv" +"image/png"; titles: +{"title":"New"}'
+        )
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import copy
+import threading
+from unittest.mock import patch
+
+import pytest
+from datacite.errors import (
+    DataCiteBadRequestError,
+    DataCiteNotFoundError,
+    DataCitePreconditionError,
+    DataCiteServerError,
+    DataCiteUnauthorizedError,
+    HttpError,
+)
+
+from ckanext.doi.lib.api import DataciteClient, get_client
+from ckanext.doi.lib.errors import DataCiteUnavailableError
+from ckanext.doi.lib.http import PooledDataCiteRESTClient
+from ckanext.doi.lib.serialisation import to_xml
+
+from .helpers import constants
+
+DOI = '10.4124/abcd1234'
+
+
+def xml_dict(doi=DOI):
+    xml_dict = copy.deepcopy(constants.XML_DICT)
+    xml_dict['identifiers'] = [{'identifierType': 'DOI', 'identifier': doi}]
+    xml_dict['dates'] = [{'dateType': 'Created', 'date': '2020-01-01'}]
+    return xml_dict
+
+
+@patch('ckanext.doi.lib.api.DOIQuery')
+class TestAgainstServer:
+    def test_publish(self, mock_crud, datacite_server):
+        client = DataciteClient()
+        assert client.is_unused(DOI)
+        client.set_metadata(DOI, xml_dict())
+        client.mint_doi(DOI, 'some-package')
+
+        assert not client.is_unused(DOI)
+        assert datacite_server.dois[DOI].url.endswith('/dataset/some-package')
+        assert client.check_for_update(DOI, xml_dict(), verify_remote=True)
+
+        changed = xml_dict()
+        changed['titles'] = [{'title': 'A new title'}]
+        assert not client.check_for_update(DOI, changed, verify_remote=True)
+
+    def test_mint_before_metadata(self, mock_crud, datacite_server):
+        with pytest.raises(DataCitePreconditionError):
+            DataciteClient().mint_doi(DOI, 'some-package')
+
+    def test_bad_credentials(self, mock_crud, datacite_server):
+        datacite_server.password = 'something else'
+        try:
+            with pytest.raises(DataCiteUnauthorizedError):
+                DataciteClient().set_metadata(DOI, xml_dict())
+        finally:
+            datacite_server.password = 'password'
+
+    def test_list_dois(self, mock_crud, datacite_server):
+        client = DataciteClient()
+        assert list(client.list_dois()) == []
+        for i in range(3):
+            client.set_metadata(f'10.4124/doi{i}', xml_dict(f'10.4124/doi{i}'))
+            client.mint_doi(f'10.4124/doi{i}', f'package-{i}')
+        # metadata only, so not minted
+        client.set_metadata(DOI, xml_dict())
+        assert sorted(client.list_dois()) == [f'10.4124/doi{i}' for i in range(3)]
+        assert client.get_url('10.4124/doi0') == client.permalink('package-0')
+        assert client.get_url(DOI) is None
+        client.set_url('10.4124/doi0', 'package-9')
+        assert client.get_url('10.4124/doi0') == client.permalink('package-9')
+
+    def test_deleted_metadata(self, mock_crud, datacite_server):
+        client = DataciteClient()
+        client.set_metadata(DOI, xml_dict())
+        client.client.metadata_delete(DOI)
+        # DataCite says gone rather than not found, so the DOI is still in use
+        assert not client.is_unused(DOI)
+        with pytest.raises(DataCiteNotFoundError):
+            client.client.metadata_delete('10.4124/notreal')
+
+    def test_connections_are_reused(self, mock_crud, datacite_server):
+        client = get_client()
+        for i in range(20):
+            client.set_metadata(f'10.4124/doi{i}', xml_dict(f'10.4124/doi{i}'))
+        assert datacite_server.requests[('POST', 'metadata')] == 20
+        assert datacite_server.connections == 1
+
+    def test_concurrent_requests(self, mock_crud, datacite_server):
+        datacite_server.latency = 0.05
+        client = get_client()
+        errors = []
+
+        def post(i):
+            try:
+                client.set_metadata(f'10.4124/doi{i}', xml_dict(f'10.4124/doi{i}'))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert len(datacite_server.dois) == 10
+
+    @pytest.mark.ckan_config('ckanext.doi.timeout.read', '0.1')
+    def test_timeout(self, mock_crud, datacite_server):
+        datacite_server.latency = 0.5
+        with pytest.raises(HttpError):
+            DataciteClient().set_metadata(DOI, xml_dict())
+
+    def test_requests_from_before_reset_ignored(self, mock_crud, datacite_server):
+        # a request which was still being handled when the server was reset
+        generation = datacite_server._record_request('POST', '/metadata')
+        datacite_server.reset()
+        status, _ = datacite_server._dispatch(
+            'POST', 'metadata', to_xml(xml_dict()), {}, generation
+        )
+        assert status == 503
+        assert not datacite_server.dois
+
+    @pytest.mark.ckan_config('ckanext.doi.retry.backoff', '0.01')
+    def test_outage(self, mock_crud, datacite_server):
+        datacite_server.outage = True
+        with pytest.raises(DataCiteServerError):
+            DataciteClient().set_metadata(DOI, xml_dict())
+        # the first attempt and two retries
+        assert datacite_server.requests[('POST', 'metadata')] == 3
+
+    @pytest.mark.ckan_config('ckanext.doi.retry.backoff', '0.01')
+    def test_errors(self, mock_crud, datacite_server):
+        datacite_server.error_rate = 1
+        with pytest.raises(DataCiteServerError):
+            DataciteClient().set_metadata(DOI, xml_dict())
+
+    @pytest.mark.ckan_config('ckanext.doi.retry.backoff', '0.01')
+    @pytest.mark.ckan_config('ckanext.doi.retry.attempts', '10')
+    @pytest.mark.ckan_config('ckanext.doi.breaker.threshold', '0')
+    def test_intermittent_errors(self, mock_crud, datacite_server):
+        datacite_server.error_rate = 0.5
+        client = DataciteClient()
+        for i in range(5):
+            client.set_metadata(f'10.4124/doi{i}', xml_dict(f'10.4124/doi{i}'))
+        assert len(datacite_server.dois) == 5
+
+    @pytest.mark.ckan_config('ckanext.doi.retry.backoff', '0.01')
+    @pytest.mark.ckan_config('ckanext.doi.breaker.threshold', '3')
+    def test_circuit_breaker(self, mock_crud, datacite_server):
+        datacite_server.outage = True
+        client = DataciteClient()
+        with pytest.raises(DataCiteServerError):
+            client.set_metadata(DOI, xml_dict())
+        # DataCite isn't asked again until the breaker has been open for a while
+        with pytest.raises(DataCiteUnavailableError):
+            client.set_metadata(DOI, xml_dict())
+        assert datacite_server.requests[('POST', 'metadata')] == 3
+
+    @pytest.mark.ckan_config('ckanext.doi.retry.attempts', '0')
+    def test_rate_limit(self, mock_crud, datacite_server):
+        datacite_server.rate_limit = 3
+        client = DataciteClient()
+        for i in range(3):
+            client.set_metadata(f'10.4124/doi{i}', xml_dict(f'10.4124/doi{i}'))
+        with pytest.raises(DataCiteServerError):
+            client.set_metadata(DOI, xml_dict())
+
+    def test_rate_limit_retried(self, mock_crud, datacite_server):
+        datacite_server.rate_limit = 3
+        client = DataciteClient()
+        for i in range(4):
+            client.set_metadata(f'10.4124/doi{i}', xml_dict(f'10.4124/doi{i}'))
+        assert len(datacite_server.dois) == 4
+
+
+@pytest.mark.ckan_config('ckanext.doi.api', 'rest')
+@patch('ckanext.doi.lib.api.DOIQuery')
+class TestRESTAgainstServer:
+    def test_publish(self, mock_crud, datacite_server):
+        client = DataciteClient()
+        assert client.is_unused(DOI)
+        client.publish_doi(DOI, 'some-package', xml_dict())
+
+        # created, registered and given its metadata in one go
+        assert datacite_server.requests[('PUT', 'dois')] == 1
+        assert not client.is_unused(DOI)
+        assert client.get_url(DOI) == client.permalink('some-package')
+        assert mock_crud.record_mint.call_count == 1
+        assert client.check_for_update(DOI, xml_dict(), verify_remote=True)
+
+        changed = xml_dict()
+        changed['titles'] = [{'title': 'A new title'}]
+        assert not client.check_for_update(DOI, changed, verify_remote=True)
+        client.set_metadata(DOI, changed)
+        assert client.check_for_update(DOI, changed, verify_remote=True)
+
+    def test_draft_then_mint(self, mock_crud, datacite_server):
+        client = DataciteClient()
+        client.set_metadata(DOI, xml_dict())
+        assert not client.is_unused(DOI)
+        assert client.get_url(DOI) is None
+        client.mint_doi(DOI, 'some-package')
+        assert client.get_url(DOI) == client.permalink('some-package')
+
+    def test_mint_before_metadata(self, mock_crud, datacite_server):
+        with pytest.raises(DataCiteBadRequestError):
+            DataciteClient().mint_doi(DOI, 'some-package')
+
+    def test_bad_credentials(self, mock_crud, datacite_server):
+        datacite_server.password = 'something else'
+        try:
+            with pytest.raises(DataCiteUnauthorizedError):
+                DataciteClient().publish_doi(DOI, 'some-package', xml_dict())
+        finally:
+            datacite_server.password = 'password'
+
+    @patch.object(PooledDataCiteRESTClient, 'page_size', 2)
+    def test_list_dois(self, mock_crud, datacite_server):
+        client = DataciteClient()
+        assert list(client.list_dois()) == []
+        for i in range(5):
+            client.publish_doi(
+                f'10.4124/doi{i}', f'package-{i}', xml_dict(f'10.4124/doi{i}')
+            )
+        # a draft, so not minted
+        client.set_metadata(DOI, xml_dict())
+        assert sorted(client.list_dois()) == [f'10.4124/doi{i}' for i in range(5)]
+        assert datacite_server.requests[('GET', 'dois')] == 4
+        client.set_url('10.4124/doi0', 'package-9')
+        assert client.get_url('10.4124/doi0') == client.permalink('package-9')
+
+    def test_connections_are_reused(self, mock_crud, datacite_server):
+        client = get_client()
+        for i in range(20):
+            client.publish_doi(
+                f'10.4124/doi{i}', f'package-{i}', xml_dict(f'10.4124/doi{i}')
+            )
+        assert datacite_server.requests[('PUT', 'dois')] == 20
+        assert datacite_server.connections == 1
+
+    @pytest.mark.ckan_config('ckanext.doi.retry.backoff', '0.01')
+    def test_outage(self, mock_crud, datacite_server):
+        datacite_server.outage = True
+        with pytest.raises(DataCiteServerError):
+            DataciteClient().publish_doi(DOI, 'some-package', xml_dict())
+        # the first attempt and two retries
+        assert datacite_server.requests[('PUT', 'dois')] == 3
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.doi.lib.dates import parse_date
+from ckanext.doi.lib.helpers import date_or_none, package_get_year
+
+from .helpers import constants
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    parse_date.cache_clear()
+    yield
+    parse_date.cache_clear()
+
+
+class TestParseDate:
+    @patch('ckanext.doi.lib.dates.parser.parse')
+    def test_ckan_timestamps(self, mock_parse):
+        assert parse_date('2020-11-09T17:14:06.700561') == datetime(
+            2020, 11, 9, 17, 14, 6, 700561
+        )
+        assert parse_date('2020-11-09') == datetime(2020, 11, 9)
+        assert parse_date('2020-11-09T17:14:06+01:00') == datetime(
+            2020, 11, 9, 17, 14, 6, tzinfo=timezone(timedelta(hours=1))
+        )
+        assert not mock_parse.called
+
+    def test_other_formats(self):
+        assert parse_date('9 November 2020') == datetime(2020, 11, 9)
+        assert parse_date('2020/11/09 17:14') == datetime(2020, 11, 9, 17, 14)
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            parse_date('not a date')
+
+    def test_memoised(self):
+        assert parse_date('9 November 2020') is parse_date('9 November 2020')
+        assert parse_date.cache_info().hits == 1
+
+
+def test_package_get_year_does_not_change_package():
+    pkg_dict = dict(constants.PKG_DICT)
+    assert package_get_year(pkg_dict) == 2020
+    assert pkg_dict['metadata_created'] == constants.PKG_DICT['metadata_created']
+    assert package_get_year({'metadata_created': datetime(2019, 1, 1)}) == 2019
+
+
+def test_date_or_none():
+    date = datetime(2020, 11, 9)
+    assert date_or_none(date) is date
+    assert date_or_none('2020-11-09') == date
+    assert date_or_none(None) is None
@@ -3,6 +3,7 @@
 #
 # This file is part of ckanext-doi
 # Created by the Natural History Museum in London, UK
+from datetime import datetime
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -10,6 +11,8 @@ from ckan.model import Session
 from ckan.tests import factories
 from datacite.errors import DataCiteNotFoundError
 
+from ckanext.doi.lib.cache import MISSING
+from ckanext.doi.model.crud import DOIQuery
 from ckanext.doi.model.doi import DOI
 
 
@@ -17,7 +20,7 @@ from ckanext.doi.model.doi import DOI
 @pytest.mark.ckan_config('ckan.plugins', 'doi')
 @pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
 @pytest.mark.usefixtures('with_doi_table', 'with_plugins')
-@patch('ckanext.doi.lib.api.DataCiteMDSClient')
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
 def test_doi_is_created_automatically(mock_client):
     # this test ensures that when a package is created, a DOI is created
     mock_client.return_value = MagicMock(
@@ -26,3 +29,197 @@ def test_doi_is_created_automatically(mock_client):
     package = factories.Dataset()
     found_record = Session.query(DOI).filter(DOI.package_id == package['id']).one()
     assert found_record is not None
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'doi')
+@pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
+@pytest.mark.usefixtures('with_doi_table', 'with_plugins')
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+def test_cached_record_is_invalidated(mock_client):
+    mock_client.return_value = MagicMock(
+        metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+    )
+    package = factories.Dataset()
+    DOIQuery.delete_package(package['id'])
+    # there's no DOI for this package
+    assert DOIQuery.read_package_cached(package['id']) is None
+
+    DOIQuery.create('testing/abcd1234', package['id'])
+    cached = DOIQuery.read_package_cached(package['id'])
+    assert cached.identifier == 'testing/abcd1234'
+    assert cached.published is None
+
+    DOIQuery.update_doi('testing/abcd1234', published=datetime.now())
+    assert DOIQuery.read_package_cached(package['id']).published is not None
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'doi')
+@pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
+@pytest.mark.usefixtures('with_doi_table', 'with_plugins')
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+def test_unpublished_record_not_cached(mock_client):
+    mock_client.return_value = MagicMock(
+        metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+    )
+    package = factories.Dataset()
+    DOIQuery.delete_package(package['id'])
+    assert DOIQuery.read_package_cached(package['id']) is None
+
+    # changes made by another process don't clear this process' cache
+    Session.add(DOI(identifier='testing/abcd1234', package_id=package['id']))
+    Session.commit()
+    assert DOIQuery.read_package_cached(package['id']).published is None
+
+    published = datetime(2020, 1, 1)
+    Session.query(DOI).filter(DOI.package_id == package['id']).update(
+        {'published': published}
+    )
+    Session.commit()
+    assert DOIQuery.read_package_cached(package['id']).published == published
+    # now it's published, it is cached
+    assert DOIQuery.cache().get(package['id']) is not MISSING
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'doi')
+@pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
+@pytest.mark.usefixtures('with_doi_table', 'with_plugins')
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+class TestBulkQueries:
+    def _packages(self, mock_client, count):
+        mock_client.return_value = MagicMock(
+            metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+        )
+        packages = [factories.Dataset() for _ in range(count)]
+        for package in packages:
+            DOIQuery.delete_package(package['id'])
+        return [package['id'] for package in packages]
+
+    def test_bulk_create(self, mock_client, query_counter):
+        package_ids = self._packages(mock_client, 3)
+        records = [
+            {'identifier': f'testing/{i}', 'package_id': package_id}
+            for i, package_id in enumerate(package_ids)
+        ]
+        query_counter.count = 0
+        created = DOIQuery.bulk_create(records)
+        assert query_counter.count == 1
+        assert created == {'testing/0', 'testing/1', 'testing/2'}
+
+        # existing records are ignored
+        assert DOIQuery.bulk_create(records[:1]) == set()
+
+    def test_bulk_update(self, mock_client, query_counter):
+        package_ids = self._packages(mock_client, 3)
+        records = [
+            {'identifier': f'testing/{i}', 'package_id': package_id}
+            for i, package_id in enumerate(package_ids)
+        ]
+        DOIQuery.bulk_create(records)
+        published = datetime(2020, 1, 1)
+        for record in records:
+            record['published'] = published
+
+        query_counter.count = 0
+        updated = DOIQuery.bulk_update(records)
+        assert query_counter.count == 1
+        assert updated == {'testing/0', 'testing/1', 'testing/2'}
+        assert all(
+            r.published == published for r in DOIQuery.read_dois(updated).values()
+        )
+
+    def test_bulk_update_needs_matching_keys(self, mock_client):
+        with pytest.raises(ValueError):
+            DOIQuery.bulk_update(
+                [
+                    {'identifier': 'testing/0', 'package_id': 'a'},
+                    {'identifier': 'testing/1', 'package_id': 'b', 'published': None},
+                ]
+            )
+
+    def test_read_many(self, mock_client, query_counter):
+        package_ids = self._packages(mock_client, 3)
+        DOIQuery.bulk_create(
+            [
+                {'identifier': f'testing/{i}', 'package_id': package_id}
+                for i, package_id in enumerate(package_ids)
+            ]
+        )
+
+        query_counter.count = 0
+        by_package = DOIQuery.read_packages(package_ids + ['not-a-package'])
+        assert query_counter.count == 1
+        assert set(by_package) == set(package_ids)
+
+        query_counter.count = 0
+        by_doi = DOIQuery.read_dois(['testing/0', 'testing/1', 'testing/nope'])
+        assert query_counter.count == 1
+        assert set(by_doi) == {'testing/0', 'testing/1'}
+        assert by_doi['testing/0'].package_id == package_ids[0]
+
+    def test_record_mint(self, mock_client, query_counter):
+        package_ids = self._packages(mock_client, 2)
+        published = datetime(2020, 1, 1)
+
+        # a package without a record gets one
+        query_counter.count = 0
+        record = DOIQuery.record_mint('testing/0', package_ids[0], published)
+        assert query_counter.count == 1
+        assert record == ('testing/0', package_ids[0], published)
+
+        # a package with a record for a different DOI gets pointed at the new one
+        DOIQuery.create('testing/old', package_ids[1])
+        DOIQuery.read_package_cached(package_ids[1])
+        record = DOIQuery.record_mint('testing/1', package_ids[1], published)
+        assert record.identifier == 'testing/1'
+        assert DOIQuery.read_doi('testing/old') is None
+        assert DOIQuery.read_package_cached(package_ids[1]).published == published
+
+        # a copy of the record the session has already loaded is updated too
+        loaded = DOIQuery.read_package(package_ids[1])
+        later = datetime(2020, 6, 1)
+        DOIQuery.record_mint('testing/1', package_ids[1], later)
+        assert loaded.published == later
+
+        # minting again just updates the published date
+        later = datetime(2021, 1, 1)
+        assert DOIQuery.record_mint('testing/1', package_ids[1], later).published == (
+            later
+        )
+
+    def test_stream_filters(self, mock_client):
+        package_ids = self._packages(mock_client, 4)
+        DOIQuery.bulk_create(
+            [
+                {'identifier': 'testing/0', 'package_id': package_ids[0]},
+                {
+                    'identifier': 'testing/1',
+                    'package_id': package_ids[1],
+                    'published': datetime(2020, 1, 1),
+                },
+                {
+                    'identifier': 'testing/2',
+                    'package_id': package_ids[2],
+                    'published': datetime(2022, 1, 1),
+                },
+                # the prefix must match the start of the DOI exactly
+                {'identifier': '10.1/testing/3', 'package_id': package_ids[3]},
+            ]
+        )
+
+        def identifiers(**kwargs):
+            return [r.identifier for r in DOIQuery.stream(batch_size=2, **kwargs)]
+
+        assert identifiers(prefix='testing') == ['testing/0', 'testing/1', 'testing/2']
+        assert identifiers(prefix='testin') == []
+        assert identifiers(prefix='testing', published=False) == ['testing/0']
+        assert identifiers(published=True) == ['testing/1', 'testing/2']
+        assert identifiers(published_since=datetime(2021, 1, 1)) == ['testing/2']
+
+    def test_with_prefix_escapes_wildcards(self, mock_client):
+        package_ids = self._packages(mock_client, 1)
+        DOIQuery.create('10x1/abc', package_ids[0])
+        query = Session.query(DOI).filter(DOIQuery.with_prefix('10_1'))
+        assert query.count() == 0
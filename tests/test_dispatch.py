@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from unittest.mock import patch
+
+from ckanext.doi.lib.cache import TTLCache
+from ckanext.doi.lib.dispatch import (
+    PluginChain,
+    get_plugin_chain,
+    reset_plugin_chain,
+)
+
+
+class OldPlugin:
+    """
+    A plugin written before fields could be declared (and without IDoi's defaults).
+    """
+
+    name = 'old'
+
+    def __init__(self):
+        self.calls = 0
+
+    def build_metadata_dict(self, pkg_dict, metadata_dict, errors):
+        self.calls += 1
+        metadata_dict['version'] = pkg_dict['version']
+        errors.pop('version', None)
+        return metadata_dict, errors
+
+    def build_xml_dict(self, metadata_dict, xml_dict):
+        xml_dict['version'] = metadata_dict['version']
+        return xml_dict
+
+
+class FundingPlugin:
+    name = 'funding'
+
+    def __init__(self):
+        self.calls = []
+
+    def doi_metadata_fields(self):
+        return ['funder'], ['fundingReferences']
+
+    def build_metadata_dict(self, pkg_dict, metadata_dict, errors):
+        self.calls.append((dict(pkg_dict), dict(metadata_dict), dict(errors)))
+        metadata_dict['fundingReferences'] = [{'funderName': pkg_dict['funder']}]
+        # keys it doesn't write are ignored
+        metadata_dict['titles'] = []
+        errors.pop('fundingReferences', None)
+        return metadata_dict, errors
+
+    def build_xml_dict(self, metadata_dict, xml_dict):
+        return xml_dict
+
+
+def make_chain(*plugins):
+    return PluginChain(plugins, cache=TTLCache(100, 60))
+
+
+def build(chain, pkg_dict):
+    metadata_dict = {'titles': [{'title': 'A title'}], 'fundingReferences': []}
+    errors = {'fundingReferences': Exception('no funder')}
+    return chain.build_metadata_dict(pkg_dict, metadata_dict, errors)
+
+
+class TestPluginChain:
+    def test_undeclared_plugins_get_everything(self):
+        plugin = OldPlugin()
+        chain = make_chain(plugin)
+        pkg_dict = {'version': '2', 'funder': 'NHM'}
+        metadata_dict, errors = chain.build_metadata_dict(
+            pkg_dict, {}, {'version': Exception()}
+        )
+        build(chain, {'version': '2'})
+        assert metadata_dict == {'version': '2'}
+        assert errors == {}
+        assert plugin.calls == 2
+        assert chain.build_xml_dict(metadata_dict, {}) == {'version': '2'}
+
+    def test_declared_plugins_get_their_fields(self):
+        plugin = FundingPlugin()
+        chain = make_chain(plugin)
+        metadata_dict, errors = build(chain, {'funder': 'NHM', 'notes': 'ignored'})
+        pkg_view, metadata_view, errors_view = plugin.calls[0]
+        assert pkg_view == {'funder': 'NHM'}
+        assert metadata_view == {'fundingReferences': []}
+        assert list(errors_view) == ['fundingReferences']
+        assert metadata_dict == {
+            'titles': [{'title': 'A title'}],
+            'fundingReferences': [{'funderName': 'NHM'}],
+        }
+        assert errors == {}
+
+    def test_declared_plugins_skipped_if_unchanged(self):
+        plugin = FundingPlugin()
+        chain = make_chain(plugin)
+        first, _ = build(chain, {'funder': 'NHM', 'notes': 'one'})
+        second, errors = build(chain, {'funder': 'NHM', 'notes': 'two'})
+        assert len(plugin.calls) == 1
+        assert second == first
+        assert errors == {}
+        # the cached result isn't shared
+        second['fundingReferences'].append({'funderName': 'Other'})
+        third, _ = build(chain, {'funder': 'NHM'})
+        assert third == first
+
+        build(chain, {'funder': 'Someone else'})
+        assert len(plugin.calls) == 2
+
+    def test_order_kept(self):
+        old = OldPlugin()
+        funding = FundingPlugin()
+        chain = make_chain(funding, old)
+        metadata_dict, _ = build(chain, {'funder': 'NHM', 'version': '3'})
+        assert metadata_dict['version'] == '3'
+        assert metadata_dict['fundingReferences'] == [{'funderName': 'NHM'}]
+
+
+@patch('ckanext.doi.lib.dispatch.PluginImplementations')
+def test_shared_chain(mock_implementations):
+    mock_implementations.return_value = [OldPlugin()]
+    reset_plugin_chain()
+    try:
+        assert get_plugin_chain() is get_plugin_chain()
+        assert mock_implementations.call_count == 1
+        reset_plugin_chain()
+        get_plugin_chain()
+        assert mock_implementations.call_count == 2
+    finally:
+        reset_plugin_chain()
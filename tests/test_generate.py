@@ -4,10 +4,19 @@
 # This file is part of ckanext-doi
 # Created by the Natural History Museum in London, UK
 
+from unittest.mock import MagicMock, patch
+
 import pytest
+from ckan.model import Package
 from datacite import schema42
 
-from ckanext.doi.lib.metadata import build_metadata_dict, build_xml_dict
+from ckanext.doi.lib.metadata import (
+    MetadataContext,
+    build_metadata_dict,
+    build_xml_dict,
+    clear_metadata_context,
+    get_metadata_context,
+)
 
 from .helpers import constants
 
@@ -48,3 +57,55 @@ def test_generate_xml():
         {'identifierType': 'DOI', 'identifier': '10.0000/this-would-be-a-doi'}
     ]
     assert schema42.validate(xml_dict)
+
+
+class TestMetadataContext:
+    @pytest.mark.ckan_config('ckanext.doi.publisher', 'Example Publisher')
+    @pytest.mark.ckan_config('ckan.site_url', 'http://ckan.example/')
+    @pytest.mark.ckan_config('ckan.locale_default', 'en_GB')
+    def test_from_config(self):
+        license = MagicMock(url='http://licenses.example/cc-by', id='cc-by')
+        with patch.object(
+            Package, 'get_license_register', return_value={'cc-by': license}
+        ):
+            context = MetadataContext.from_config()
+        assert context.publisher == 'Example Publisher'
+        assert context.site_url == 'http://ckan.example'
+        assert context.language == 'en'
+        assert context.licenses == {'cc-by': ('http://licenses.example/cc-by', 'cc-by')}
+        assert context.license_error is None
+
+    @pytest.mark.ckan_config('ckanext.doi.publisher', 'Example Publisher')
+    def test_shared_and_cleared(self):
+        with patch.object(Package, 'get_license_register', return_value={}) as mock:
+            context = get_metadata_context()
+            build_metadata_dict(constants.PKG_DICT)
+            assert get_metadata_context() is context
+            assert mock.call_count == 1
+            clear_metadata_context()
+            assert get_metadata_context() is not context
+            assert mock.call_count == 2
+
+    @pytest.mark.ckan_config('ckanext.doi.context_ttl', '0')
+    def test_ttl(self):
+        assert get_metadata_context() is not get_metadata_context()
+
+    def test_uses_given_context(self):
+        context = MetadataContext(
+            'Another Publisher',
+            'http://elsewhere.example',
+            'fr',
+            {constants.PKG_DICT['license_id']: ('http://licenses.example/x', 'x')},
+        )
+        metadata_dict = build_metadata_dict(constants.PKG_DICT, context)
+        assert metadata_dict['publisher'] == 'Another Publisher'
+        assert metadata_dict['language'] == 'fr'
+        assert metadata_dict['rightsList'] == [
+            {'rightsURI': 'http://licenses.example/x', 'rightsIdentifier': 'x'}
+        ]
+
+    def test_license_error(self):
+        context = MetadataContext('Publisher', '', 'en', {}, Exception('no licenses'))
+        # rightsList is optional so the error is only logged
+        metadata_dict = build_metadata_dict(constants.PKG_DICT, context)
+        assert not metadata_dict['rightsList']
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import os
+import socket
+
+import pytest
+
+from ckanext.doi.lib import metrics
+from ckanext.doi.lib.helpers import doi_metrics_sinks, doi_prometheus_path
+from ckanext.doi.lib.metrics import (
+    LogSink,
+    PrometheusSink,
+    StatsdSink,
+    count,
+    reset_metrics,
+    set_sinks,
+    timed,
+)
+
+from .helpers.timer import FakeTimer
+
+
+class RecordingSink:
+    def __init__(self):
+        self.timings = []
+        self.counts = []
+
+    def timing(self, operation, seconds, tags):
+        self.timings.append((operation, seconds, dict(tags)))
+
+    def count(self, operation, tags):
+        self.counts.append((operation, dict(tags)))
+
+    def flush(self):
+        pass
+
+
+@pytest.fixture
+def sink():
+    recording_sink = RecordingSink()
+    set_sinks([recording_sink])
+    yield recording_sink
+    reset_metrics()
+
+
+class TestTimed:
+    def test_records_timing(self, sink):
+        with timed('datacite.metadata_post'):
+            pass
+        assert len(sink.timings) == 1
+        operation, seconds, tags = sink.timings[0]
+        assert operation == 'datacite.metadata_post'
+        assert seconds >= 0
+        assert tags == {'result': 'ok'}
+
+    def test_tags(self, sink):
+        with timed('check_for_update', source='local') as timer:
+            timer.tag(result='same')
+        assert sink.timings[0][2] == {'result': 'same', 'source': 'local'}
+
+    def test_error(self, sink):
+        with pytest.raises(ValueError):
+            with timed('validate'):
+                raise ValueError()
+        assert sink.timings[0][2]['result'] == 'error'
+
+    def test_count(self, sink):
+        count('update_doi', 'updated')
+        assert sink.counts == [('update_doi', {'result': 'updated'})]
+
+    def test_disabled(self):
+        set_sinks([])
+        try:
+            timer = timed('validate')
+            assert timer is metrics._NULL_TIMER
+            with timer:
+                timer.tag(result='anything')
+            count('update_doi', 'updated')
+        finally:
+            reset_metrics()
+
+
+class TestConfig:
+    @pytest.mark.ckan_config('ckanext.doi.metrics', '')
+    def test_no_sinks(self):
+        reset_metrics()
+        assert metrics.get_sinks() == []
+
+    @pytest.mark.ckan_config('ckanext.doi.metrics', 'log statsd')
+    def test_sinks(self):
+        reset_metrics()
+        try:
+            sinks = metrics.get_sinks()
+            assert [type(s) for s in sinks] == [LogSink, StatsdSink]
+        finally:
+            reset_metrics()
+
+    @pytest.mark.ckan_config('ckanext.doi.metrics', 'log graphite')
+    def test_unknown_sink(self):
+        with pytest.raises(ValueError, match='graphite'):
+            doi_metrics_sinks()
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/var/lib/ckan')
+    def test_prometheus_file_per_process(self):
+        assert doi_prometheus_path() == '/var/lib/ckan/ckanext_doi.{pid}.prom'
+
+
+class TestLogSink:
+    def test_lines(self, caplog):
+        sink = LogSink()
+        with caplog.at_level('INFO', logger='ckanext.doi.metrics'):
+            sink.timing('mint_doi', 0.25, {'result': 'ok'})
+            sink.count('update_doi', {'result': 'failed'})
+        assert caplog.messages == [
+            'metric=timing operation=mint_doi duration_ms=250.000 result=ok',
+            'metric=count operation=update_doi result=failed',
+        ]
+
+
+class TestStatsdSink:
+    def test_sends_datagrams(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        try:
+            sink = StatsdSink(receiver.getsockname(), 'ckanext_doi')
+            sink.timing('mint_doi', 0.5, {'result': 'ok'})
+            sink.count('update_doi', {'result': 'updated'})
+            assert receiver.recv(1024) == (
+                b'ckanext_doi.duration:500.000|ms|#operation:mint_doi,result:ok'
+            )
+            assert receiver.recv(1024) == (
+                b'ckanext_doi.total:1|c|#operation:update_doi,result:updated'
+            )
+        finally:
+            receiver.close()
+
+    def test_unreachable(self):
+        # metrics that can't be sent are dropped
+        sink = StatsdSink(('256.0.0.1', 8125), 'ckanext_doi')
+        sink.count('update_doi', {'result': 'updated'})
+
+
+class TestPrometheusSink:
+    def test_render(self, tmp_path):
+        sink = PrometheusSink(str(tmp_path / 'doi.prom'), 'ckanext_doi', 15)
+        sink.timing('validate', 0.02, {'result': 'ok'})
+        sink.timing('validate', 3, {'result': 'ok'})
+        sink.count('update_doi', {'result': 'updated'})
+        text = sink.render()
+        labels = f'operation="validate",result="ok",pid="{os.getpid()}"'
+        assert '# TYPE ckanext_doi_duration_seconds histogram' in text
+        assert f'ckanext_doi_duration_seconds_bucket{{{labels},le="0.01"}} 0' in text
+        assert f'ckanext_doi_duration_seconds_bucket{{{labels},le="0.025"}} 1' in text
+        assert f'ckanext_doi_duration_seconds_bucket{{{labels},le="5"}} 2' in text
+        assert f'ckanext_doi_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+        assert f'ckanext_doi_duration_seconds_count{{{labels}}} 2' in text
+        assert (
+            f'ckanext_doi_total{{operation="update_doi",result="updated",'
+            f'pid="{os.getpid()}"}} 1'
+        ) in text
+
+    def test_escapes_labels(self, tmp_path):
+        sink = PrometheusSink(str(tmp_path / 'doi.prom'), 'ckanext_doi', 15)
+        sink.count('update_doi', {'result': 'a "quoted"\nvalue'})
+        assert 'result="a \\"quoted\\"\\nvalue"' in sink.render()
+
+    def test_flush_interval(self, tmp_path):
+        path = tmp_path / 'doi.prom'
+        timer = FakeTimer()
+        sink = PrometheusSink(str(path), 'ckanext_doi', 15, timer=timer)
+        sink.count('update_doi', {'result': 'updated'})
+        assert not path.exists()
+        timer.now = 15
+        sink.count('update_doi', {'result': 'updated'})
+        assert f'result="updated",pid="{os.getpid()}"}} 2' in path.read_text()
+
+    def test_pid_in_path(self, tmp_path):
+        sink = PrometheusSink(str(tmp_path / 'doi-{pid}.prom'), 'ckanext_doi', 15)
+        sink.flush()
+        assert len(list(tmp_path.glob('doi-*.prom'))) == 1
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import threading
+import time
+
+from ckanext.doi.lib.pipeline import run_pipeline
+
+
+def double(task):
+    task.value = task.item * 2
+
+
+def skip_odd(task):
+    if task.item % 2:
+        task.finish('skipped')
+
+
+def fail_on_four(task):
+    if task.item == 4:
+        raise ValueError('four!')
+
+
+def done(task):
+    task.finish('done', task.value)
+
+
+def run(items, stages, **kwargs):
+    results = []
+    run_pipeline(items, stages, results.append, 'failed', **kwargs)
+    return results
+
+
+class TestRunPipeline:
+    def test_all_items_come_out(self):
+        results = run(range(50), [(double, 3), (done, 2)])
+        assert sorted(t.message for t in results) == [i * 2 for i in range(50)]
+        assert all(t.status == 'done' for t in results)
+
+    def test_finished_tasks_skip_later_stages(self):
+        results = run(range(10), [(skip_odd, 2), (double, 2), (done, 1)])
+        statuses = {t.item: t.status for t in results}
+        assert statuses == {i: 'skipped' if i % 2 else 'done' for i in range(10)}
+
+    def test_exceptions_fail_the_task(self):
+        results = run(range(10), [(fail_on_four, 2), (double, 1), (done, 1)])
+        failed = [t for t in results if t.status == 'failed']
+        assert len(failed) == 1
+        assert failed[0].item == 4
+        assert isinstance(failed[0].error, ValueError)
+        assert len(results) == 10
+
+    def test_stages_run_concurrently(self):
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow(task):
+            with lock:
+                active.append(task)
+                peak.append(len(active))
+            time.sleep(0.01)
+            with lock:
+                active.remove(task)
+            task.finish('done')
+
+        results = run(range(20), [(slow, 5)], queue_size=2)
+        assert len(results) == 20
+        assert max(peak) > 1
+
+    def test_no_items(self):
+        assert run([], [(double, 2), (done, 2)]) == []
@@ -18,7 +18,7 @@ class TestDOIPlugin:
         # this test is also here to confirm that after_dataset_create is called
         # correctly whether you are on CKAN 2.9 or CKAN 2.10.
 
-        with patch('ckanext.doi.lib.api.DataCiteMDSClient') as mock_client_class:
+        with patch('ckanext.doi.lib.api.PooledDataCiteMDSClient') as mock_client_class:
             # mock the datacite API to make it look like the DOI generated is new
             mock_client = MagicMock(
                 metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
@@ -39,7 +39,9 @@ class TestDOIPlugin:
 
         # the udpate function has flashes in it which we don't care about
         with patch('ckan.plugins.toolkit.h.flash_success'):
-            with patch('ckanext.doi.lib.api.DataCiteMDSClient') as mock_client_class:
+            with patch(
+                'ckanext.doi.lib.api.PooledDataCiteMDSClient'
+            ) as mock_client_class:
                 # mock the datacite API to make it look like the DOI generated is new
                 mock_client = MagicMock(
                     metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
@@ -66,7 +68,7 @@ class TestDOIPlugin:
         # this test is also here to confirm that after_dataset_show is called correctly
         # whether you are on CKAN 2.9 or CKAN 2.10.
 
-        with patch('ckanext.doi.lib.api.DataCiteMDSClient') as mock_client_class:
+        with patch('ckanext.doi.lib.api.PooledDataCiteMDSClient') as mock_client_class:
             # mock the datacite API to make it look like the DOI generated is new
             mock_client = MagicMock(
                 metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
@@ -83,3 +85,99 @@ class TestDOIPlugin:
         assert package['domain'] == 'dois.are.great.org'
         assert package['doi_date_published'] is None
         assert package['doi_publisher'] == 'argh!'
+
+    @pytest.mark.ckan_config('ckanext.doi.publisher', 'argh!')
+    @pytest.mark.ckan_config('ckanext.doi.publish_mode', 'async')
+    def test_after_dataset_update_async(self):
+        with patch('ckanext.doi.lib.api.PooledDataCiteMDSClient') as mock_client_class:
+            mock_client = MagicMock(
+                metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+            )
+            mock_client_class.return_value = mock_client
+
+            with patch('ckan.plugins.toolkit.enqueue_job') as mock_enqueue:
+                dataset = factories.Dataset(title='test', author='Author, Test')
+                call_action('package_patch', id=dataset['id'], title='different')
+
+                # the datacite calls should have been handed off to a job
+                assert mock_enqueue.called
+                assert mock_enqueue.call_args.args[1] == [dataset['id']]
+                assert not mock_client.metadata_post.called
+                assert not mock_client.doi_post.called
+
+    @pytest.mark.ckan_config('ckanext.doi.publisher', 'argh!')
+    def test_after_dataset_update_datacite_unavailable(self):
+        with patch('ckanext.doi.lib.api.PooledDataCiteMDSClient') as mock_client_class:
+            mock_client = MagicMock(
+                metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+            )
+            mock_client_class.return_value = mock_client
+            dataset = factories.Dataset(title='test', author='Author, Test')
+
+            with patch(
+                'ckanext.doi.plugin.get_breaker',
+                return_value=MagicMock(available=False),
+            ):
+                with patch('ckan.plugins.toolkit.h.flash_notice'):
+                    with patch('ckan.plugins.toolkit.enqueue_job') as mock_enqueue:
+                        call_action(
+                            'package_patch', id=dataset['id'], title='different'
+                        )
+
+            # the sync should have been deferred rather than waiting on datacite
+            assert mock_enqueue.called
+            assert mock_enqueue.call_args.args[1] == [dataset['id']]
+            assert not mock_client.metadata_post.called
+
+    @pytest.mark.ckan_config('ckanext.doi.publisher', 'argh!')
+    def test_after_dataset_update_irrelevant(self):
+        with patch('ckan.plugins.toolkit.h.flash_success'):
+            with patch(
+                'ckanext.doi.lib.api.PooledDataCiteMDSClient'
+            ) as mock_client_class:
+                mock_client = MagicMock(
+                    metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+                )
+                mock_client_class.return_value = mock_client
+                dataset = factories.Dataset(title='test', author='Author, Test')
+                call_action('package_patch', id=dataset['id'], title='different')
+                assert mock_client.doi_post.called
+                record = DOIQuery.read_package(dataset['id'])
+                assert record.published is not None
+                assert record.input_hash is not None
+                mock_client.reset_mock()
+
+                # extras aren't used in the metadata, so datacite isn't contacted
+                call_action(
+                    'package_patch',
+                    id=dataset['id'],
+                    extras=[{'key': 'other_extension', 'value': 'something'}],
+                )
+                assert not mock_client.method_calls
+
+                call_action('package_patch', id=dataset['id'], title='another')
+                assert mock_client.metadata_post.called
+
+    @pytest.mark.ckan_config('ckanext.doi.publisher', 'argh!')
+    @pytest.mark.ckan_config('ckanext.doi.coalesce_window', '60')
+    def test_after_dataset_update_coalesced(self):
+        with patch('ckan.plugins.toolkit.h.flash_success'):
+            with patch(
+                'ckanext.doi.lib.api.PooledDataCiteMDSClient'
+            ) as mock_client_class:
+                mock_client = MagicMock(
+                    metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+                )
+                mock_client_class.return_value = mock_client
+                dataset = factories.Dataset(title='test', author='Author, Test')
+                call_action('package_patch', id=dataset['id'], title='different')
+                assert mock_client.doi_post.called
+                mock_client.reset_mock()
+
+                with patch('ckan.plugins.toolkit.enqueue_job') as mock_enqueue:
+                    # updates soon after a sync are collected into one job
+                    for title in ('another', 'and another'):
+                        call_action('package_patch', id=dataset['id'], title=title)
+                assert mock_enqueue.call_count == 1
+                assert mock_enqueue.call_args.args[1] == [dataset['id']]
+                assert not mock_client.metadata_post.called
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from datetime import datetime
+from unittest.mock import MagicMock, call, patch
+
+from ckanext.doi.lib.publish import CREATED, SKIPPED
+from ckanext.doi.lib.reconcile import (
+    NOT_IN_DATABASE,
+    NOT_MINTED,
+    NOT_PUBLISHED,
+    OK,
+    WRONG_URL,
+    Reconciler,
+    external_sort,
+)
+
+
+def record(identifier, package_id, published=True):
+    return MagicMock(
+        identifier=identifier,
+        package_id=package_id,
+        published=datetime(2020, 1, 1) if published else None,
+    )
+
+
+def mock_client(remote_dois, urls=None):
+    client = MagicMock(prefix='10.4124')
+    client.list_dois.side_effect = lambda: iter(remote_dois)
+    client.permalink.side_effect = lambda package_id: f'http://ckan/{package_id}'
+    client.get_url.side_effect = lambda doi: (urls or {}).get(doi)
+    return client
+
+
+def reconcile(client, records, **kwargs):
+    found = []
+    with patch('ckanext.doi.lib.reconcile.get_client', return_value=client):
+        with patch('ckanext.doi.lib.reconcile.DOIQuery') as mock_crud:
+            mock_crud.stream.side_effect = lambda **kw: iter(records)
+            reconciler = Reconciler(on_result=found.append, **kwargs)
+            counts = reconciler.run()
+    return counts, {(d.category, d.identifier) for d in found}, mock_crud
+
+
+class TestExternalSort:
+    def test_in_memory(self):
+        assert list(external_sort(['c', 'a', 'b'])) == ['a', 'b', 'c']
+
+    def test_in_chunks(self):
+        lines = [f'{i:05}' for i in range(1000)][::-1]
+        assert list(external_sort(lines, chunk_size=7)) == sorted(lines)
+
+    def test_empty(self):
+        assert list(external_sort([])) == []
+
+
+class TestReconciler:
+    def test_categories(self):
+        client = mock_client(
+            ['10.4124/MATCHES', '10.4124/UNPUBLISHED', '10.4124/UNKNOWN']
+        )
+        records = [
+            record('10.4124/matches', 'a'),
+            record('10.4124/unpublished', 'b', published=False),
+            record('10.4124/notminted', 'c'),
+            record('10.4124/neverpublished', 'd', published=False),
+        ]
+        counts, found, mock_crud = reconcile(client, records)
+        assert found == {
+            (NOT_PUBLISHED, '10.4124/unpublished'),
+            (NOT_IN_DATABASE, '10.4124/unknown'),
+            (NOT_MINTED, '10.4124/notminted'),
+        }
+        assert counts[OK] == 1
+        client.list_dois.assert_called_once()
+        assert mock_crud.stream.call_args.kwargs['prefix'] == '10.4124'
+
+    def test_chunked_sort(self):
+        identifiers = [f'10.4124/doi{i:04}' for i in range(50)]
+        client = mock_client([i.upper() for i in reversed(identifiers)])
+        records = [record(i, i) for i in identifiers[::2] + identifiers[1::2]]
+        counts, found, _ = reconcile(client, records, chunk_size=8)
+        assert found == set()
+        assert counts[OK] == 50
+
+    def test_check_urls(self):
+        client = mock_client(
+            ['10.4124/RIGHT', '10.4124/WRONG'],
+            urls={
+                '10.4124/right': 'http://ckan/a',
+                '10.4124/wrong': 'http://ckan/elsewhere',
+            },
+        )
+        records = [record('10.4124/right', 'a'), record('10.4124/wrong', 'b')]
+        counts, found, _ = reconcile(client, records, check_urls=True)
+        assert found == {(WRONG_URL, '10.4124/wrong')}
+        assert counts[OK] == 1
+
+    def test_urls_not_checked_by_default(self):
+        client = mock_client(['10.4124/WRONG'])
+        reconcile(client, [record('10.4124/wrong', 'b')])
+        assert not client.get_url.called
+
+    def test_fix(self):
+        client = mock_client(
+            ['10.4124/UNPUBLISHED', '10.4124/WRONG'],
+            urls={'10.4124/wrong': 'http://ckan/elsewhere'},
+        )
+        records = [
+            record('10.4124/unpublished', 'a', published=False),
+            record('10.4124/wrong', 'b'),
+            record('10.4124/notminted', 'c'),
+        ]
+        with patch(
+            'ckanext.doi.lib.reconcile.publish_package',
+            return_value=(MagicMock(), CREATED),
+        ) as mock_publish:
+            counts, found, mock_crud = reconcile(
+                client, records, check_urls=True, fix=True
+            )
+        assert counts[NOT_PUBLISHED] == counts[NOT_MINTED] == counts[WRONG_URL] == 1
+        updates = {c.args[0]: c.kwargs for c in mock_crud.update_doi.call_args_list}
+        assert updates['10.4124/unpublished']['published'] is not None
+        assert updates['10.4124/notminted'] == {'published': None}
+        mock_publish.assert_called_once_with('c')
+        client.set_url.assert_called_once_with('10.4124/wrong', 'b')
+
+    def test_fix_fails(self):
+        client = mock_client([])
+        with patch(
+            'ckanext.doi.lib.reconcile.publish_package',
+            side_effect=Exception('package not found'),
+        ):
+            found = []
+            with patch('ckanext.doi.lib.reconcile.get_client', return_value=client):
+                with patch('ckanext.doi.lib.reconcile.DOIQuery') as mock_crud:
+                    mock_crud.stream.side_effect = lambda **kw: iter(
+                        [record('10.4124/notminted', 'c')]
+                    )
+                    Reconciler(fix=True, on_result=found.append).run()
+        assert not found[0].fixed
+        assert found[0].detail == 'package not found'
+        # the record is put back as it was
+        original = mock_crud.read_doi.return_value.published
+        assert mock_crud.update_doi.call_args_list == [
+            call('10.4124/notminted', published=None),
+            call('10.4124/notminted', published=original),
+        ]
+
+    def test_fix_skipped(self):
+        client = mock_client([])
+        with patch(
+            'ckanext.doi.lib.reconcile.publish_package',
+            return_value=(None, SKIPPED),
+        ):
+            counts, found, mock_crud = reconcile(
+                client, [record('10.4124/notminted', 'c')], fix=True
+            )
+        assert counts[NOT_MINTED] == 1
+        original = mock_crud.read_doi.return_value.published
+        assert mock_crud.update_doi.call_args_list == [
+            call('10.4124/notminted', published=None),
+            call('10.4124/notminted', published=original),
+        ]
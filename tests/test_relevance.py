@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import copy
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.doi.lib.dispatch import PluginChain
+from ckanext.doi.lib.relevance import input_snapshot, is_relevant_update
+
+from .helpers import constants
+
+
+def package():
+    pkg_dict = copy.deepcopy(constants.PKG_DICT)
+    pkg_dict['resources'] = [{'name': 'Data', 'format': 'CSV', 'size': 2048}]
+    return pkg_dict
+
+
+def chain(*fields):
+    plugins = []
+    for declared in fields:
+        plugin = MagicMock()
+        plugin.doi_metadata_fields.return_value = declared
+        plugins.append(plugin)
+    return PluginChain(plugins)
+
+
+@pytest.mark.ckan_config('ckanext.doi.publisher', 'Example Publisher')
+class TestInputSnapshot:
+    def test_irrelevant_changes(self):
+        pkg_dict = package()
+        snapshot = input_snapshot(pkg_dict)
+        pkg_dict['metadata_modified'] = '2021-01-01T00:00:00'
+        pkg_dict['extras'] = [{'key': 'other', 'value': 'thing'}]
+        pkg_dict['num_resources'] = 99
+        for resource in pkg_dict['resources']:
+            resource['name'] = 'renamed'
+        assert input_snapshot(pkg_dict) == snapshot
+
+    @pytest.mark.parametrize(
+        'change',
+        [
+            {'title': 'A new title'},
+            {'notes': 'New notes'},
+            {'license_id': 'cc-by'},
+            {'version': '2'},
+            {'tags': [{'name': 'new-tag'}]},
+            {'resources': []},
+            {'resources': [{'format': 'CSV', 'size': 4096}]},
+        ],
+    )
+    def test_relevant_changes(self, change):
+        pkg_dict = package()
+        snapshot = input_snapshot(pkg_dict)
+        pkg_dict.update(change)
+        assert input_snapshot(pkg_dict) != snapshot
+
+    def test_resource_changes(self):
+        pkg_dict = package()
+        snapshot = input_snapshot(pkg_dict)
+        pkg_dict['resources'][0]['format'] = 'XLSX'
+        assert input_snapshot(pkg_dict) != snapshot
+
+    def test_equivalent_forms(self):
+        # the dicts given to after_dataset_update and returned by package_show don't
+        # always represent the same values in the same way
+        one = {'tags': [{'name': 'b'}, {'name': 'a'}], 'resources': [{'size': 10}]}
+        two = {'tag_string': 'a,b', 'resources': [{'size': '10'}]}
+        assert input_snapshot(one) == input_snapshot(two)
+
+    def test_missing_resources(self):
+        # e.g. form edits, where the resources aren't given
+        assert input_snapshot({'resources': []}) != input_snapshot({})
+
+    def test_site_config(self):
+        snapshot = input_snapshot(constants.PKG_DICT)
+        with patch(
+            'ckanext.doi.lib.relevance.get_metadata_context',
+            return_value=MagicMock(publisher='Someone else', licenses={}),
+        ):
+            assert input_snapshot(constants.PKG_DICT) != snapshot
+
+    def test_declared_plugin_fields(self):
+        pkg_dict = package()
+        with patch(
+            'ckanext.doi.lib.relevance.get_plugin_chain',
+            return_value=chain((['funder'], ['fundingReferences'])),
+        ):
+            snapshot = input_snapshot(pkg_dict)
+            pkg_dict['funder'] = 'NHM'
+            assert input_snapshot(pkg_dict) != snapshot
+
+    def test_undeclared_plugin(self):
+        with patch(
+            'ckanext.doi.lib.relevance.get_plugin_chain',
+            return_value=chain((['funder'], ['fundingReferences']), None),
+        ):
+            assert input_snapshot(constants.PKG_DICT) is None
+
+
+@pytest.mark.ckan_config('ckanext.doi.publisher', 'Example Publisher')
+@patch('ckanext.doi.lib.relevance.count')
+@patch('ckanext.doi.lib.relevance.DOIQuery')
+class TestIsRelevantUpdate:
+    def record(self, mock_crud, published=True, input_hash=None):
+        mock_crud.read_package.return_value = MagicMock(
+            published=datetime(2020, 1, 1) if published else None,
+            input_hash=input_hash or input_snapshot(constants.PKG_DICT),
+        )
+
+    def test_unchanged(self, mock_crud, mock_count):
+        self.record(mock_crud)
+        assert not is_relevant_update(constants.PKG_DICT)
+        mock_count.assert_called_once_with('update_gate', 'skipped')
+
+    def test_changed(self, mock_crud, mock_count):
+        self.record(mock_crud, input_hash='something else')
+        assert is_relevant_update(constants.PKG_DICT)
+        mock_count.assert_called_once_with('update_gate', 'relevant')
+
+    def test_not_published(self, mock_crud, mock_count):
+        self.record(mock_crud, published=False)
+        assert is_relevant_update(constants.PKG_DICT)
+
+    def test_no_record(self, mock_crud, mock_count):
+        mock_crud.read_package.return_value = None
+        assert is_relevant_update(constants.PKG_DICT)
+
+    @pytest.mark.ckan_config('ckanext.doi.skip_irrelevant', 'false')
+    def test_disabled(self, mock_crud, mock_count):
+        self.record(mock_crud)
+        assert is_relevant_update(constants.PKG_DICT)
+        assert not mock_crud.read_package.called
+
+    @pytest.mark.ckan_config('ckanext.doi.verify_remote', 'true')
+    def test_verify_remote(self, mock_crud, mock_count):
+        self.record(mock_crud)
+        assert is_relevant_update(constants.PKG_DICT)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+from ckan.lib.redis import connect_to_redis
+from ckan.tests import factories
+from datacite.errors import DataCiteNotFoundError
+
+from ckanext.doi.lib.reservations import (
+    REFILL_KEY,
+    new_doi,
+    refill_pool,
+    refill_pool_job,
+)
+from ckanext.doi.model.crud import DOIQuery, ReservationQuery
+
+
+@pytest.fixture
+def no_refill_queued():
+    connect_to_redis().delete(REFILL_KEY)
+    yield
+    connect_to_redis().delete(REFILL_KEY)
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'doi')
+@pytest.mark.ckan_config('ckanext.doi.prefix', 'testing')
+@pytest.mark.usefixtures('with_doi_table', 'with_plugins', 'no_refill_queued')
+@patch('ckanext.doi.lib.api.PooledDataCiteMDSClient')
+class TestReservations:
+    def test_refill(self, mock_client):
+        mock_client.return_value = MagicMock(
+            metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+        )
+        assert refill_pool(5) == 5
+        assert ReservationQuery.count() == 5
+        # already full
+        assert refill_pool(5) == 0
+
+    def test_refill_skips_dois_in_use(self, mock_client):
+        mock_client.return_value = MagicMock(metadata_get=MagicMock())
+        # everything is in use on datacite
+        assert refill_pool(5) == 0
+        assert ReservationQuery.count() == 0
+
+    def test_claim(self, mock_client):
+        ReservationQuery.add(['testing/aaaaaaaa', 'testing/bbbbbbbb'])
+        claimed = {ReservationQuery.claim(), ReservationQuery.claim()}
+        assert claimed == {'testing/aaaaaaaa', 'testing/bbbbbbbb'}
+        assert ReservationQuery.claim() is None
+
+    def test_new_package_uses_pool(self, mock_client):
+        ReservationQuery.add(['testing/aaaaaaaa'])
+        dataset = factories.Dataset()
+        assert DOIQuery.read_package(dataset['id']).identifier == 'testing/aaaaaaaa'
+        # the pool was used so datacite shouldn't have been asked
+        assert not mock_client.return_value.metadata_get.called
+
+    @pytest.mark.ckan_config('ckanext.doi.reservations.size', '10')
+    def test_empty_pool_queues_refill(self, mock_client):
+        mock_client.return_value = MagicMock(
+            metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+        )
+        with patch('ckan.plugins.toolkit.enqueue_job') as mock_enqueue:
+            assert new_doi().startswith('testing/')
+        assert mock_enqueue.called
+
+    @pytest.mark.ckan_config('ckanext.doi.reservations.size', '10')
+    def test_empty_pool_queues_one_refill(self, mock_client):
+        mock_client.return_value = MagicMock(
+            metadata_get=MagicMock(side_effect=DataCiteNotFoundError())
+        )
+        with patch('ckan.plugins.toolkit.enqueue_job') as mock_enqueue:
+            new_doi()
+            new_doi()
+            assert mock_enqueue.call_count == 1
+            # once the job has run, the next claim from an empty pool queues another
+            refill_pool_job(0)
+            new_doi()
+            assert mock_enqueue.call_count == 2
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+from datacite.errors import HttpError
+
+from ckanext.doi.lib.errors import DataCiteUnavailableError
+from ckanext.doi.lib.http import PooledDataCiteRequest
+from ckanext.doi.lib.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    backoff_delay,
+    get_breaker,
+    reset_breaker,
+)
+
+from .helpers.timer import FakeTimer
+
+
+def response(status, headers=None):
+    return MagicMock(status_code=status, headers=headers or {})
+
+
+class TestBackoffDelay:
+    def test_grows_exponentially(self):
+        assert backoff_delay(0, 0.5, 10, rand=lambda: 1) == 0.5
+        assert backoff_delay(1, 0.5, 10, rand=lambda: 1) == 1
+        assert backoff_delay(3, 0.5, 10, rand=lambda: 1) == 4
+
+    def test_capped(self):
+        assert backoff_delay(10, 0.5, 10, rand=lambda: 1) == 10
+
+    def test_jitter(self):
+        assert backoff_delay(3, 0.5, 10, rand=lambda: 0.25) == 1
+
+    def test_retry_after(self):
+        assert backoff_delay(0, 0.5, 10, retry_after='3') == 3
+        assert backoff_delay(0, 0.5, 10, retry_after='120') == 10
+
+    def test_retry_after_date(self):
+        delay = backoff_delay(
+            0, 0.5, 10, retry_after='Wed, 21 Oct 2015 07:28:00 GMT', rand=lambda: 1
+        )
+        assert delay == 0.5
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(3, 30)
+        breaker.failure()
+        breaker.failure()
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == OPEN
+        assert not breaker.allow()
+        assert not breaker.available
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(2, 30)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        assert breaker.state == CLOSED
+
+    def test_half_open_trial(self):
+        timer = FakeTimer()
+        breaker = CircuitBreaker(1, 30, timer=timer)
+        breaker.failure()
+        timer.now = 29
+        assert not breaker.allow()
+        assert breaker.retry_in() == 1
+        timer.now = 30
+        assert breaker.available
+        # only one request is let through
+        assert breaker.allow()
+        assert breaker.state == HALF_OPEN
+        assert not breaker.allow()
+        breaker.success()
+        assert breaker.state == CLOSED
+        assert breaker.allow()
+
+    def test_failed_trial_reopens(self):
+        timer = FakeTimer()
+        breaker = CircuitBreaker(1, 30, timer=timer)
+        breaker.failure()
+        timer.now = 30
+        assert breaker.allow()
+        breaker.failure()
+        assert breaker.state == OPEN
+        assert breaker.retry_in() == 30
+
+    def test_disabled(self):
+        breaker = CircuitBreaker(0, 30)
+        for _ in range(100):
+            breaker.failure()
+        assert breaker.allow()
+
+    @pytest.mark.ckan_config('ckanext.doi.breaker.threshold', '7')
+    @pytest.mark.ckan_config('ckanext.doi.breaker.reset_timeout', '12')
+    def test_shared_breaker(self):
+        reset_breaker()
+        try:
+            assert get_breaker() is get_breaker()
+            assert get_breaker().threshold == 7
+            assert get_breaker().reset_timeout == 12
+        finally:
+            reset_breaker()
+
+
+@patch('ckanext.doi.lib.http.get_session')
+@patch('ckanext.doi.lib.http.get_breaker')
+class TestRetries:
+    def make_request(self, retries=2):
+        return PooledDataCiteRequest(
+            base_url='https://mds.datacite.org/',
+            username='goat!',
+            password='hammocks?',
+            retries=retries,
+            backoff=(0.5, 10),
+            sleep=MagicMock(),
+        )
+
+    def test_retries_server_errors(self, mock_get_breaker, mock_get_session):
+        mock_get_breaker.return_value = CircuitBreaker(5, 30)
+        mock_request = mock_get_session.return_value.request
+        mock_request.side_effect = [response(503), response(500), response(200)]
+        request = self.make_request()
+        assert request.get('doi/10.4124/abcd1234').status_code == 200
+        assert mock_request.call_count == 3
+        assert request.sleep.call_count == 2
+
+    def test_gives_up(self, mock_get_breaker, mock_get_session):
+        mock_get_breaker.return_value = CircuitBreaker(5, 30)
+        mock_request = mock_get_session.return_value.request
+        mock_request.return_value = response(503)
+        assert self.make_request().get('doi/10.4124/abcd1234').status_code == 503
+        assert mock_request.call_count == 3
+
+    def test_does_not_retry_client_errors(self, mock_get_breaker, mock_get_session):
+        mock_get_breaker.return_value = CircuitBreaker(5, 30)
+        mock_request = mock_get_session.return_value.request
+        mock_request.return_value = response(404)
+        assert self.make_request().get('doi/10.4124/abcd1234').status_code == 404
+        assert mock_request.call_count == 1
+
+    def test_honours_retry_after(self, mock_get_breaker, mock_get_session):
+        mock_get_breaker.return_value = CircuitBreaker(5, 30)
+        mock_request = mock_get_session.return_value.request
+        mock_request.side_effect = [
+            response(429, {'Retry-After': '2'}),
+            response(201),
+        ]
+        request = self.make_request()
+        request.post('metadata', body='<xml/>')
+        request.sleep.assert_called_once_with(2)
+
+    def test_retries_connection_errors(self, mock_get_breaker, mock_get_session):
+        mock_get_breaker.return_value = CircuitBreaker(5, 30)
+        mock_request = mock_get_session.return_value.request
+        mock_request.side_effect = [
+            requests.exceptions.ConnectionError('reset'),
+            response(200),
+        ]
+        assert self.make_request().get('doi/10.4124/abcd1234').status_code == 200
+
+    def test_does_not_retry_read_timeouts(self, mock_get_breaker, mock_get_session):
+        mock_get_breaker.return_value = CircuitBreaker(5, 30)
+        mock_request = mock_get_session.return_value.request
+        mock_request.side_effect = requests.exceptions.ReadTimeout('slow')
+        with pytest.raises(HttpError):
+            self.make_request().get('doi/10.4124/abcd1234')
+        assert mock_request.call_count == 1
+
+    def test_breaker_opens(self, mock_get_breaker, mock_get_session):
+        breaker = CircuitBreaker(2, 30)
+        mock_get_breaker.return_value = breaker
+        mock_request = mock_get_session.return_value.request
+        mock_request.return_value = response(503)
+        # stops retrying as soon as the breaker opens
+        assert self.make_request().get('doi/10.4124/abcd1234').status_code == 503
+        assert mock_request.call_count == 2
+        assert breaker.state == OPEN
+        # and then fails fast
+        with pytest.raises(DataCiteUnavailableError):
+            self.make_request().get('doi/10.4124/abcd1234')
+        assert mock_request.call_count == 2
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import copy
+
+import pytest
+from datacite import schema42
+
+from ckanext.doi.lib.metadata import build_xml_dict
+from ckanext.doi.lib.serialisation import from_xml, normalise, to_xml
+
+from .helpers import constants
+
+# uses every field schema42 knows about, plus some that need escaping
+FULL_XML_DICT = {
+    'identifiers': [
+        {'identifier': 'https://data.nhm.ac.uk/dataset/1', 'identifierType': 'URL'},
+        {'identifier': '10.4124/abcd1234', 'identifierType': 'DOI'},
+    ],
+    'creators': [
+        {
+            'name': 'Smith & Sons <Ltd>',
+            'nameType': 'Organizational',
+            'lang': 'en',
+        },
+        {
+            'name': 'Doe, Jane',
+            'nameType': 'Personal',
+            'givenName': 'Jane',
+            'familyName': 'Doe',
+            'nameIdentifiers': [
+                {
+                    'nameIdentifier': '0000-0000-0000-0000',
+                    'nameIdentifierScheme': 'ORCID',
+                    'schemeURI': 'https://orcid.org',
+                },
+                {'nameIdentifier': '', 'nameIdentifierScheme': 'ORCID'},
+            ],
+            'affiliations': [{'affiliation': 'Natural History Museum'}],
+        },
+    ],
+    'titles': [
+        {'title': 'A "quoted" title\r\nwith\ttabs', 'lang': 'en'},
+        {'title': 'Subtitle', 'type': 'Other', 'titleType': 'Subtitle'},
+    ],
+    'publisher': 'Natural History Museum',
+    'publicationYear': 2020,
+    'subjects': [
+        {
+            'subject': 'Zoology',
+            'subjectScheme': 'x',
+            'schemeURI': 'https://example.com',
+            'valueURI': 'https://example.com/zoology',
+            'lang': 'en',
+        }
+    ],
+    'contributors': [
+        {'name': 'Bloggs, Joe', 'contributorType': 'DataCurator', 'lang': 'en'}
+    ],
+    'dates': [
+        {'date': '2020-01-01', 'dateType': 'Created'},
+        {'date': '2020-01-02', 'dateType': 'Updated', 'dateInformation': 'a\n"b"'},
+    ],
+    'language': 'en',
+    'types': {'resourceType': None, 'resourceTypeGeneral': 'Dataset'},
+    'relatedIdentifiers': [
+        {
+            'relatedIdentifier': 'https://example.com',
+            'relatedIdentifierType': 'URL',
+            'relationType': 'IsSourceOf',
+            'resourceTypeGeneral': 'Text',
+        }
+    ],
+    'sizes': ['10 kB', None, ''],
+    'formats': ['text/csv'],
+    'version': '1.0',
+    'rightsList': [
+        {'rights': 'CC0', 'rightsURI': 'https://creativecommons.org', 'lang': 'en'},
+        {'rightsURI': 'https://example.com'},
+    ],
+    'descriptions': [
+        {'description': 'Spécimens ☃', 'descriptionType': 'Abstract', 'lang': 'fr'}
+    ],
+    'geoLocations': [
+        {
+            'geoLocationPlace': 'London',
+            'geoLocationPoint': {'pointLongitude': -0.17, 'pointLatitude': 51.5},
+            'geoLocationBox': {
+                'westBoundLongitude': -1,
+                'eastBoundLongitude': 1,
+                'southBoundLatitude': 50,
+                'northBoundLatitude': 52,
+            },
+            'geoLocationPolygons': [
+                {
+                    'polygonPoints': [
+                        {'pointLongitude': 0, 'pointLatitude': 0},
+                        {'pointLongitude': 1, 'pointLatitude': 1},
+                    ],
+                    'inPolygonPoint': {'pointLongitude': 0.5, 'pointLatitude': 0.5},
+                }
+            ],
+        },
+        {},
+    ],
+    'fundingReferences': [
+        {
+            'funderName': 'Funder',
+            'funderIdentifier': '123',
+            'funderIdentifierType': 'ISNI',
+            'awardNumber': '1',
+            'awardURI': 'https://example.com/award',
+            'awardTitle': 'Award',
+        },
+        {'funderName': 'Another funder'},
+    ],
+    # not serialised by schema42
+    'schemaVersion': 'http://datacite.org/schema/kernel-4',
+}
+
+
+def metadata_xml_dict():
+    xml_dict = build_xml_dict(constants.METADATA_DICT)
+    xml_dict['identifiers'] = [
+        {'identifierType': 'DOI', 'identifier': '10.4124/abcd1234'}
+    ]
+    return xml_dict
+
+
+@pytest.mark.parametrize(
+    'xml_dict',
+    [constants.XML_DICT, FULL_XML_DICT, {}],
+    ids=['minimal', 'full', 'empty'],
+)
+class TestParity:
+    def test_same_as_schema42(self, xml_dict):
+        assert to_xml(xml_dict) == schema42.tostring(xml_dict).encode('utf-8')
+
+    def test_round_trip(self, xml_dict):
+        assert from_xml(to_xml(xml_dict)) == normalise(xml_dict)
+
+
+def test_generated_metadata():
+    xml_dict = metadata_xml_dict()
+    xml = to_xml(xml_dict)
+    assert xml == schema42.tostring(xml_dict).encode('utf-8')
+    assert from_xml(xml) == normalise(xml_dict)
+
+
+def test_invalid_characters():
+    xml_dict = copy.deepcopy(constants.XML_DICT)
+    xml_dict['titles'] = [{'title': 'bad\x00title'}]
+    with pytest.raises(ValueError):
+        schema42.tostring(xml_dict)
+    with pytest.raises(ValueError):
+        to_xml(xml_dict)
+
+
+def test_duplicate_doi():
+    xml_dict = copy.deepcopy(constants.XML_DICT)
+    xml_dict['identifiers'].append(
+        {'identifierType': 'DOI', 'identifier': '10.4124/other'}
+    )
+    with pytest.raises(TypeError):
+        to_xml(xml_dict)
+
+
+class TestNormalise:
+    def test_values_are_strings(self):
+        normalised = normalise(FULL_XML_DICT)
+        assert normalised['publicationYear'] == '2020'
+        assert normalised['geoLocations'][0]['geoLocationPoint'] == {
+            'pointLongitude': '-0.17',
+            'pointLatitude': '51.5',
+        }
+
+    def test_empty_values_dropped(self):
+        normalised = normalise(FULL_XML_DICT)
+        assert 'schemaVersion' not in normalised
+        assert normalised['types'] == {'resourceTypeGeneral': 'Dataset'}
+        assert normalised['creators'][1]['nameIdentifiers'] == [
+            {
+                'nameIdentifier': '0000-0000-0000-0000',
+                'nameIdentifierScheme': 'ORCID',
+                'schemeURI': 'https://orcid.org',
+            }
+        ]
+        assert normalised['sizes'] == ['10 kB', '', '']
+
+    def test_doi_first(self):
+        normalised = normalise(FULL_XML_DICT)
+        assert [i['identifierType'] for i in normalised['identifiers']] == [
+            'DOI',
+            'URL',
+        ]
+
+    def test_title_type(self):
+        normalised = normalise(FULL_XML_DICT)
+        assert normalised['titles'][1] == {
+            'title': 'Subtitle',
+            'titleType': 'Subtitle',
+        }
+
+
+class TestFromXML:
+    def test_str(self):
+        xml = schema42.tostring(constants.XML_DICT)
+        assert from_xml(xml) == from_xml(xml.encode('utf-8'))
+
+    def test_unknown_elements(self):
+        xml = to_xml(constants.XML_DICT).replace(
+            b'</resource>',
+            b'<somethingNew a="1"><child>text</child></somethingNew></resource>',
+        )
+        parsed = from_xml(xml)
+        assert parsed != normalise(constants.XML_DICT)
+        assert parsed['other'] == [
+            {
+                'tag': 'somethingNew',
+                'attributes': {'a': '1'},
+                'children': [{'tag': 'child', 'text': 'text'}],
+            }
+        ]
+
+    def test_ignores_whitespace(self):
+        xml = to_xml(constants.XML_DICT).replace(b'\n', b'').replace(b'  ', b'')
+        assert from_xml(xml) == normalise(constants.XML_DICT)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+#
+# This file is part of ckanext-doi
+# Created by the Natural History Museum in London, UK
+
+import copy
+from unittest.mock import MagicMock, patch
+
+import pytest
+from datacite import schema42
+from jsonschema import ValidationError
+
+from ckanext.doi.lib.errors import DOIValidationError
+from ckanext.doi.lib.validation import clear_validation_cache, validate_xml_dict
+
+from .helpers import constants
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    clear_validation_cache()
+    yield
+    clear_validation_cache()
+
+
+def test_valid():
+    validate_xml_dict(copy.deepcopy(constants.XML_DICT))
+
+
+def test_reports_all_errors():
+    xml_dict = copy.deepcopy(constants.XML_DICT)
+    del xml_dict['publisher']
+    xml_dict['titles'] = [{'title': 1}]
+    with pytest.raises(DOIValidationError) as e:
+        validate_xml_dict(xml_dict)
+    assert len(e.value.errors) == 2
+    # still catchable as a jsonschema error
+    assert isinstance(e.value, ValidationError)
+
+
+def test_valid_metadata_is_only_checked_once():
+    mock_iter_errors = MagicMock(wraps=schema42.validator.iter_errors)
+    with patch(
+        'ckanext.doi.lib.validation.schema42',
+        MagicMock(validator=MagicMock(iter_errors=mock_iter_errors)),
+    ):
+        validate_xml_dict(copy.deepcopy(constants.XML_DICT))
+        validate_xml_dict(copy.deepcopy(constants.XML_DICT))
+    assert mock_iter_errors.call_count == 1
+
+
+def test_invalid_metadata_is_always_checked():
+    xml_dict = copy.deepcopy(constants.XML_DICT)
+    del xml_dict['publisher']
+    for _ in range(2):
+        with pytest.raises(DOIValidationError):
+            validate_xml_dict(xml_dict)